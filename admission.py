@@ -0,0 +1,271 @@
+import hashlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class AdmissionRejected(Exception):
+    """操作因并发已满或排队超时被拒绝。"""
+
+    def __init__(self, op_class, repo=None, retry_after=1, reason='busy'):
+        self.op_class = op_class
+        self.repo = repo
+        self.retry_after = retry_after
+        self.reason = reason
+        super().__init__(f'{op_class} 并发已满 ({reason})，请 {retry_after} 秒后重试')
+
+
+class ProcessSlots:
+    """用 flock 文件锁实现的跨进程名额，供多个工作进程共享同一组并发上限。
+
+    每个名额对应一个锁文件，持有者进程退出（包括崩溃）时锁由内核自动释放。
+    """
+
+    def __init__(self, directory):
+        if fcntl is None:
+            raise RuntimeError('当前平台不支持 fcntl.flock')
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _try_lock(self, name, limit):
+        for i in range(limit):
+            fd = os.open(os.path.join(self.directory, f'{name}.{i}.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        return None
+
+    def try_acquire(self, op_class, repo, global_limit, per_repo_limit):
+        """尝试占用全局名额和单仓库名额，任一已满时返回 None。"""
+        fds = []
+        if global_limit:
+            fd = self._try_lock(op_class, global_limit)
+            if fd is None:
+                return None
+            fds.append(fd)
+        if repo and per_repo_limit:
+            repo_key = hashlib.sha1(repo.encode('utf-8')).hexdigest()[:16]
+            fd = self._try_lock(f'{op_class}.{repo_key}', per_repo_limit)
+            if fd is None:
+                self.release(fds)
+                return None
+            fds.append(fd)
+        return fds
+
+    def release(self, fds):
+        for fd in fds:
+            os.close(fd)
+
+
+class _Waiter:
+    __slots__ = ('repo', 'admitted')
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.admitted = False
+
+
+class _OperationClass:
+    """单个操作类别的全局/单仓库并发计数与 FIFO 等待队列。"""
+
+    def __init__(self, name, global_limit, per_repo_limit, max_queue, queue_timeout):
+        self.name = name
+        self.global_limit = global_limit
+        self.per_repo_limit = per_repo_limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self.per_repo = {}
+        self.waiters = []
+        self.avg_hold = 1.0
+        self.admitted_total = 0
+        self.rejected_total = 0
+
+    def has_capacity(self, repo):
+        if self.global_limit and self.running >= self.global_limit:
+            return False
+        if repo and self.per_repo_limit and self.per_repo.get(repo, 0) >= self.per_repo_limit:
+            return False
+        return True
+
+    def retry_after(self):
+        slots = self.global_limit or 1
+        estimate = self.avg_hold * (len(self.waiters) + 1) / slots
+        return max(1, int(estimate + 0.999))
+
+
+class AdmissionController:
+    """按操作类别限制昂贵 git 操作的并发数。
+
+    每个类别有全局上限和单仓库上限；超出时按到达顺序排队，
+    排在前面但所属仓库已满的请求不会阻塞其他仓库的请求。
+    队列已满或等待超时时抛出 AdmissionRejected，由调用方转换为 503。
+
+    传入 slots（ProcessSlots）时，进程内排队通过后还需取得跨进程名额，
+    使多工作进程部署下的上限对整台机器生效。
+    """
+
+    def __init__(self, limits=None, default_queue_timeout=10, default_max_queue=100, slots=None):
+        self._lock = threading.Condition()
+        self._classes = {}
+        self.slots = slots
+        self.default_queue_timeout = default_queue_timeout
+        self.default_max_queue = default_max_queue
+        for name, conf in (limits or {}).items():
+            self.configure(name, **conf)
+
+    def configure(self, name, global_limit=0, per_repo_limit=0, max_queue=None, queue_timeout=None):
+        """设置（或更新）一个操作类别的限制，0 表示不限制。"""
+        with self._lock:
+            cls = self._classes.get(name)
+            if cls is None:
+                cls = _OperationClass(name, 0, 0, 0, 0)
+                self._classes[name] = cls
+            cls.global_limit = global_limit
+            cls.per_repo_limit = per_repo_limit
+            cls.max_queue = self.default_max_queue if max_queue is None else max_queue
+            cls.queue_timeout = self.default_queue_timeout if queue_timeout is None else queue_timeout
+            self._lock.notify_all()
+
+    def _first_eligible(self, cls):
+        for waiter in cls.waiters:
+            if cls.has_capacity(waiter.repo):
+                return waiter
+        return None
+
+    def acquire(self, op_class, repo=None, timeout=None):
+        """获取一个执行名额，返回释放时需要传回的句柄。"""
+        started = time.monotonic()
+        handle = self._acquire_local(op_class, repo, timeout)
+        if handle is None or self.slots is None:
+            return handle
+
+        cls = handle[0]
+        deadline = started + (cls.queue_timeout if timeout is None else timeout)
+        delay = 0.01
+        while True:
+            fds = self.slots.try_acquire(op_class, repo, cls.global_limit, cls.per_repo_limit)
+            if fds is not None:
+                return handle + (fds,)
+            if time.monotonic() >= deadline:
+                self.release(handle)
+                with self._lock:
+                    cls.rejected_total += 1
+                raise AdmissionRejected(op_class, repo, cls.retry_after(), 'timeout')
+            time.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+            delay = min(delay * 2, 0.2)
+
+    def try_acquire(self, op_class, repo=None):
+        """不排队地尝试获取名额，已满时返回 False。
+
+        供 asyncio 等不能阻塞线程的调用方轮询使用；类别未配置时与 acquire 一样返回 None。
+        """
+        with self._lock:
+            cls = self._classes.get(op_class)
+            if cls is None:
+                return None
+            if cls.waiters or not cls.has_capacity(repo):
+                return False
+            handle = self._admit(cls, repo)
+        if self.slots is None:
+            return handle
+        fds = self.slots.try_acquire(op_class, repo, cls.global_limit, cls.per_repo_limit)
+        if fds is None:
+            self.release(handle)
+            return False
+        return handle + (fds,)
+
+    def reject(self, op_class, repo=None, reason='timeout'):
+        """记录一次拒绝并返回对应的异常，供轮询等待超时的调用方抛出。"""
+        with self._lock:
+            cls = self._classes[op_class]
+            cls.rejected_total += 1
+            return AdmissionRejected(op_class, repo, cls.retry_after(), reason)
+
+    def queue_timeout(self, op_class):
+        cls = self._classes.get(op_class)
+        return cls.queue_timeout if cls else self.default_queue_timeout
+
+    def _acquire_local(self, op_class, repo, timeout):
+        with self._lock:
+            cls = self._classes.get(op_class)
+            if cls is None:
+                return None
+
+            if not cls.waiters and cls.has_capacity(repo):
+                return self._admit(cls, repo)
+
+            if cls.max_queue and len(cls.waiters) >= cls.max_queue:
+                cls.rejected_total += 1
+                raise AdmissionRejected(op_class, repo, cls.retry_after(), 'queue full')
+
+            waiter = _Waiter(repo)
+            cls.waiters.append(waiter)
+            deadline = time.monotonic() + (cls.queue_timeout if timeout is None else timeout)
+            try:
+                while True:
+                    if self._first_eligible(cls) is waiter:
+                        return self._admit(cls, repo)
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        cls.rejected_total += 1
+                        raise AdmissionRejected(op_class, repo, cls.retry_after(), 'timeout')
+                    self._lock.wait(remaining)
+            finally:
+                cls.waiters.remove(waiter)
+                self._lock.notify_all()
+
+    def _admit(self, cls, repo):
+        cls.running += 1
+        cls.admitted_total += 1
+        if repo:
+            cls.per_repo[repo] = cls.per_repo.get(repo, 0) + 1
+        return (cls, repo, time.monotonic())
+
+    def release(self, handle):
+        """归还执行名额并唤醒等待者。"""
+        if handle is None:
+            return
+        cls, repo, started = handle[:3]
+        if len(handle) > 3:
+            self.slots.release(handle[3])
+        with self._lock:
+            cls.running -= 1
+            if repo:
+                cls.per_repo[repo] -= 1
+                if cls.per_repo[repo] <= 0:
+                    del cls.per_repo[repo]
+            cls.avg_hold = cls.avg_hold * 0.9 + (time.monotonic() - started) * 0.1
+            self._lock.notify_all()
+
+    @contextmanager
+    def admit(self, op_class, repo=None, timeout=None):
+        """在上下文期间占用一个名额。"""
+        handle = self.acquire(op_class, repo, timeout)
+        try:
+            yield
+        finally:
+            self.release(handle)
+
+    def stats(self):
+        """返回各类别当前运行数、排队数与累计计数。"""
+        with self._lock:
+            return {
+                name: {
+                    'running': cls.running,
+                    'queued': len(cls.waiters),
+                    'global_limit': cls.global_limit,
+                    'per_repo_limit': cls.per_repo_limit,
+                    'admitted_total': cls.admitted_total,
+                    'rejected_total': cls.rejected_total,
+                }
+                for name, cls in self._classes.items()
+            }
@@ -0,0 +1,341 @@
+"""Smart HTTP 的 asyncio (ASGI) 传输。
+
+.git/ 下的 info/refs、git-upload-pack、git-receive-pack 在事件循环中处理：
+请求体按块写入 git 的标准输入，输出按块发送给客户端，两个方向都遵循背压，
+因此每个进行中的克隆/推送只占用几十 KB 缓冲区，而不是一个阻塞的线程。
+其余路径交给 Flask 应用（需要安装 a2wsgi），也可以由反向代理只把 .git/
+路径转发到这里：
+
+    uvicorn asgi:app --workers 8
+    python serve.py --asgi
+"""
+import asyncio
+import re
+import time
+import zlib
+from urllib.parse import parse_qs
+
+try:
+    from a2wsgi import WSGIMiddleware
+except ImportError:
+    WSGIMiddleware = None
+
+import gitexec
+import metrics
+import web
+
+
+GIT_PATH = re.compile(r'^/([^/]+)\.git/(info/refs|git-upload-pack|git-receive-pack)$')
+ENDPOINTS = {'info/refs': 'git_info_refs', 'git-upload-pack': 'git_upload_pack', 'git-receive-pack': 'git_receive_pack'}
+PACK_HEAD_SIZE = 65536
+RECEIVE_HEAD_SIZE = 1024 * 1024
+
+wsgi_app = WSGIMiddleware(web.app) if WSGIMiddleware is not None else None
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class RequestBody:
+    """按块读取 ASGI 请求体，透明解压 gzip。"""
+
+    def __init__(self, receive, gzipped=False):
+        self.receive = receive
+        self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+        self.done = False
+        self.bytes_in = 0
+
+    async def chunks(self):
+        while not self.done:
+            message = await self.receive()
+            if message['type'] == 'http.disconnect':
+                raise ClientDisconnected()
+            data = message.get('body', b'')
+            self.done = not message.get('more_body', False)
+            if self.decoder is not None:
+                data = self.decoder.decompress(data)
+                if self.done:
+                    data += self.decoder.flush()
+            if data:
+                self.bytes_in += len(data)
+                yield data
+
+
+async def read_head(chunks):
+    """读取请求开头直到得到第一个完整的 pkt-line（用于识别协议 v2 命令）。"""
+    head = b''
+    async for chunk in chunks:
+        head += chunk
+        if len(head) >= 4:
+            try:
+                length = int(head[:4], 16)
+            except ValueError:
+                break
+            if len(head) >= length or len(head) >= PACK_HEAD_SIZE:
+                break
+    return head
+
+
+def get_header(scope, name):
+    name = name.lower().encode()
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return ''
+
+
+async def start_response(send, status, content_type, headers=None):
+    header_list = [(b'content-type', content_type.encode())]
+    for key, value in (headers or {}).items():
+        header_list.append((key.lower().encode(), str(value).encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': status, 'headers': header_list})
+
+
+async def send_response(send, status, body=b'', content_type='text/plain; charset=utf-8', headers=None):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    await start_response(send, status, content_type, dict(headers or {}, **{'Content-Length': len(body)}))
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def admit(op_class, repo_path):
+    """在事件循环中等待执行名额；不阻塞线程，超时后抛出 AdmissionRejected。"""
+    if not op_class:
+        return None
+    deadline = time.monotonic() + web.admission_control.queue_timeout(op_class)
+    delay = 0.01
+    while True:
+        handle = web.admission_control.try_acquire(op_class, repo_path)
+        if handle is not False:
+            return handle
+        if time.monotonic() >= deadline:
+            raise web.admission_control.reject(op_class, repo_path)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.25)
+
+
+async def next_chunk(chunks):
+    try:
+        return await chunks.__anext__()
+    except StopAsyncIteration:
+        return b''
+
+
+async def pump_stdin(proc, head, chunks, capture=None, capture_limit=PACK_HEAD_SIZE):
+    """把请求体写入 git 标准输入；write() 等待管道排空，从而对客户端形成背压。
+
+    capture 保存请求体的前 capture_limit 字节（推送命令列表与 pack 头）。
+    """
+    try:
+        if head:
+            if capture is not None:
+                capture.extend(head[:capture_limit])
+            if not await proc.write(head):
+                return
+        async for chunk in chunks:
+            if capture is not None and len(capture) < capture_limit:
+                capture.extend(chunk[:capture_limit - len(capture)])
+            if not await proc.write(chunk):
+                return
+    finally:
+        proc.close_stdin()
+
+
+async def watch_disconnect(receive, proc, writer):
+    """请求体读完后监听客户端断开，断开时终止 git 进程。"""
+    await asyncio.gather(writer, return_exceptions=True)
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            proc.cancel()
+            return
+
+
+async def handle_info_refs(scope, send, repo_path, transfer, env, git_protocol):
+    service_name = parse_qs(scope.get('query_string', b'').decode()).get('service', [''])[0]
+    if service_name not in ('git-upload-pack', 'git-receive-pack'):
+        return await send_response(send, 404, 'Unknown service')
+
+    proc = await gitexec.AsyncGitProcess(
+        ['git', service_name[4:], '--stateless-rpc', '--advertise-refs', web.get_git_dir(repo_path)],
+        op='advertise', env=env).start()
+    try:
+        refs_data = await proc.read_all()
+        returncode = await proc.wait()
+    finally:
+        await proc.close()
+    if returncode != 0:
+        return await send_response(send, 500, proc.stderr)
+
+    response_data = web.format_advertisement(service_name, git_protocol, refs_data)
+    transfer['service'] = f'{service_name}-advertisement'
+    web.record_git_transfer(transfer, 'ok', 0, len(response_data))
+    await send_response(send, 200, response_data, f'application/x-{service_name}-advertisement', web.NO_CACHE_HEADERS)
+
+
+async def handle_upload_pack(scope, receive, send, repo_path, transfer, env, git_protocol, body):
+    chunks = body.chunks().__aiter__()
+    head = await read_head(chunks)
+    command = web.get_v2_command(head) if web.is_protocol_v2(git_protocol) else None
+    if command:
+        transfer['command'] = command
+    handle = await admit(None if command == 'ls-refs' else 'upload-pack', repo_path)
+
+    status = 'error'
+    sent = 0
+    objects = None
+    pack_head = b''
+    proc = writer = watcher = None
+    try:
+        proc = await gitexec.AsyncGitProcess(
+            ['git', 'upload-pack', '--stateless-rpc', web.get_git_dir(repo_path)],
+            op='upload-pack', env=env).start(stdin=True)
+        writer = asyncio.ensure_future(pump_stdin(proc, head, chunks))
+        output = proc.iter_chunks()
+        chunk = await next_chunk(output)
+        if not chunk:
+            await asyncio.gather(writer, return_exceptions=True)
+            if await proc.wait() != 0 or proc.killed:
+                await send_response(send, 500, proc.stderr or 'git upload-pack 失败')
+                return
+
+        watcher = asyncio.ensure_future(watch_disconnect(receive, proc, writer))
+        await start_response(send, 200, 'application/x-git-upload-pack-result', web.NO_CACHE_HEADERS)
+        while chunk:
+            sent += len(chunk)
+            if objects is None and len(pack_head) < PACK_HEAD_SIZE:
+                pack_head += chunk
+                objects = metrics.pack_object_count(pack_head)
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await next_chunk(output)
+        await writer
+        await send({'type': 'http.response.body', 'body': b''})
+        status = 'cancelled' if proc.cancelled else 'ok'
+    except (ClientDisconnected, OSError):
+        status = 'cancelled'
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        if writer is not None and not writer.done():
+            writer.cancel()
+        if proc is not None:
+            await proc.close()
+        web.admission_control.release(handle)
+        web.record_git_transfer(transfer, status, body.bytes_in, sent, objects)
+
+
+async def handle_receive_pack(scope, receive, send, repo_path, transfer, env, body):
+    write_lock = web.lock_repo_for_push(transfer['repo'])
+    try:
+        repo_path = await asyncio.to_thread(web.get_repo_path, transfer['repo']) or repo_path
+        handle = await admit('receive-pack', repo_path)
+    except BaseException:
+        web.storage_pool.unlock(write_lock)
+        raise
+    request_head = bytearray()
+    status = 'error'
+    output = b''
+    proc = None
+    try:
+        proc = await gitexec.AsyncGitProcess(
+            ['git', 'receive-pack', '--stateless-rpc', web.get_git_dir(repo_path)],
+            op='receive-pack', env=env).start(stdin=True)
+        writer = asyncio.ensure_future(pump_stdin(proc, b'', body.chunks(), capture=request_head,
+                                                  capture_limit=RECEIVE_HEAD_SIZE))
+        output = await proc.read_all()
+        await writer
+        returncode = await proc.wait()
+        if returncode == 0 and not proc.killed:
+            await asyncio.to_thread(web.after_receive_pack, repo_path, bytes(request_head), output,
+                                    transfer['remote_addr'])
+            status = 'ok'
+    except ClientDisconnected:
+        status = 'cancelled'
+    finally:
+        if proc is not None:
+            await proc.close()
+        web.admission_control.release(handle)
+        web.storage_pool.unlock(write_lock)
+        web.record_git_transfer(transfer, status, body.bytes_in, len(output) if status == 'ok' else 0,
+                                metrics.pack_object_count(bytes(request_head)))
+
+    if status == 'ok':
+        await send_response(send, 200, output, 'application/x-git-receive-pack-result', web.NO_CACHE_HEADERS)
+    elif status == 'error':
+        await send_response(send, 500, proc.stderr if proc else 'git receive-pack 失败')
+
+
+async def handle_git(scope, receive, send, repo_name, service):
+    # get_repo_path 会查询元数据库并访问磁盘，不能在事件循环线程中执行
+    repo_path = await asyncio.to_thread(web.get_repo_path, repo_name)
+    if not repo_path:
+        return await send_response(send, 404, '未找到仓库')
+
+    git_protocol = web.parse_git_protocol(get_header(scope, 'Git-Protocol'))
+    env = web.git_service_env(git_protocol)
+    transfer = {
+        'started': time.monotonic(),
+        'repo': repo_name,
+        'service': service,
+        'protocol': git_protocol or 'version=0',
+        'remote_addr': (scope.get('client') or ('', 0))[0],
+        'user_agent': get_header(scope, 'User-Agent'),
+        'transport': 'asgi',
+    }
+
+    if service == 'info/refs':
+        return await handle_info_refs(scope, send, repo_path, transfer, env, git_protocol)
+    if scope['method'] != 'POST':
+        return await send_response(send, 405, 'Method Not Allowed')
+
+    body = RequestBody(receive, get_header(scope, 'Content-Encoding').lower() in ('gzip', 'x-gzip'))
+    if service == 'git-upload-pack':
+        return await handle_upload_pack(scope, receive, send, repo_path, transfer, env, git_protocol, body)
+    return await handle_receive_pack(scope, receive, send, repo_path, transfer, env, body)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI 入口：Smart HTTP 请求在这里处理，其他请求交给 Flask。"""
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    match = GIT_PATH.match(scope['path'])
+    query = scope.get('query_string', b'')
+    if match is None or (match.group(2) == 'info/refs' and b'service=' not in query):
+        if wsgi_app is None:
+            return await send_response(send, 404, '该路径由 WSGI 服务处理（安装 a2wsgi 后可在同一进程中提供）')
+        return await wsgi_app(scope, receive, send)
+
+    repo_name, service = match.groups()
+    endpoint = ENDPOINTS[service]
+    started = time.monotonic()
+    status = 500
+    metrics.HTTP_IN_FLIGHT.inc()
+
+    async def tracking_send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+            metrics.HTTP_REQUEST_DURATION.observe(time.monotonic() - started, endpoint=endpoint, method=scope['method'])
+        await send(message)
+
+    try:
+        await handle_git(scope, receive, tracking_send, repo_name, service)
+    except web.AdmissionRejected as e:
+        await send_response(tracking_send, 503, str(e), headers={'Retry-After': e.retry_after})
+    finally:
+        metrics.HTTP_IN_FLIGHT.dec()
+        metrics.HTTP_REQUESTS.inc(endpoint=endpoint, method=scope['method'], status=status)
@@ -0,0 +1,504 @@
+"""仓库、元数据库与 LFS 对象的增量备份和恢复。
+
+备份目录的布局：
+
+    repos/<仓库>/state.json      备份链：每次备份时的引用快照及对应的 bundle 文件
+    repos/<仓库>/<序号>.bundle   链上第一个是完整 bundle，之后的只包含上次备份以来新增的对象
+    repos/<仓库>/releases/...    发布附件的镜像，每次只复制新增或变化的文件
+    db/<时间>.db                 元数据库的在线一致性快照（SQLite 备份 API）
+    lfs/objects/...              LFS 对象，内容寻址，每次只复制新增的对象
+    manifests/<时间>.json        每次备份的汇总，恢复时以最新的一份为准
+
+引用与发布附件都没有变化的仓库不产生新文件；备份链超过 max_chain 个 bundle 时重新生成完整 bundle
+并删除旧链。各仓库在有界的线程池中并行备份，git 以低优先级运行，写入速度可限制。
+
+命令行用法（恢复前先停止服务）：
+
+    python backup.py run --dir /backup/olsc --jobs 8 --rate 200
+    python backup.py restore --dir /backup/olsc --jobs 8
+"""
+import argparse
+import datetime
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import db
+import gitexec
+import lfs
+import storage
+from importer import REPO_CONFIG, check, write_config
+
+
+DEFAULT_MAX_CHAIN = 30
+DB_SNAPSHOTS_KEEP = 7
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class Throttle:
+    """多个线程共享的写入限速器，rate 为每秒字节数，0 表示不限速。"""
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def consume(self, size):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + size / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+def timestamp():
+    # 精确到微秒，同一秒内的两次备份不会互相覆盖快照与清单
+    return datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+
+
+def write_json(path, data):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_json(path, default=None):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def list_refs(repo_path, op='backup'):
+    res = check(gitexec.run(['git', 'for-each-ref', '--format=%(objectname) %(refname)'], cwd=repo_path, op=op),
+                'git for-each-ref')
+    refs = {}
+    for line in res['stdout'].decode('utf-8', errors='surrogateescape').splitlines():
+        sha, _, ref = line.partition(' ')
+        refs[ref] = sha
+    return refs
+
+
+def read_head(repo_path, op='backup'):
+    res = gitexec.run(['git', 'symbolic-ref', '-q', 'HEAD'], cwd=repo_path, op=op)
+    return res['stdout'].decode('utf-8').strip() if res['returncode'] == 0 else None
+
+
+def existing_objects(repo_path, shas, op='backup'):
+    """返回 shas 中仓库里仍然存在的对象（强制推送后旧提交可能已被清理）。"""
+    if not shas:
+        return set()
+    res = check(gitexec.run(['git', 'cat-file', '--batch-check=%(objectname)'], cwd=repo_path, op=op,
+                            input=''.join(f'{sha}\n' for sha in shas).encode('ascii')), 'git cat-file')
+    return {line for line in res['stdout'].decode('ascii').splitlines() if not line.endswith(' missing')}
+
+
+def write_bundle(repo_path, path, refs, prerequisites, throttle, heartbeat=None, op='backup'):
+    """把 refs 写成 bundle，排除 prerequisites 可达的对象；没有新对象时返回 False。
+
+    git 把 bundle 写到标准输出，经过限速后写入临时文件，完整写入后才改名到位。
+    """
+    revs = ''.join(f'{ref}\n' for ref in refs) + ''.join(f'^{sha}\n' for sha in prerequisites)
+    tmp_path = f'{path}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f, gitexec.GitProcess(['git', 'bundle', 'create', '--quiet', '-', '--stdin'],
+                                                          cwd=repo_path, op=op, input=revs.encode('utf-8')) as proc:
+            for chunk in proc.iter_chunks():
+                throttle.consume(len(chunk))
+                f.write(chunk)
+                if heartbeat is not None:
+                    heartbeat()
+            returncode = proc.wait()
+            if returncode != 0:
+                stderr = proc.stderr.decode('utf-8', errors='replace')
+                if 'empty bundle' in stderr:
+                    return False
+                raise RuntimeError(f'git bundle 失败: {stderr.strip() or returncode}')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return True
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def bundle_heads(path, op='backup'):
+    res = check(gitexec.run(['git', 'bundle', 'list-heads', path], op=op), 'git bundle list-heads')
+    heads = {}
+    for line in res['stdout'].decode('utf-8', errors='surrogateescape').splitlines():
+        sha, _, ref = line.partition(' ')
+        heads[ref] = sha
+    return heads
+
+
+def backup_repo(name, repo_path, repo_dir, throttle, max_chain=DEFAULT_MAX_CHAIN, heartbeat=None):
+    """备份一个仓库及其发布附件，返回 {'name', 'status', 'bundle', 'size'}。
+
+    status 为 full（完整 bundle）、incremental（增量 bundle）、refs（只有引用变化，
+    所需对象都已在链上）、releases（只有发布附件变化）或 unchanged。
+    state.json 同时记录仓库当时的路径，恢复到别的位置时据此改写附件路径。
+    """
+    os.makedirs(repo_dir, exist_ok=True)
+    state_path = os.path.join(repo_dir, 'state.json')
+    state = read_json(state_path, {'seq': 0, 'chain': []})
+    last = state['chain'][-1] if state['chain'] else None
+
+    released = mirror_files(os.path.join(repo_path, 'releases'), os.path.join(repo_dir, 'releases'),
+                            throttle, heartbeat)
+    refs = list_refs(repo_path)
+    head = read_head(repo_path)
+    if last and last['refs'] == refs and last['head'] == head:
+        if state.get('path') != repo_path:
+            state['path'] = repo_path
+            write_json(state_path, state)
+        return {'name': name, 'status': 'releases' if released else 'unchanged', 'bundle': None, 'size': released}
+
+    full = last is None or len([e for e in state['chain'] if e['bundle']]) >= max_chain
+    if full:
+        wanted = sorted(refs)
+        prerequisites = set()
+    else:
+        wanted = sorted(ref for ref, sha in refs.items() if last['refs'].get(ref) != sha)
+        prerequisites = existing_objects(repo_path, sorted(set(last['refs'].values())))
+
+    state['seq'] += 1
+    bundle = f'{state["seq"]:06d}.bundle'
+    bundle_path = os.path.join(repo_dir, bundle)
+    if wanted and write_bundle(repo_path, bundle_path, wanted, prerequisites, throttle, heartbeat):
+        # 引用可能在列出之后又被推送更新，以 bundle 中实际记录的值为准
+        refs.update(bundle_heads(bundle_path))
+        size = os.path.getsize(bundle_path)
+    else:
+        if full and refs:
+            raise RuntimeError('无法生成完整 bundle')
+        bundle = None
+        size = 0
+
+    state['path'] = repo_path
+    entry = {'bundle': bundle, 'refs': refs, 'head': head, 'full': full, 'created_at': time.time()}
+    obsolete = []
+    if full:
+        obsolete = [e['bundle'] for e in state['chain'] if e['bundle']]
+        state['chain'] = [entry]
+    else:
+        state['chain'].append(entry)
+    write_json(state_path, state)
+    for old in obsolete:
+        try:
+            os.remove(os.path.join(repo_dir, old))
+        except FileNotFoundError:
+            pass
+    status = 'full' if full else ('incremental' if bundle else 'refs')
+    return {'name': name, 'status': status, 'bundle': bundle, 'size': size + released}
+
+
+def snapshot_db(db_file, path):
+    """用 SQLite 在线备份 API 生成一致性快照，不阻塞正在进行的写入。"""
+    tmp_path = f'{path}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    source = sqlite3.connect(db_file)
+    target = sqlite3.connect(tmp_path)
+    try:
+        source.backup(target, pages=1024, sleep=0.01)
+    finally:
+        target.close()
+        source.close()
+    os.replace(tmp_path, path)
+
+
+def copy_file(src, dst, throttle):
+    tmp_path = f'{dst}.tmp'
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    with open(src, 'rb') as fin, open(tmp_path, 'wb') as fout:
+        for chunk in iter(lambda: fin.read(COPY_CHUNK_SIZE), b''):
+            throttle.consume(len(chunk))
+            fout.write(chunk)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(tmp_path, dst)
+    return os.path.getsize(dst)
+
+
+def mirror_files(src, dst, throttle, heartbeat=None):
+    """把 src 目录镜像到 dst：复制新增或大小、修改时间不同的文件，删除 dst 中多余的文件。
+
+    复制经过限速，复制后保留源文件的修改时间，下次比较时未变的文件直接跳过。
+    src 不存在时清空 dst。返回复制的字节数。
+    """
+    copied = 0
+    seen = set()
+    for dirpath, dirnames, filenames in os.walk(src):
+        rel = os.path.relpath(dirpath, src)
+        for filename in filenames:
+            src_file = os.path.join(dirpath, filename)
+            dst_file = os.path.normpath(os.path.join(dst, rel, filename))
+            try:
+                st = os.stat(src_file)
+            except FileNotFoundError:
+                continue
+            seen.add(dst_file)
+            try:
+                dst_st = os.stat(dst_file)
+                if dst_st.st_size == st.st_size and dst_st.st_mtime_ns == st.st_mtime_ns:
+                    continue
+            except FileNotFoundError:
+                pass
+            try:
+                copied += copy_file(src_file, dst_file, throttle)
+            except FileNotFoundError:
+                seen.discard(dst_file)
+                continue
+            os.utime(dst_file, ns=(st.st_atime_ns, st.st_mtime_ns))
+            if heartbeat is not None:
+                heartbeat()
+    for dirpath, dirnames, filenames in os.walk(dst, topdown=False):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if path not in seen:
+                os.remove(path)
+        if not os.listdir(dirpath):
+            os.rmdir(dirpath)
+    return copied
+
+
+def sync_objects(src_root, dst_root, throttle, heartbeat=None):
+    """复制 src_root/objects 中 dst_root 还没有的 LFS 对象（内容寻址，同名即同内容）。"""
+    copied = 0
+    total = 0
+    src_objects = os.path.join(src_root, 'objects')
+    for dirpath, dirnames, filenames in os.walk(src_objects):
+        rel = os.path.relpath(dirpath, src_objects)
+        for filename in filenames:
+            dst = os.path.join(dst_root, 'objects', rel, filename)
+            if not os.path.exists(dst):
+                total += copy_file(os.path.join(dirpath, filename), dst, throttle)
+                copied += 1
+                if heartbeat is not None:
+                    heartbeat()
+    return {'objects': copied, 'size': total}
+
+
+def run_backup(backup_dir, pool, db_file, lfs_dir=None, jobs=4, rate=0, max_chain=DEFAULT_MAX_CHAIN,
+               progress=None):
+    """备份所有仓库、元数据库与 LFS 对象，返回本次的清单（同时写入 manifests/）。
+
+    progress(完成比例, 说明) 在每个仓库结束时以及写入 bundle 的过程中调用。
+    """
+    throttle = Throttle(rate)
+    started = time.time()
+    name = timestamp()
+    for sub in ('repos', 'db', 'manifests'):
+        os.makedirs(os.path.join(backup_dir, sub), exist_ok=True)
+
+    report = lambda fraction, message: progress(fraction, message) if progress is not None else None
+    report(0, '备份元数据库')
+    snapshot_db(db_file, os.path.join(backup_dir, 'db', f'{name}.db'))
+    snapshots = sorted(f for f in os.listdir(os.path.join(backup_dir, 'db')) if f.endswith('.db'))
+    for old in snapshots[:-DB_SNAPSHOTS_KEEP]:
+        os.remove(os.path.join(backup_dir, 'db', old))
+
+    repos = list(pool.iter_repos())
+    results = []
+    failed = []
+    done = 0
+
+    def backup_one(repo_name, repo_path):
+        fd = pool.lock_for_write(repo_name)
+        try:
+            return backup_repo(repo_name, pool.locate(repo_name) or repo_path,
+                               os.path.join(backup_dir, 'repos', repo_name), throttle, max_chain,
+                               heartbeat=lambda: report(done / max(len(repos), 1), f'正在备份 {repo_name}'))
+        finally:
+            pool.unlock(fd)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs), thread_name_prefix='olsc-backup') as executor:
+        futures = {executor.submit(backup_one, repo_name, repo_path): repo_name for repo_name, repo_path in repos}
+        for future in as_completed(futures):
+            repo_name = futures[future]
+            try:
+                results.append(future.result())
+            except Exception as e:
+                failed.append({'name': repo_name, 'error': str(e) or type(e).__name__})
+            done += 1
+            report(done / max(len(repos), 1), f'{done}/{len(repos)} {repo_name}')
+
+    lfs = None
+    if lfs_dir and os.path.isdir(lfs_dir):
+        report(1, '复制 LFS 对象')
+        lfs = sync_objects(lfs_dir, os.path.join(backup_dir, 'lfs'), throttle,
+                           heartbeat=lambda: report(1, '复制 LFS 对象'))
+
+    manifest = {
+        'name': name,
+        'started_at': started,
+        'finished_at': time.time(),
+        'db': f'{name}.db',
+        'repos': sorted(r['name'] for r in results),
+        'failed': failed,
+        'changed': sum(1 for r in results if r['status'] != 'unchanged'),
+        'size': sum(r['size'] for r in results),
+        'lfs': lfs,
+    }
+    write_json(os.path.join(backup_dir, 'manifests', f'{name}.json'), manifest)
+    return manifest
+
+
+def latest_manifest(backup_dir):
+    manifest_dir = os.path.join(backup_dir, 'manifests')
+    try:
+        names = sorted(f for f in os.listdir(manifest_dir) if f.endswith('.json'))
+    except FileNotFoundError:
+        return None
+    return read_json(os.path.join(manifest_dir, names[-1])) if names else None
+
+
+def restore_repo(repo_dir, repo_path, op='backup'):
+    """按备份链依次解包 bundle，再把引用与 HEAD 设为最后一次备份时的状态。"""
+    state = read_json(os.path.join(repo_dir, 'state.json'))
+    if not state or not state['chain']:
+        raise RuntimeError('没有备份记录')
+    temp_path = f'{repo_path}_temp_init'
+    if os.path.exists(temp_path):
+        shutil.rmtree(temp_path)
+    try:
+        check(gitexec.run(['git', 'init', '-q', '--bare', temp_path], op=op), 'git init')
+        write_config(temp_path, REPO_CONFIG)
+        for entry in state['chain']:
+            if entry['bundle']:
+                check(gitexec.run(['git', 'bundle', 'unbundle', os.path.join(repo_dir, entry['bundle'])],
+                                  cwd=temp_path, op=op), f'git bundle unbundle {entry["bundle"]}')
+        last = state['chain'][-1]
+        commands = ''.join(f'update {ref} {sha}\n' for ref, sha in sorted(last['refs'].items()))
+        check(gitexec.run(['git', 'update-ref', '--stdin'], cwd=temp_path, op=op, input=commands.encode('utf-8')),
+              'git update-ref')
+        if last['head']:
+            check(gitexec.run(['git', 'symbolic-ref', 'HEAD', last['head']], cwd=temp_path, op=op),
+                  'git symbolic-ref')
+        check(gitexec.run(['git', 'update-server-info'], cwd=temp_path, op=op), 'git update-server-info')
+        mirror_files(os.path.join(repo_dir, 'releases'), os.path.join(temp_path, 'releases'), Throttle())
+        os.rename(temp_path, repo_path)
+    finally:
+        if os.path.exists(temp_path):
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+
+def restore_db(backup_dir, db_file, manifest):
+    """把清单中的元数据库快照恢复到 db_file。"""
+    snapshot_db(os.path.join(backup_dir, 'db', manifest['db']), db_file)
+
+
+def restore_repos(backup_dir, pool, manifest, lfs_dir=None, jobs=4, progress=None):
+    """恢复仓库（已存在的跳过）与 LFS 对象，返回 {'restored', 'skipped', 'failed'}。
+
+    除清单中成功备份的仓库外，最近一次备份失败但此前有备份链的仓库也按其旧链恢复。
+    发布附件随仓库恢复，元数据库中的附件路径改写到恢复后的位置。
+    """
+    report = {'restored': [], 'skipped': [], 'failed': []}
+    candidates = list(manifest['repos'])
+    for failure in manifest.get('failed', []):
+        state = read_json(os.path.join(backup_dir, 'repos', failure['name'], 'state.json'))
+        if state and state['chain'] and failure['name'] not in candidates:
+            candidates.append(failure['name'])
+    names = []
+    for name in sorted(candidates):
+        if pool.locate(name):
+            report['skipped'].append(name)
+        else:
+            names.append(name)
+    done = 0
+
+    def restore_one(name):
+        repo_dir = os.path.join(backup_dir, 'repos', name)
+        state = read_json(os.path.join(repo_dir, 'state.json')) or {'chain': []}
+        size = sum(os.path.getsize(os.path.join(repo_dir, e['bundle'])) for e in state['chain'] if e['bundle'])
+        repo_path = os.path.join(pool.choose_root(size), name)
+        restore_repo(repo_dir, repo_path)
+        pool.record(name, repo_path)
+        if state.get('path') and os.path.abspath(state['path']) != os.path.abspath(repo_path):
+            db.rebase_release_asset_paths(name, state['path'], repo_path)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs), thread_name_prefix='olsc-restore') as executor:
+        futures = {executor.submit(restore_one, name): name for name in names}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                future.result()
+                report['restored'].append(name)
+            except Exception as e:
+                report['failed'].append({'name': name, 'error': str(e) or type(e).__name__})
+            done += 1
+            if progress is not None:
+                progress(done, len(names), name)
+
+    if lfs_dir and os.path.isdir(os.path.join(backup_dir, 'lfs')):
+        sync_objects(os.path.join(backup_dir, 'lfs'), lfs_dir, Throttle())
+    report['restored'].sort()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='增量备份与恢复仓库、元数据库和 LFS 对象')
+    parser.add_argument('command', choices=('run', 'restore'))
+    parser.add_argument('--dir', default=os.environ.get('OLSC_BACKUP_DIR'), help='备份目录（默认 OLSC_BACKUP_DIR）')
+    parser.add_argument('--jobs', type=int, default=int(os.environ.get('OLSC_BACKUP_JOBS', '4')), help='并行数')
+    parser.add_argument('--rate', type=float, default=float(os.environ.get('OLSC_BACKUP_RATE', '0')),
+                        help='写入限速（MB/s，0 为不限速）')
+    parser.add_argument('--max-chain', type=int, default=int(os.environ.get('OLSC_BACKUP_MAX_CHAIN', str(DEFAULT_MAX_CHAIN))),
+                        help='备份链上最多的 bundle 数，超过后重新生成完整 bundle')
+    parser.add_argument('--force', action='store_true', help='恢复时覆盖已存在的元数据库')
+    args = parser.parse_args()
+    if not args.dir:
+        parser.error('需要通过 --dir 或 OLSC_BACKUP_DIR 指定备份目录')
+
+    def progress(done, total, name):
+        print(f'[{done}/{total}] {name}', file=sys.stderr)
+
+    # 不导入 web：那会在命令行进程里启动任务队列、Webhook 投递等后台线程
+    pool = storage.pool_from_environ()
+    lfs_dir = lfs.root_from_environ(storage.data_dir_from_environ())
+    started = time.monotonic()
+    if args.command == 'restore':
+        manifest = latest_manifest(args.dir)
+        if manifest is None:
+            print('备份目录中没有可用的备份', file=sys.stderr)
+            return 1
+        if os.path.exists(db.DB_FILE) and not args.force:
+            print(f'{db.DB_FILE} 已存在，确认要覆盖时加上 --force', file=sys.stderr)
+            return 1
+        restore_db(args.dir, db.DB_FILE, manifest)
+        db.init_db()
+
+        report = restore_repos(args.dir, pool, manifest, lfs_dir, args.jobs, progress)
+        print(f'从 {manifest["name"]} 恢复 {len(report["restored"])} 个仓库，跳过 {len(report["skipped"])} 个，'
+              f'失败 {len(report["failed"])} 个，用时 {time.monotonic() - started:.1f} 秒')
+        for failure in report['failed']:
+            print(f'  {failure["name"]}: {failure["error"]}')
+        return 1 if report['failed'] else 0
+
+    db.init_db()
+    manifest = run_backup(args.dir, pool, db.DB_FILE, lfs_dir, args.jobs, int(args.rate * 1024 * 1024),
+                          args.max_chain)
+    print(f'备份 {len(manifest["repos"])} 个仓库（{manifest["changed"]} 个有变化，'
+          f'新增 {manifest["size"] / 1024 / 1024:.1f} MB），失败 {len(manifest["failed"])} 个，'
+          f'用时 {time.monotonic() - started:.1f} 秒')
+    for failure in manifest['failed']:
+        print(f'  {failure["name"]}: {failure["error"]}')
+    return 1 if manifest['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,318 @@
+"""Olsc_GitWeb 路由基准测试。
+
+在临时目录中生成可复现的合成仓库，通过 Flask 测试客户端驱动各个页面，
+报告延迟分位数、每请求 git 子进程数和峰值内存，并可与基线结果比较：
+
+    python bench.py --files 2000 --depth 4 --commits 500 --save baseline.json
+    python bench.py --files 2000 --depth 4 --commits 500 --baseline baseline.json
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+
+WORDS = ('alpha beta gamma delta epsilon zeta eta theta iota kappa lambda mu nu xi omicron pi rho sigma '
+         'tau upsilon phi chi psi omega def class return import while for if else try except yield').split()
+
+
+def synthetic_text(rng, size):
+    """生成指定大小、按行组织的伪随机文本。"""
+    lines = []
+    total = 0
+    while total < size:
+        line = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+        lines.append(line)
+        total += len(line) + 1
+    return ('\n'.join(lines) + '\n').encode()[:max(size, 1)]
+
+
+def synthetic_paths(files, depth):
+    """生成分布在不同深度目录中的文件路径。"""
+    paths = []
+    for i in range(files):
+        level = i % (depth + 1)
+        dirs = [f'dir{(i >> (2 * l)) % 4}' for l in range(level)]
+        paths.append('/'.join(dirs + [f'file{i}.txt']))
+    return paths
+
+
+def make_synthetic_repo(path, files=200, depth=3, commits=50, blob_size=2048, refs=10,
+                        seed=1, binary_blob_size=0):
+    """用 git fast-import 一次性生成裸仓库，返回仓库概况（样例文件、目录、提交）。"""
+    rng = random.Random(seed)
+    subprocess.run(['git', 'init', '-q', '--bare', path], check=True)
+    subprocess.run(['git', 'config', 'http.receivepack', 'true'], cwd=path, check=True)
+    paths = synthetic_paths(files, depth)
+
+    proc = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=path, stdin=subprocess.PIPE)
+    out = proc.stdin
+    mark = 0
+    commit_marks = []
+    timestamp = 1700000000
+
+    def write_blob(data):
+        nonlocal mark
+        mark += 1
+        out.write(b'blob\nmark :%d\ndata %d\n' % (mark, len(data)))
+        out.write(data)
+        out.write(b'\n')
+        return mark
+
+    for n in range(max(commits, 1)):
+        if n == 0:
+            changed = paths
+        else:
+            changed = rng.sample(paths, min(len(paths), rng.randint(1, 5)))
+        blob_marks = [(p, write_blob(synthetic_text(rng, blob_size))) for p in changed]
+        if n == 0 and binary_blob_size:
+            blob_marks.append(('assets/blob.bin', write_blob(rng.randbytes(binary_blob_size))))
+
+        mark += 1
+        commit_marks.append(mark)
+        message = f'Commit {n}: update {len(changed)} files'.encode()
+        who = b'Bench <bench@example.com> %d +0000' % (timestamp + n * 60)
+        out.write(b'commit refs/heads/master\nmark :%d\nauthor %s\ncommitter %s\ndata %d\n%s\n'
+                  % (mark, who, who, len(message), message))
+        if n > 0:
+            out.write(b'from :%d\n' % commit_marks[-2])
+        for p, blob in blob_marks:
+            out.write(b'M 100644 :%d %s\n' % (blob, p.encode()))
+        out.write(b'\n')
+
+    for i in range(refs):
+        target = commit_marks[rng.randrange(len(commit_marks))]
+        ref = f'refs/heads/branch{i}' if i % 4 == 0 else f'refs/tags/v{i}'
+        out.write(b'reset %s\nfrom :%d\n\n' % (ref.encode(), target))
+
+    out.close()
+    if proc.wait() != 0:
+        raise RuntimeError('git fast-import 失败')
+    subprocess.run(['git', 'update-server-info'], cwd=path, check=True)
+
+    deepest = max(paths, key=lambda p: p.count('/'))
+    return {
+        'path': path,
+        'sample_file': deepest,
+        'top_file': paths[0],
+        'sample_dir': os.path.dirname(deepest),
+        'commits': len(commit_marks),
+    }
+
+
+def add_repo_args(parser):
+    """合成仓库形状参数（bench 与 loadtest 共用）。"""
+    parser.add_argument('--files', type=int, default=200, help='文件数')
+    parser.add_argument('--depth', type=int, default=3, help='目录最大深度')
+    parser.add_argument('--commits', type=int, default=50, help='历史提交数')
+    parser.add_argument('--blob-size', type=int, default=2048, help='每个文本文件的字节数')
+    parser.add_argument('--binary-size', type=int, default=0, help='额外二进制文件的字节数（0 表示不生成）')
+    parser.add_argument('--refs', type=int, default=10, help='分支/标签数量')
+    parser.add_argument('--seed', type=int, default=1, help='随机种子，保证结果可复现')
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def build_routes(repo_name, info, head):
+    """需要测量的页面及其 URL。"""
+    base = f'/{repo_name}'
+    return {
+        'index': '/',
+        'view_tree': f'{base}/tree/master/',
+        'view_tree_subdir': f'{base}/tree/master/{info["sample_dir"]}',
+        'view_file': f'{base}/blob/master/{info["sample_file"]}',
+        'view_file_raw': f'{base}/blob/master/{info["sample_file"]}?raw=1',
+        'view_commits': f'{base}/commits/master',
+        'view_commit': f'{base}/commit/{head}',
+        'compare_nodes': f'{base}/compare?base=master~10&head=master',
+        'view_branches': f'{base}/branches',
+        'view_tags': f'{base}/tags',
+        'search': '/search?q=omega',
+        'view_releases': f'{base}/releases',
+        'new_release': f'{base}/releases/new',
+    }
+
+
+def run_benchmark(args):
+    workdir = tempfile.mkdtemp(prefix='olsc-bench-')
+    os.environ['OLSC_DATA_DIR'] = os.path.join(workdir, 'data')
+    os.environ['OLSC_DB_FILE'] = os.path.join(workdir, 'repos.db')
+    os.environ['OLSC_KEY_FILE'] = os.path.join(workdir, 'key.txt')
+    os.environ.setdefault('OLSC_GIT_ACCESS_LOG', '')
+    os.makedirs(os.environ['OLSC_DATA_DIR'])
+
+    try:
+        repo_name = 'bench'
+        repo_path = os.path.join(os.environ['OLSC_DATA_DIR'], repo_name)
+        started = time.perf_counter()
+        info = make_synthetic_repo(repo_path, args.files, args.depth, args.commits, args.blob_size,
+                                   args.refs, args.seed, args.binary_size)
+        print(f'生成合成仓库: {info["commits"]} 次提交, {args.files} 个文件, '
+              f'{args.refs} 个引用 ({time.perf_counter() - started:.1f}s)', file=sys.stderr)
+
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import db
+        import gitexec
+        import web
+
+        for i in range(3):
+            db.create_release(repo_name, f'v{i}', 'master', f'Release {i}', '## 更新\n\n- 条目 ' * 20)
+
+        forks = [0]
+        forks_lock = threading.Lock()
+
+        def count_fork(proc):
+            with forks_lock:
+                forks[0] += 1
+        gitexec.add_observer(count_fork)
+
+        head = subprocess.run(['git', 'rev-parse', 'master'], cwd=repo_path, capture_output=True,
+                              text=True, check=True).stdout.strip()
+        routes = build_routes(repo_name, info, head)
+        if args.routes:
+            routes = {k: v for k, v in routes.items() if k in args.routes}
+
+        client = web.app.test_client()
+        with client.session_transaction() as sess:
+            sess['authenticated'] = True
+
+        def fetch(url):
+            forks[0] = 0
+            t0 = time.perf_counter()
+            response = client.get(url)
+            response.get_data()
+            elapsed = time.perf_counter() - t0
+            response.close()
+            return response.status_code, elapsed, forks[0]
+
+        results = {}
+        for name, url in routes.items():
+            for _ in range(args.warmup):
+                fetch(url)
+            timings = []
+            fork_counts = []
+            status = None
+            for _ in range(args.iterations):
+                status, elapsed, count = fetch(url)
+                timings.append(elapsed * 1000)
+                fork_counts.append(count)
+
+            tracemalloc.start()
+            fetch(url)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            results[name] = {
+                'url': url,
+                'status': status,
+                'p50_ms': round(percentile(timings, 50), 3),
+                'p90_ms': round(percentile(timings, 90), 3),
+                'p99_ms': round(percentile(timings, 99), 3),
+                'mean_ms': round(statistics.fmean(timings), 3),
+                'git_forks': max(fork_counts),
+                'py_peak_kb': round(peak / 1024, 1),
+            }
+            print(f'{name:<18} {status} p50={results[name]["p50_ms"]:.1f}ms '
+                  f'p90={results[name]["p90_ms"]:.1f}ms forks={results[name]["git_forks"]}', file=sys.stderr)
+
+        children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        return {
+            'shape': {k: getattr(args, k) for k in ('files', 'depth', 'commits', 'blob_size', 'binary_size', 'refs', 'seed')},
+            'iterations': args.iterations,
+            'git_max_rss_kb': children_rss,
+            'server_max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'routes': results,
+        }
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            print(f'保留工作目录: {workdir}', file=sys.stderr)
+
+
+def compare(current, baseline, threshold, min_delta_ms):
+    """与基线比较，返回回归项列表。"""
+    regressions = []
+    for name, result in current['routes'].items():
+        base = baseline.get('routes', {}).get(name)
+        if not base:
+            continue
+        for key in ('p50_ms', 'p90_ms'):
+            if result[key] > base[key] * (1 + threshold) and result[key] - base[key] > min_delta_ms:
+                regressions.append(f'{name}: {key} {base[key]:.1f} -> {result[key]:.1f}')
+        if result['git_forks'] > base['git_forks']:
+            regressions.append(f'{name}: git_forks {base["git_forks"]} -> {result["git_forks"]}')
+        if result['status'] != base['status']:
+            regressions.append(f'{name}: status {base["status"]} -> {result["status"]}')
+    return regressions
+
+
+def print_table(current, baseline=None):
+    header = f'{"route":<18} {"status":>6} {"p50":>9} {"p90":>9} {"p99":>9} {"forks":>6} {"py_peak":>9}'
+    if baseline:
+        header += f' {"Δp50":>8}'
+    print(header)
+    for name, r in current['routes'].items():
+        line = (f'{name:<18} {r["status"]:>6} {r["p50_ms"]:>7.1f}ms {r["p90_ms"]:>7.1f}ms '
+                f'{r["p99_ms"]:>7.1f}ms {r["git_forks"]:>6} {r["py_peak_kb"]:>7.0f}KB')
+        base = (baseline or {}).get('routes', {}).get(name)
+        if base and base['p50_ms']:
+            line += f' {(r["p50_ms"] / base["p50_ms"] - 1) * 100:>+7.0f}%'
+        print(line)
+    print(f'git 子进程峰值 RSS: {current["git_max_rss_kb"]} KB, 服务进程峰值 RSS: {current["server_max_rss_kb"]} KB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Olsc_GitWeb 路由基准测试')
+    add_repo_args(parser)
+    parser.add_argument('--iterations', type=int, default=20, help='每个路由的测量次数')
+    parser.add_argument('--warmup', type=int, default=2, help='每个路由的预热次数')
+    parser.add_argument('--routes', nargs='*', help='只测量指定路由')
+    parser.add_argument('--save', help='把结果保存为 JSON（可作为基线）')
+    parser.add_argument('--baseline', help='与该基线 JSON 比较，发现回归时以非零状态退出')
+    parser.add_argument('--threshold', type=float, default=0.2, help='判定回归的相对阈值（默认 20%%）')
+    parser.add_argument('--min-delta-ms', type=float, default=2.0, help='判定回归的最小绝对差值')
+    parser.add_argument('--keep', action='store_true', help='保留生成的临时目录')
+    args = parser.parse_args()
+
+    current = run_benchmark(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_table(current, baseline)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+
+    if baseline:
+        if baseline.get('shape') != current['shape']:
+            print('警告: 基线使用了不同的仓库形状参数，比较结果可能无意义', file=sys.stderr)
+        regressions = compare(current, baseline, args.threshold, args.min_delta_ms)
+        if regressions:
+            print('\n发现性能回归:')
+            for item in regressions:
+                print(f'  - {item}')
+            sys.exit(1)
+        print('\n未发现回归。')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import json
+import os
+import sqlite3
+import time
+
+import metrics
+
+
+class SharedCache:
+    """基于 SQLite 的键值缓存，多个工作进程共享同一个文件。
+
+    只适合存放由不可变键（提交 SHA、对象 SHA 等）索引的数据，因此不需要失效机制；
+    条目数超过上限时按写入顺序淘汰最旧的条目。
+    """
+
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path, max_entries=500000):
+        self.path = path
+        self.max_entries = max_entries
+        self._writes = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS cache (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    UNIQUE (namespace, key)
+                )
+            ''')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def get(self, namespace, key):
+        """读取单个条目，不存在时返回 None。"""
+        return self.get_many(namespace, [key]).get(key)
+
+    def get_many(self, namespace, keys):
+        """批量读取，返回 {key: value}，只包含命中的键。"""
+        keys = list(keys)
+        found = {}
+        if keys:
+            conn = self._connect()
+            try:
+                for i in range(0, len(keys), 500):
+                    batch = keys[i:i + 500]
+                    rows = conn.execute(
+                        f'SELECT key, value FROM cache WHERE namespace = ? AND key IN ({",".join("?" * len(batch))})',
+                        [namespace] + batch).fetchall()
+                    found.update((k, json.loads(v)) for k, v in rows)
+            except sqlite3.Error:
+                found = {}
+            finally:
+                conn.close()
+        for key in keys:
+            metrics.record_cache(namespace, key in found)
+        return found
+
+    def set(self, namespace, key, value):
+        self.set_many(namespace, {key: value})
+
+    def set_many(self, namespace, items):
+        """批量写入；缓存写入失败（如数据库繁忙）不影响调用方。"""
+        if not items:
+            return
+        now = time.time()
+        rows = [(namespace, k, json.dumps(v, ensure_ascii=False), now) for k, v in items.items()]
+        conn = self._connect()
+        try:
+            conn.executemany('INSERT OR REPLACE INTO cache (namespace, key, value, created_at) VALUES (?, ?, ?, ?)', rows)
+            self._writes += len(rows)
+            if self._writes >= self.PRUNE_EVERY:
+                self._writes = 0
+                conn.execute('DELETE FROM cache WHERE id <= (SELECT MAX(id) FROM cache) - ?', (self.max_entries,))
+            conn.commit()
+        except sqlite3.Error:
+            pass
+        finally:
+            conn.close()
+
+    def clear(self, namespace=None):
+        conn = self._connect()
+        try:
+            if namespace:
+                conn.execute('DELETE FROM cache WHERE namespace = ?', (namespace,))
+            else:
+                conn.execute('DELETE FROM cache')
+            conn.commit()
+        finally:
+            conn.close()
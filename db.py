@@ -1,8 +1,9 @@
 import sqlite3
 import os
+import time
 
 
-DB_FILE = os.path.join(os.path.dirname(__file__), 'repos.db')
+DB_FILE = os.environ.get('OLSC_DB_FILE') or os.path.join(os.path.dirname(__file__), 'repos.db')
 
 def init_db():
     """初始化数据库"""
@@ -44,6 +45,101 @@ def init_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (release_id) REFERENCES releases(id)
         );
+
+        CREATE TABLE IF NOT EXISTS push_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            repo_name TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE TABLE IF NOT EXISTS event_subscribers (
+            name TEXT PRIMARY KEY,
+            last_event_id INTEGER NOT NULL DEFAULT 0,
+            lease_owner TEXT,
+            lease_expires REAL DEFAULT 0
+        );
+
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            repo_name TEXT,
+            params TEXT NOT NULL,
+            dedupe_key TEXT,
+            status TEXT DEFAULT 'queued',
+            progress REAL DEFAULT 0,
+            message TEXT DEFAULT '',
+            result TEXT,
+            error TEXT,
+            attempts INTEGER DEFAULT 0,
+            locked_by TEXT,
+            locked_until REAL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, id);
+        CREATE INDEX IF NOT EXISTS idx_jobs_dedupe ON jobs (dedupe_key, status);
+
+        CREATE TABLE IF NOT EXISTS repo_placements (
+            repo_name TEXT PRIMARY KEY,
+            root TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE TABLE IF NOT EXISTS repo_forks (
+            repo_name TEXT PRIMARY KEY,
+            parent_name TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE TABLE IF NOT EXISTS lfs_objects (
+            repo_name TEXT NOT NULL,
+            oid TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (repo_name, oid)
+        );
+        CREATE INDEX IF NOT EXISTS idx_lfs_objects_oid ON lfs_objects (oid);
+
+        CREATE TABLE IF NOT EXISTS webhooks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            repo_name TEXT NOT NULL,
+            url TEXT NOT NULL,
+            secret TEXT DEFAULT '',
+            active INTEGER DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE TABLE IF NOT EXISTS webhook_deliveries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            webhook_id INTEGER NOT NULL,
+            event TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL DEFAULT 0,
+            last_status_code INTEGER,
+            last_error TEXT,
+            locked_by TEXT,
+            locked_until REAL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            delivered_at TIMESTAMP,
+            FOREIGN KEY (webhook_id) REFERENCES webhooks(id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_webhook_deliveries_due ON webhook_deliveries (status, next_attempt_at);
+        CREATE INDEX IF NOT EXISTS idx_webhook_deliveries_webhook ON webhook_deliveries (webhook_id, id);
+
+        CREATE TABLE IF NOT EXISTS webhook_attempts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            delivery_id INTEGER NOT NULL,
+            status_code INTEGER,
+            response TEXT,
+            error TEXT,
+            duration_ms INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (delivery_id) REFERENCES webhook_deliveries(id)
+        );
     ''')
     
     conn.commit()
@@ -198,6 +294,16 @@ def get_asset(asset_id):
         }
     return None
 
+def delete_repo_releases(repo_name):
+    """删除仓库的所有发行版及附件记录（仓库被删除时；附件文件随仓库目录一起清理）"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM release_assets WHERE release_id IN (SELECT id FROM releases WHERE repo_name = ?)',
+                   (repo_name,))
+    cursor.execute('DELETE FROM releases WHERE repo_name = ?', (repo_name,))
+    conn.commit()
+    conn.close()
+
 def delete_release(release_id):
     """删除发行版"""
     conn = sqlite3.connect(DB_FILE)
@@ -211,3 +317,603 @@ def delete_release(release_id):
     conn.commit()
     conn.close()
     return paths
+
+def touch_repo(repo_name):
+    """更新仓库的最后活动时间"""
+    conn = sqlite3.connect(DB_FILE)
+    conn.execute('UPDATE repositories SET updated_at = CURRENT_TIMESTAMP WHERE name = ?', (repo_name,))
+    conn.commit()
+    conn.close()
+
+def add_push_event(repo_name, payload):
+    """把推送事件（JSON 字符串）写入持久队列，返回事件 ID"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute('INSERT INTO push_events (repo_name, payload) VALUES (?, ?)', (repo_name, payload))
+    event_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    return event_id
+
+def get_push_events(after_id, limit=100):
+    """按 ID 顺序读取 after_id 之后的推送事件"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute('SELECT id, repo_name, payload, created_at FROM push_events WHERE id > ? ORDER BY id LIMIT ?',
+                   (after_id, limit))
+    rows = cursor.fetchall()
+    conn.close()
+    return [{'id': r[0], 'repo_name': r[1], 'payload': r[2], 'created_at': r[3]} for r in rows]
+
+def register_event_subscriber(name):
+    """登记订阅者；新订阅者从当前最新事件之后开始，不回放登记前的历史事件"""
+    conn = sqlite3.connect(DB_FILE)
+    conn.execute('''
+        INSERT OR IGNORE INTO event_subscribers (name, last_event_id)
+        VALUES (?, (SELECT COALESCE(MAX(id), 0) FROM push_events))
+    ''', (name,))
+    conn.commit()
+    conn.close()
+
+def claim_event_subscriber(name, owner, lease_seconds):
+    """为订阅者取得（或续期）处理租约，返回其已处理到的事件 ID；租约被其他进程持有时返回 None"""
+    now = time.time()
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE event_subscribers SET lease_owner = ?, lease_expires = ?
+        WHERE name = ? AND (lease_owner IS NULL OR lease_owner = ? OR lease_expires < ?)
+    ''', (owner, now + lease_seconds, name, owner, now))
+    claimed = cursor.rowcount == 1
+    cursor.execute('SELECT last_event_id FROM event_subscribers WHERE name = ?', (name,))
+    row = cursor.fetchone()
+    conn.commit()
+    conn.close()
+    return row[0] if claimed and row else None
+
+def advance_event_subscriber(name, owner, event_id):
+    """记录订阅者已处理到 event_id；租约已被其他进程接管时返回 False"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute('UPDATE event_subscribers SET last_event_id = ? WHERE name = ? AND lease_owner = ?',
+                   (event_id, name, owner))
+    updated = cursor.rowcount == 1
+    conn.commit()
+    conn.close()
+    return updated
+
+def get_event_subscribers():
+    """获取所有订阅者的处理进度"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute('SELECT name, last_event_id, lease_owner, lease_expires FROM event_subscribers ORDER BY name')
+    rows = cursor.fetchall()
+    conn.close()
+    return [{'name': r[0], 'last_event_id': r[1], 'lease_owner': r[2], 'lease_expires': r[3]} for r in rows]
+
+def prune_push_events(keep_days=7):
+    """删除所有订阅者都已处理、且早于 keep_days 天的推送事件"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute('''
+        DELETE FROM push_events
+        WHERE id <= (SELECT COALESCE(MIN(last_event_id), 0) FROM event_subscribers)
+          AND created_at < datetime('now', ?)
+    ''', (f'-{int(keep_days)} days',))
+    deleted = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return deleted
+
+def get_webhooks(repo_name, active_only=False):
+    """获取仓库的 Webhook 列表"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    sql = 'SELECT id, repo_name, url, secret, active, created_at FROM webhooks WHERE repo_name = ?'
+    if active_only:
+        sql += ' AND active = 1'
+    cursor.execute(sql + ' ORDER BY id', (repo_name,))
+    rows = cursor.fetchall()
+    conn.close()
+    return [{'id': r[0], 'repo_name': r[1], 'url': r[2], 'secret': r[3], 'active': r[4], 'created_at': r[5]}
+            for r in rows]
+
+def get_webhook(webhook_id):
+    """获取单个 Webhook"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute('SELECT id, repo_name, url, secret, active, created_at FROM webhooks WHERE id = ?', (webhook_id,))
+    r = cursor.fetchone()
+    conn.close()
+    if r:
+        return {'id': r[0], 'repo_name': r[1], 'url': r[2], 'secret': r[3], 'active': r[4], 'created_at': r[5]}
+    return None
+
+def add_webhook(repo_name, url, secret=''):
+    """添加 Webhook"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute('INSERT INTO webhooks (repo_name, url, secret) VALUES (?, ?, ?)', (repo_name, url, secret))
+    webhook_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    return webhook_id
+
+def set_webhook_active(webhook_id, active):
+    """启用或停用 Webhook"""
+    conn = sqlite3.connect(DB_FILE)
+    conn.execute('UPDATE webhooks SET active = ? WHERE id = ?', (1 if active else 0, webhook_id))
+    conn.commit()
+    conn.close()
+
+def delete_webhook(webhook_id):
+    """删除 Webhook 及其投递记录"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM webhook_attempts WHERE delivery_id IN '
+                   '(SELECT id FROM webhook_deliveries WHERE webhook_id = ?)', (webhook_id,))
+    cursor.execute('DELETE FROM webhook_deliveries WHERE webhook_id = ?', (webhook_id,))
+    cursor.execute('DELETE FROM webhooks WHERE id = ?', (webhook_id,))
+    conn.commit()
+    conn.close()
+
+def delete_repo_webhooks(repo_name):
+    """删除仓库的所有 Webhook 及其投递记录（仓库被删除时）"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM webhook_attempts WHERE delivery_id IN (SELECT id FROM webhook_deliveries WHERE '
+                   'webhook_id IN (SELECT id FROM webhooks WHERE repo_name = ?))', (repo_name,))
+    cursor.execute('DELETE FROM webhook_deliveries WHERE webhook_id IN (SELECT id FROM webhooks WHERE repo_name = ?)',
+                   (repo_name,))
+    cursor.execute('DELETE FROM webhooks WHERE repo_name = ?', (repo_name,))
+    conn.commit()
+    conn.close()
+
+def enqueue_webhook_delivery(webhook_id, event, payload, merge, not_before):
+    """把一次事件加入 Webhook 的投递队列，返回投递 ID。
+
+    该 Webhook 已有尚未开始投递的同类事件时，调用 merge(旧负载, 新负载) 合并为一次投递，
+    不新增记录；merge 返回 None 表示两次事件相互抵消，删除该投递并返回 None。
+    否则新建一条在 not_before 之后投递的记录。负载均为 JSON 字符串。
+    """
+    conn = sqlite3.connect(DB_FILE, isolation_level=None)
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('''
+            SELECT id, payload FROM webhook_deliveries
+            WHERE webhook_id = ? AND event = ? AND status = 'pending' AND attempts = 0 AND locked_until < ?
+            ORDER BY id DESC LIMIT 1
+        ''', (webhook_id, event, time.time()))
+        row = cursor.fetchone()
+        if row:
+            merged = merge(row[1], payload)
+            if merged is None:
+                cursor.execute('DELETE FROM webhook_deliveries WHERE id = ?', (row[0],))
+                delivery_id = None
+            else:
+                cursor.execute('UPDATE webhook_deliveries SET payload = ? WHERE id = ?', (merged, row[0]))
+                delivery_id = row[0]
+        else:
+            cursor.execute('''
+                INSERT INTO webhook_deliveries (webhook_id, event, payload, next_attempt_at)
+                VALUES (?, ?, ?, ?)
+            ''', (webhook_id, event, payload, not_before))
+            delivery_id = cursor.lastrowid
+        cursor.execute('COMMIT')
+        return delivery_id
+    except Exception:
+        cursor.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+def claim_webhook_delivery(owner, lease_seconds):
+    """取得一条已到投递时间的记录并加锁，返回投递信息（含 Webhook 的 URL 与密钥）；没有时返回 None"""
+    now = time.time()
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+            SELECT d.id FROM webhook_deliveries d JOIN webhooks w ON w.id = d.webhook_id
+            WHERE d.status = 'pending' AND d.next_attempt_at <= ? AND d.locked_until < ? AND w.active = 1
+            ORDER BY d.next_attempt_at LIMIT 1
+        ''', (now, now))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        cursor.execute('''
+            UPDATE webhook_deliveries SET locked_by = ?, locked_until = ?
+            WHERE id = ? AND status = 'pending' AND locked_until < ?
+        ''', (owner, now + lease_seconds, row[0], now))
+        conn.commit()
+        if cursor.rowcount != 1:
+            return None
+        cursor.execute('''
+            SELECT d.id, d.webhook_id, d.event, d.payload, d.attempts, w.url, w.secret, w.repo_name
+            FROM webhook_deliveries d JOIN webhooks w ON w.id = d.webhook_id WHERE d.id = ?
+        ''', (row[0],))
+        r = cursor.fetchone()
+        return {'id': r[0], 'webhook_id': r[1], 'event': r[2], 'payload': r[3], 'attempts': r[4],
+                'url': r[5], 'secret': r[6], 'repo_name': r[7]}
+    finally:
+        conn.close()
+
+def finish_webhook_attempt(delivery_id, owner, status_code, response, error, duration_ms, next_attempt_at=None):
+    """记录一次投递尝试。next_attempt_at 为 None 时按 status_code 标记成功或最终失败，否则安排重试"""
+    succeeded = status_code is not None and 200 <= status_code < 300
+    if succeeded:
+        status = 'success'
+    elif next_attempt_at is not None:
+        status = 'pending'
+    else:
+        status = 'failed'
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO webhook_attempts (delivery_id, status_code, response, error, duration_ms)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (delivery_id, status_code, response, error, duration_ms))
+    cursor.execute('''
+        UPDATE webhook_deliveries
+        SET status = ?, attempts = attempts + 1, next_attempt_at = COALESCE(?, next_attempt_at),
+            last_status_code = ?, last_error = ?, locked_by = NULL, locked_until = 0,
+            delivered_at = CASE WHEN ? THEN CURRENT_TIMESTAMP ELSE delivered_at END
+        WHERE id = ? AND locked_by = ?
+    ''', (status, next_attempt_at, status_code, error, 1 if succeeded else 0, delivery_id, owner))
+    conn.commit()
+    conn.close()
+    return status
+
+def get_webhook_deliveries(webhook_id, limit=20):
+    """获取 Webhook 最近的投递记录（含每次尝试）"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT id, event, payload, status, attempts, next_attempt_at, last_status_code, last_error,
+               created_at, delivered_at
+        FROM webhook_deliveries WHERE webhook_id = ? ORDER BY id DESC LIMIT ?
+    ''', (webhook_id, limit))
+    deliveries = []
+    for r in cursor.fetchall():
+        attempt_cursor = conn.cursor()
+        attempt_cursor.execute('''
+            SELECT status_code, response, error, duration_ms, created_at
+            FROM webhook_attempts WHERE delivery_id = ? ORDER BY id
+        ''', (r[0],))
+        attempts = [{'status_code': a[0], 'response': a[1], 'error': a[2], 'duration_ms': a[3], 'created_at': a[4]}
+                    for a in attempt_cursor.fetchall()]
+        deliveries.append({
+            'id': r[0],
+            'event': r[1],
+            'payload': r[2],
+            'status': r[3],
+            'attempts': r[4],
+            'next_attempt_at': r[5],
+            'last_status_code': r[6],
+            'last_error': r[7],
+            'created_at': r[8],
+            'delivered_at': r[9],
+            'attempt_log': attempts
+        })
+    conn.close()
+    return deliveries
+
+def redeliver_webhook(webhook_id, delivery_id):
+    """把 Webhook 的一条投递复制为新的待投递记录，返回新 ID"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO webhook_deliveries (webhook_id, event, payload, next_attempt_at)
+        SELECT webhook_id, event, payload, ? FROM webhook_deliveries WHERE id = ? AND webhook_id = ?
+    ''', (time.time(), delivery_id, webhook_id))
+    new_id = cursor.lastrowid if cursor.rowcount else None
+    conn.commit()
+    conn.close()
+    return new_id
+
+def prune_webhook_deliveries(keep_days=30):
+    """删除早于 keep_days 天且已结束的投递记录"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cutoff = f'-{int(keep_days)} days'
+    cursor.execute('''
+        DELETE FROM webhook_attempts WHERE delivery_id IN (
+            SELECT id FROM webhook_deliveries
+            WHERE status IN ('success', 'failed') AND created_at < datetime('now', ?))
+    ''', (cutoff,))
+    cursor.execute('''
+        DELETE FROM webhook_deliveries WHERE status IN ('success', 'failed') AND created_at < datetime('now', ?)
+    ''', (cutoff,))
+    deleted = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return deleted
+
+def add_fork(repo_name, parent_name):
+    """记录 fork 关系"""
+    conn = sqlite3.connect(DB_FILE)
+    conn.execute('INSERT OR REPLACE INTO repo_forks (repo_name, parent_name) VALUES (?, ?)', (repo_name, parent_name))
+    conn.commit()
+    conn.close()
+
+def get_fork_parent(repo_name):
+    """获取 fork 的上游仓库名，不是 fork 时返回 None"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute('SELECT parent_name FROM repo_forks WHERE repo_name = ?', (repo_name,))
+    row = cursor.fetchone()
+    conn.close()
+    return row[0] if row else None
+
+def get_forks(parent_name):
+    """获取仓库的所有 fork"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute('SELECT repo_name FROM repo_forks WHERE parent_name = ? ORDER BY repo_name', (parent_name,))
+    rows = cursor.fetchall()
+    conn.close()
+    return [row[0] for row in rows]
+
+def remove_fork(repo_name):
+    """删除 fork 关系（仓库被删除或已与上游脱离）"""
+    conn = sqlite3.connect(DB_FILE)
+    conn.execute('DELETE FROM repo_forks WHERE repo_name = ?', (repo_name,))
+    conn.commit()
+    conn.close()
+
+def add_lfs_object(repo_name, oid, size):
+    """把 LFS 对象关联到仓库（对象本身在所有仓库间共享）"""
+    conn = sqlite3.connect(DB_FILE)
+    conn.execute('INSERT OR IGNORE INTO lfs_objects (repo_name, oid, size) VALUES (?, ?, ?)', (repo_name, oid, size))
+    conn.commit()
+    conn.close()
+
+def get_lfs_objects(repo_name, oids):
+    """返回 oids 中已关联到仓库的对象：{oid: 大小}"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    found = {}
+    oids = list(oids)
+    for i in range(0, len(oids), 500):
+        chunk = oids[i:i + 500]
+        cursor.execute(f'''
+            SELECT oid, size FROM lfs_objects WHERE repo_name = ? AND oid IN ({", ".join("?" * len(chunk))})
+        ''', [repo_name] + chunk)
+        found.update(cursor.fetchall())
+    conn.close()
+    return found
+
+def copy_lfs_objects(source_repo, target_repo):
+    """让 target_repo 可以访问 source_repo 的所有 LFS 对象（用于 fork）"""
+    conn = sqlite3.connect(DB_FILE)
+    conn.execute('''
+        INSERT OR IGNORE INTO lfs_objects (repo_name, oid, size)
+        SELECT ?, oid, size FROM lfs_objects WHERE repo_name = ?
+    ''', (target_repo, source_repo))
+    conn.commit()
+    conn.close()
+
+def remove_lfs_objects(repo_name):
+    """删除仓库的 LFS 对象关联，返回不再被任何仓库引用的对象 ID 列表"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT oid FROM lfs_objects AS o WHERE repo_name = ?
+        AND NOT EXISTS (SELECT 1 FROM lfs_objects WHERE oid = o.oid AND repo_name != o.repo_name)
+    ''', (repo_name,))
+    orphans = [row[0] for row in cursor.fetchall()]
+    cursor.execute('DELETE FROM lfs_objects WHERE repo_name = ?', (repo_name,))
+    conn.commit()
+    conn.close()
+    return orphans
+
+def get_unreferenced_lfs_objects(oids):
+    """返回 oids 中已不被任何仓库引用的对象 ID"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    referenced = set()
+    oids = list(oids)
+    for i in range(0, len(oids), 500):
+        chunk = oids[i:i + 500]
+        cursor.execute(f'SELECT DISTINCT oid FROM lfs_objects WHERE oid IN ({", ".join("?" * len(chunk))})', chunk)
+        referenced.update(row[0] for row in cursor.fetchall())
+    conn.close()
+    return [oid for oid in oids if oid not in referenced]
+
+def get_repo_placement(repo_name):
+    """获取仓库所在的存储根目录，没有记录时返回 None"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute('SELECT root FROM repo_placements WHERE repo_name = ?', (repo_name,))
+    row = cursor.fetchone()
+    conn.close()
+    return row[0] if row else None
+
+def get_repo_placements():
+    """获取所有仓库的放置位置 {仓库名: 根目录}"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute('SELECT repo_name, root FROM repo_placements')
+    rows = cursor.fetchall()
+    conn.close()
+    return {row[0]: row[1] for row in rows}
+
+def set_repo_placement(repo_name, root):
+    """记录仓库所在的存储根目录"""
+    conn = sqlite3.connect(DB_FILE)
+    conn.execute('''
+        INSERT INTO repo_placements (repo_name, root) VALUES (?, ?)
+        ON CONFLICT(repo_name) DO UPDATE SET root = excluded.root, updated_at = CURRENT_TIMESTAMP
+    ''', (repo_name, root))
+    conn.commit()
+    conn.close()
+
+def remove_repo_placement(repo_name):
+    """删除仓库的放置记录"""
+    conn = sqlite3.connect(DB_FILE)
+    conn.execute('DELETE FROM repo_placements WHERE repo_name = ?', (repo_name,))
+    conn.commit()
+    conn.close()
+
+def rebase_release_asset_paths(repo_name, old_prefix, new_prefix):
+    """仓库迁移后，把该仓库发布附件路径中的 old_prefix 替换为 new_prefix"""
+    old_prefix = old_prefix.rstrip(os.sep) + os.sep
+    new_prefix = new_prefix.rstrip(os.sep) + os.sep
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE release_assets SET path = ? || substr(path, ?)
+        WHERE release_id IN (SELECT id FROM releases WHERE repo_name = ?) AND substr(path, 1, ?) = ?
+    ''', (new_prefix, len(old_prefix) + 1, repo_name, len(old_prefix), old_prefix))
+    updated = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return updated
+
+JOB_COLUMNS = ('id', 'kind', 'repo_name', 'params', 'dedupe_key', 'status', 'progress', 'message', 'result',
+               'error', 'attempts', 'created_at', 'started_at', 'finished_at')
+
+def _job_from_row(row):
+    return dict(zip(JOB_COLUMNS, row)) if row else None
+
+def add_job(kind, repo_name, params, dedupe_key=None):
+    """加入一个后台任务，返回任务 ID。
+
+    dedupe_key 相同且尚未结束的任务已存在时不重复加入，直接返回已有任务的 ID。
+    """
+    conn = sqlite3.connect(DB_FILE, isolation_level=None)
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        if dedupe_key:
+            cursor.execute('''
+                SELECT id FROM jobs WHERE dedupe_key = ? AND status IN ('queued', 'running') ORDER BY id LIMIT 1
+            ''', (dedupe_key,))
+            row = cursor.fetchone()
+            if row:
+                cursor.execute('COMMIT')
+                return row[0]
+        cursor.execute('INSERT INTO jobs (kind, repo_name, params, dedupe_key) VALUES (?, ?, ?, ?)',
+                       (kind, repo_name, params, dedupe_key))
+        job_id = cursor.lastrowid
+        cursor.execute('COMMIT')
+        return job_id
+    except Exception:
+        cursor.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+def get_job(job_id):
+    """获取单个任务"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute(f'SELECT {", ".join(JOB_COLUMNS)} FROM jobs WHERE id = ?', (job_id,))
+    row = cursor.fetchone()
+    conn.close()
+    return _job_from_row(row)
+
+def get_jobs(repo_name=None, limit=50):
+    """获取最近的任务，可按仓库过滤"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    sql = f'SELECT {", ".join(JOB_COLUMNS)} FROM jobs'
+    args = []
+    if repo_name is not None:
+        sql += ' WHERE repo_name = ?'
+        args.append(repo_name)
+    cursor.execute(sql + ' ORDER BY id DESC LIMIT ?', args + [limit])
+    rows = cursor.fetchall()
+    conn.close()
+    return [_job_from_row(row) for row in rows]
+
+def claim_job(owner, lease_seconds, max_attempts=3):
+    """认领一个排队中或租约已过期的任务并加锁，返回任务信息；没有时返回 None。
+
+    租约过期说明执行它的进程已经退出，任务会被重新执行；已尝试 max_attempts 次的任务标记为失败。
+    """
+    now = time.time()
+    conn = sqlite3.connect(DB_FILE, isolation_level=None)
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('''
+            UPDATE jobs SET status = 'failed', error = '执行任务的进程多次中断', finished_at = CURRENT_TIMESTAMP,
+                locked_by = NULL, locked_until = 0
+            WHERE status = 'running' AND locked_until < ? AND attempts >= ?
+        ''', (now, max_attempts))
+        cursor.execute('''
+            SELECT id FROM jobs
+            WHERE status = 'queued' OR (status = 'running' AND locked_until < ?)
+            ORDER BY id LIMIT 1
+        ''', (now,))
+        row = cursor.fetchone()
+        if not row:
+            cursor.execute('COMMIT')
+            return None
+        cursor.execute('''
+            UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_by = ?, locked_until = ?,
+                started_at = COALESCE(started_at, CURRENT_TIMESTAMP)
+            WHERE id = ?
+        ''', (owner, now + lease_seconds, row[0]))
+        cursor.execute(f'SELECT {", ".join(JOB_COLUMNS)} FROM jobs WHERE id = ?', (row[0],))
+        job = _job_from_row(cursor.fetchone())
+        cursor.execute('COMMIT')
+        return job
+    except Exception:
+        cursor.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+def update_job_progress(job_id, owner, progress, message, lease_seconds):
+    """更新任务进度并续期租约；租约已被其他进程接管时返回 False"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE jobs SET progress = ?, message = ?, locked_until = ?
+        WHERE id = ? AND locked_by = ? AND status = 'running'
+    ''', (progress, message, time.time() + lease_seconds, job_id, owner))
+    updated = cursor.rowcount == 1
+    conn.commit()
+    conn.close()
+    return updated
+
+def finish_job(job_id, owner, result=None, error=None):
+    """结束任务：error 为 None 时标记成功并保存结果（JSON 字符串），否则标记失败"""
+    conn = sqlite3.connect(DB_FILE)
+    conn.execute('''
+        UPDATE jobs SET status = ?, progress = CASE WHEN ? IS NULL THEN 1 ELSE progress END,
+            message = CASE WHEN ? IS NULL THEN '' ELSE message END,
+            result = ?, error = ?, finished_at = CURRENT_TIMESTAMP, locked_by = NULL, locked_until = 0
+        WHERE id = ? AND locked_by = ?
+    ''', ('failed' if error is not None else 'done', error, error, result, error, job_id, owner))
+    conn.commit()
+    conn.close()
+
+def prune_jobs(keep_days=7):
+    """删除早于 keep_days 天且已结束的任务"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute('''
+        DELETE FROM jobs WHERE status IN ('done', 'failed') AND created_at < datetime('now', ?)
+    ''', (f'-{int(keep_days)} days',))
+    deleted = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return deleted
+
+def register_repos(repos):
+    """在一个事务中登记一批新仓库：repos 为 (名称, 存储根目录, 描述) 列表"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.executemany('''
+        INSERT OR IGNORE INTO repositories (name, description, language) VALUES (?, ?, '')
+    ''', [(name, description) for name, root, description in repos])
+    cursor.executemany('''
+        INSERT INTO repo_placements (repo_name, root) VALUES (?, ?)
+        ON CONFLICT(repo_name) DO UPDATE SET root = excluded.root, updated_at = CURRENT_TIMESTAMP
+    ''', [(name, root) for name, root, description in repos])
+    conn.commit()
+    conn.close()
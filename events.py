@@ -0,0 +1,164 @@
+"""推送事件：receive-pack 成功后产生的类型化事件，以及进程内的事件总线。
+
+事件先写入 SQLite 中的持久队列（db.push_events），再唤醒本进程的分发线程。
+每个订阅者在 db.event_subscribers 中有一个游标，按事件 ID 顺序逐条处理，
+处理成功后才前移游标，因此进程重启后会从上次的位置继续（至少投递一次）。
+多进程部署时同一订阅者通过租约保证同一时刻只有一个进程在处理。
+"""
+import json
+import os
+import threading
+import time
+import traceback
+
+import db
+import metrics
+
+
+def is_zero_id(sha):
+    return not sha.strip('0')
+
+
+class RefUpdate:
+    """一次推送中单个引用的变化。"""
+
+    __slots__ = ('ref', 'old', 'new')
+
+    def __init__(self, ref, old, new):
+        self.ref = ref
+        self.old = old
+        self.new = new
+
+    @property
+    def kind(self):
+        """create、delete 或 update。"""
+        if is_zero_id(self.old):
+            return 'create'
+        if is_zero_id(self.new):
+            return 'delete'
+        return 'update'
+
+    @property
+    def is_branch(self):
+        return self.ref.startswith('refs/heads/')
+
+    @property
+    def is_tag(self):
+        return self.ref.startswith('refs/tags/')
+
+    @property
+    def short_name(self):
+        for prefix in ('refs/heads/', 'refs/tags/'):
+            if self.ref.startswith(prefix):
+                return self.ref[len(prefix):]
+        return self.ref
+
+    def to_dict(self):
+        return {'ref': self.ref, 'old': self.old, 'new': self.new}
+
+    def __repr__(self):
+        return f'RefUpdate({self.ref!r}, {self.old[:7]}..{self.new[:7]})'
+
+
+class PushEvent:
+    """一次成功推送，包含所有已更新的引用。id 在写入持久队列后才有值。"""
+
+    def __init__(self, repo, updates, pushed_at=None, remote_addr='', id=None):
+        self.repo = repo
+        self.updates = list(updates)
+        self.pushed_at = pushed_at if pushed_at is not None else time.time()
+        self.remote_addr = remote_addr
+        self.id = id
+
+    def to_dict(self):
+        return {
+            'repo': self.repo,
+            'updates': [u.to_dict() for u in self.updates],
+            'pushed_at': self.pushed_at,
+            'remote_addr': self.remote_addr,
+        }
+
+    @classmethod
+    def from_dict(cls, data, id=None):
+        updates = [RefUpdate(u['ref'], u['old'], u['new']) for u in data.get('updates', [])]
+        return cls(data['repo'], updates, data.get('pushed_at'), data.get('remote_addr', ''), id)
+
+    def __repr__(self):
+        return f'PushEvent(id={self.id}, repo={self.repo!r}, updates={self.updates!r})'
+
+
+class EventBus:
+    """持久化的推送事件总线。
+
+    subscribe() 注册按名称区分的订阅者；publish() 把事件写入队列并唤醒分发线程。
+    回调抛出异常时该订阅者停在这条事件上，下一轮再重试，不会跳过事件。
+    其他进程发布的事件在 poll_interval 秒内被发现。
+    """
+
+    def __init__(self, poll_interval=2.0, batch_size=100, lease_seconds=30):
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.owner = f'{os.getpid()}:{id(self)}'
+        self._subscribers = {}
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, name, callback):
+        """注册订阅者；callback 接收一个 PushEvent。首次注册的订阅者从此刻之后的事件开始处理。"""
+        db.register_event_subscriber(name)
+        with self._lock:
+            self._subscribers[name] = callback
+        self._ensure_started()
+
+    def publish(self, event):
+        """写入持久队列并通知分发线程，返回事件 ID。"""
+        event.id = db.add_push_event(event.repo, json.dumps(event.to_dict(), ensure_ascii=False))
+        metrics.PUSH_EVENTS.inc(repo=event.repo)
+        self._wakeup.set()
+        return event.id
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='event-bus', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            with self._lock:
+                subscribers = list(self._subscribers.items())
+            for name, callback in subscribers:
+                try:
+                    self.drain(name, callback)
+                except Exception:
+                    traceback.print_exc()
+
+    def drain(self, name, callback):
+        """处理订阅者积压的事件，返回处理的条数；租约被其他进程持有时返回 0。"""
+        last_id = db.claim_event_subscriber(name, self.owner, self.lease_seconds)
+        if last_id is None:
+            return 0
+        handled = 0
+        while True:
+            rows = db.get_push_events(last_id, self.batch_size)
+            if not rows:
+                return handled
+            for row in rows:
+                event = PushEvent.from_dict(json.loads(row['payload']), id=row['id'])
+                try:
+                    callback(event)
+                except Exception:
+                    metrics.EVENT_DELIVERIES.inc(subscriber=name, status='error')
+                    traceback.print_exc()
+                    return handled
+                metrics.EVENT_DELIVERIES.inc(subscriber=name, status='ok')
+                if not db.advance_event_subscriber(name, self.owner, row['id']):
+                    return handled
+                last_id = row['id']
+                handled += 1
+            if db.claim_event_subscriber(name, self.owner, self.lease_seconds) is None:
+                return handled
@@ -0,0 +1,466 @@
+import asyncio
+import json
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+
+
+MB = 1024 * 1024
+
+
+OPERATION_PROFILES = {
+    'default': {'timeout': 30, 'max_output': 64 * MB, 'nice': 0, 'ionice': None, 'cpu_seconds': None, 'max_memory': None},
+    'log': {'timeout': 60, 'max_output': 64 * MB, 'nice': 5, 'ionice': (2, 7), 'cpu_seconds': 60, 'max_memory': 1024 * MB},
+    'blame': {'timeout': 120, 'max_output': 64 * MB, 'nice': 5, 'ionice': (2, 7), 'cpu_seconds': 120, 'max_memory': 1024 * MB},
+    'grep': {'timeout': 30, 'max_output': 16 * MB, 'nice': 10, 'ionice': (2, 7), 'cpu_seconds': 30, 'max_memory': 1024 * MB},
+    'archive': {'timeout': 1800, 'max_output': None, 'nice': 10, 'ionice': (2, 7), 'cpu_seconds': None, 'max_memory': 2048 * MB},
+    'advertise': {'timeout': 60, 'max_output': None, 'nice': 0, 'ionice': None, 'cpu_seconds': None, 'max_memory': None},
+    'upload-pack': {'timeout': 3600, 'max_output': None, 'nice': 0, 'ionice': None, 'cpu_seconds': None, 'max_memory': None},
+    'receive-pack': {'timeout': 3600, 'max_output': 16 * MB, 'nice': 0, 'ionice': None, 'cpu_seconds': None, 'max_memory': None},
+    'import': {'timeout': 3600, 'max_output': 16 * MB, 'nice': 10, 'ionice': (2, 7), 'cpu_seconds': None, 'max_memory': None},
+    'backup': {'timeout': 6 * 3600, 'max_output': None, 'nice': 19, 'ionice': (2, 7), 'cpu_seconds': None, 'max_memory': None},
+    'maintenance': {'timeout': 3600, 'max_output': 16 * MB, 'nice': 19, 'ionice': (3, 0), 'cpu_seconds': None, 'max_memory': None},
+}
+for _op, _conf in json.loads(os.environ.get('OLSC_GIT_PROFILES', '{}')).items():
+    OPERATION_PROFILES.setdefault(_op, dict(OPERATION_PROFILES['default'])).update(_conf)
+
+
+STDERR_LIMIT = 1 * MB
+CHUNK_SIZE = 64 * 1024
+IONICE = shutil.which('ionice') if os.name == 'posix' else None
+NICE = shutil.which('nice') if os.name == 'posix' else None
+PRLIMIT = shutil.which('prlimit') if os.name == 'posix' else None
+
+_active = set()
+_active_lock = threading.Lock()
+_observers = []
+
+
+def add_observer(callback):
+    """注册进程结束回调，参数为已结束的 GitProcess（用于指标统计等）。"""
+    _observers.append(callback)
+
+
+def get_profile(op):
+    """返回操作类别对应的资源配置，未知类别使用 default。"""
+    return OPERATION_PROFILES.get(op) or OPERATION_PROFILES['default']
+
+
+def _build_command(args, profile):
+    """按资源配置在命令前加上 prlimit、nice 与 ionice。
+
+    不使用 preexec_fn：它在 fork 之后、exec 之前运行 Python 代码，多线程进程中可能死锁。
+    系统中没有对应命令时跳过该项限制。
+    """
+    command = list(args)
+    ionice = profile.get('ionice')
+    if ionice and IONICE:
+        command = [IONICE, '-c', str(ionice[0])] + (['-n', str(ionice[1])] if ionice[0] == 2 else []) + command
+    nice = profile.get('nice')
+    if nice and NICE:
+        command = [NICE, '-n', str(nice)] + command
+    limits = []
+    if profile.get('cpu_seconds'):
+        limits.append(f'--cpu={profile["cpu_seconds"]}:{profile["cpu_seconds"] + 5}')
+    if profile.get('max_memory'):
+        limits.append(f'--data={profile["max_memory"]}:{profile["max_memory"]}')
+    if limits and PRLIMIT:
+        command = [PRLIMIT] + limits + ['--'] + command
+    return command
+
+
+def _notify(proc):
+    for callback in _observers:
+        try:
+            callback(proc)
+        except Exception:
+            pass
+
+
+class GitProcess:
+    """受资源约束的 git 子进程。
+
+    超过墙钟超时或输出上限时整个进程组会被立即杀死；调用 close()
+    （例如客户端断开后响应生成器被关闭）也会终止仍在运行的进程。
+    """
+
+    def __init__(self, args, cwd=None, op='default', env=None, input=None, timeout=None, max_output=None):
+        profile = get_profile(op)
+        self.op = op
+        self.args = args
+        self.timeout = profile['timeout'] if timeout is None else timeout
+        self.max_output = profile['max_output'] if max_output is None else max_output
+        self.timed_out = False
+        self.truncated = False
+        self.cancelled = False
+        self.bytes_out = 0
+        self.started = time.monotonic()
+        self.duration = None
+        self._stderr = bytearray()
+        self._eof = False
+        self._closed = False
+
+        self.proc = subprocess.Popen(
+            _build_command(args, profile),
+            cwd=cwd,
+            env=env,
+            stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=os.name == 'posix'
+        )
+        with _active_lock:
+            _active.add(self)
+
+        self._threads = [threading.Thread(target=self._read_stderr, daemon=True)]
+        if input is not None:
+            self._threads.append(threading.Thread(target=self._write_stdin, args=(input,), daemon=True))
+        for t in self._threads:
+            t.start()
+
+        self._timer = None
+        if self.timeout:
+            self._timer = threading.Timer(self.timeout, self._on_timeout)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _write_stdin(self, data):
+        try:
+            self.proc.stdin.write(data)
+        except (BrokenPipeError, OSError):
+            pass
+        finally:
+            try:
+                self.proc.stdin.close()
+            except OSError:
+                pass
+
+    def _read_stderr(self):
+        for chunk in iter(lambda: self.proc.stderr.read(8192), b''):
+            if len(self._stderr) < STDERR_LIMIT:
+                self._stderr.extend(chunk[:STDERR_LIMIT - len(self._stderr)])
+
+    def _on_timeout(self):
+        if self.proc.poll() is None:
+            self.timed_out = True
+            self.kill()
+
+    def kill(self):
+        """杀死整个进程组（git 可能派生 pack-objects 等子进程）。"""
+        if self.proc.poll() is not None:
+            return
+        try:
+            if os.name == 'posix':
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            else:
+                self.proc.kill()
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def cancel(self):
+        """取消执行，例如客户端已断开。"""
+        if self.proc.poll() is None:
+            self.cancelled = True
+            self.kill()
+
+    def iter_chunks(self, size=CHUNK_SIZE):
+        """逐块读取标准输出；超过输出上限时截断并终止进程。"""
+        read = getattr(self.proc.stdout, 'read1', self.proc.stdout.read)
+        while True:
+            chunk = read(size)
+            if not chunk:
+                self._eof = True
+                break
+            if self.max_output and self.bytes_out + len(chunk) > self.max_output:
+                chunk = chunk[:self.max_output - self.bytes_out]
+                self.bytes_out += len(chunk)
+                self.truncated = True
+                self.kill()
+                if chunk:
+                    yield chunk
+                break
+            self.bytes_out += len(chunk)
+            yield chunk
+
+    def read_all(self):
+        """读取全部（受上限约束的）标准输出。"""
+        return b''.join(self.iter_chunks())
+
+    def wait(self):
+        returncode = self.proc.wait()
+        for t in self._threads:
+            t.join()
+        return returncode
+
+    @property
+    def returncode(self):
+        return self.proc.poll()
+
+    @property
+    def stderr(self):
+        return bytes(self._stderr)
+
+    @property
+    def killed(self):
+        return self.timed_out or self.truncated or self.cancelled
+
+    def close(self):
+        """结束进程并释放资源，可重复调用。"""
+        if self._closed:
+            return
+        self._closed = True
+        if not self._eof:
+            self.cancel()
+        self.wait()
+        if self._timer:
+            self._timer.cancel()
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+        self.duration = time.monotonic() - self.started
+        with _active_lock:
+            _active.discard(self)
+        _notify(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncGitProcess:
+    """GitProcess 的 asyncio 版本。
+
+    通过事件循环的非阻塞管道读写，不为每个进程占用线程；stdin 的 write()
+    会等待管道排空，从而把背压传递给上游的客户端连接。资源配置、超时、
+    输出上限与结束回调与 GitProcess 相同。
+    """
+
+    def __init__(self, args, cwd=None, op='default', env=None, timeout=None, max_output=None):
+        self.profile = get_profile(op)
+        self.op = op
+        self.args = args
+        self.cwd = cwd
+        self.env = env
+        self.timeout = self.profile['timeout'] if timeout is None else timeout
+        self.max_output = self.profile['max_output'] if max_output is None else max_output
+        self.timed_out = False
+        self.truncated = False
+        self.cancelled = False
+        self.bytes_out = 0
+        self.started = time.monotonic()
+        self.duration = None
+        self.proc = None
+        self._stderr = bytearray()
+        self._eof = False
+        self._closed = False
+        self._timer = None
+        self._stderr_task = None
+
+    async def start(self, stdin=False):
+        self.proc = await asyncio.create_subprocess_exec(
+            *_build_command(self.args, self.profile),
+            cwd=self.cwd,
+            env=self.env,
+            stdin=subprocess.PIPE if stdin else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=os.name == 'posix'
+        )
+        with _active_lock:
+            _active.add(self)
+        self._stderr_task = asyncio.ensure_future(self._read_stderr())
+        if self.timeout:
+            self._timer = asyncio.get_running_loop().call_later(self.timeout, self._on_timeout)
+        return self
+
+    async def _read_stderr(self):
+        while True:
+            chunk = await self.proc.stderr.read(8192)
+            if not chunk:
+                break
+            if len(self._stderr) < STDERR_LIMIT:
+                self._stderr.extend(chunk[:STDERR_LIMIT - len(self._stderr)])
+
+    def _on_timeout(self):
+        if self.proc.returncode is None:
+            self.timed_out = True
+            self.kill()
+
+    def kill(self):
+        """杀死整个进程组。"""
+        if self.proc is None or self.proc.returncode is not None:
+            return
+        try:
+            if os.name == 'posix':
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            else:
+                self.proc.kill()
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def cancel(self):
+        if self.proc is not None and self.proc.returncode is None:
+            self.cancelled = True
+            self.kill()
+
+    async def write(self, data):
+        """写入标准输入并等待管道排空；进程已退出时返回 False。"""
+        try:
+            self.proc.stdin.write(data)
+            await self.proc.stdin.drain()
+            return True
+        except (BrokenPipeError, ConnectionResetError):
+            return False
+
+    def close_stdin(self):
+        if self.proc.stdin and not self.proc.stdin.is_closing():
+            self.proc.stdin.close()
+
+    async def iter_chunks(self, size=CHUNK_SIZE):
+        """逐块读取标准输出；超过输出上限时截断并终止进程。"""
+        while True:
+            chunk = await self.proc.stdout.read(size)
+            if not chunk:
+                self._eof = True
+                break
+            if self.max_output and self.bytes_out + len(chunk) > self.max_output:
+                chunk = chunk[:self.max_output - self.bytes_out]
+                self.bytes_out += len(chunk)
+                self.truncated = True
+                self.kill()
+                if chunk:
+                    yield chunk
+                break
+            self.bytes_out += len(chunk)
+            yield chunk
+
+    async def read_all(self):
+        return b''.join([chunk async for chunk in self.iter_chunks()])
+
+    async def wait(self):
+        returncode = await self.proc.wait()
+        if self._stderr_task:
+            await self._stderr_task
+        return returncode
+
+    @property
+    def returncode(self):
+        return self.proc.returncode if self.proc else None
+
+    @property
+    def stderr(self):
+        return bytes(self._stderr)
+
+    @property
+    def killed(self):
+        return self.timed_out or self.truncated or self.cancelled
+
+    async def close(self):
+        """结束进程并释放资源，可重复调用。"""
+        if self._closed or self.proc is None:
+            return
+        self._closed = True
+        if not self._eof:
+            self.cancel()
+        if self.proc.stdin:
+            self.proc.stdin.close()
+        await self.wait()
+        if self._timer:
+            self._timer.cancel()
+        self.duration = time.monotonic() - self.started
+        with _active_lock:
+            _active.discard(self)
+        _notify(self)
+
+
+def run(args, cwd=None, op='default', env=None, input=None, timeout=None, max_output=None):
+    """运行 git 并读取全部输出，返回包含原始字节和终止原因的结果字典。"""
+    with GitProcess(args, cwd=cwd, op=op, env=env, input=input, timeout=timeout, max_output=max_output) as proc:
+        stdout = proc.read_all()
+        returncode = proc.wait()
+    return {
+        'returncode': returncode,
+        'stdout': stdout,
+        'stderr': proc.stderr,
+        'timed_out': proc.timed_out,
+        'truncated': proc.truncated,
+        'cancelled': proc.cancelled,
+        'duration': proc.duration,
+    }
+
+
+class RecordStream:
+    """按分隔符（换行或 NUL）惰性读取 git 输出的记录。
+
+    迭代时直接从管道读取，不保留完整输出；提前退出迭代（break 或 close()）
+    会立即终止进程。text=True 时记录解码为 str，否则保持 bytes。
+    """
+
+    def __init__(self, args, cwd=None, op='default', env=None, sep=b'\n', text=True,
+                 encoding='utf-8', timeout=None, max_output=None):
+        self.sep = sep.encode() if isinstance(sep, str) else sep
+        self.text = text
+        self.encoding = encoding
+        self.proc = GitProcess(args, cwd=cwd, op=op, env=env, timeout=timeout, max_output=max_output)
+        self.returncode = None
+
+    def _decode(self, record):
+        if self.text:
+            return record.decode(self.encoding, errors='replace')
+        return record
+
+    def __iter__(self):
+        # 只在新读到的块中查找分隔符，未结束的记录按块暂存，超长记录也是线性开销
+        pending = []
+        try:
+            for chunk in self.proc.iter_chunks():
+                if self.sep not in chunk:
+                    pending.append(chunk)
+                    continue
+                first, *records = chunk.split(self.sep)
+                pending.append(first)
+                yield self._decode(b''.join(pending))
+                pending = [records.pop()]
+                for record in records:
+                    yield self._decode(record)
+            tail = b''.join(pending)
+            if tail:
+                yield self._decode(tail)
+        finally:
+            self.close()
+
+    def close(self):
+        """停止读取；进程若仍在运行则被终止。"""
+        self.proc.close()
+        self.returncode = self.proc.returncode
+
+    @property
+    def success(self):
+        return self.returncode == 0
+
+    @property
+    def stderr(self):
+        return self.proc.stderr
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def active_processes():
+    """返回当前仍在运行的 git 进程概况。"""
+    now = time.monotonic()
+    with _active_lock:
+        return [{
+            'pid': p.proc.pid,
+            'op': p.op,
+            'args': p.args[1:4],
+            'elapsed': now - p.started,
+            'bytes_out': p.bytes_out,
+        } for p in _active]
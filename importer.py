@@ -0,0 +1,253 @@
+"""仓库的创建与批量导入，全部在裸仓库中用 git 底层命令完成，不生成工作区。
+
+create_bare_repo 用 git init --bare 加 fast-import 直接写入初始提交；
+import_repos 并行导入已有的裸仓库或 bundle 文件，导入完成后在一个事务中
+登记所有仓库的元数据与存放位置。
+
+命令行用法：
+
+    python importer.py /srv/old-repos /srv/bundles/app.bundle --jobs 8
+"""
+import argparse
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import db
+import gitexec
+import storage
+
+
+REPO_CONFIG = (
+    ('http.receivepack', 'true'),
+    ('receive.denyNonFastForwards', 'false'),
+)
+COMMITTER = (os.environ.get('OLSC_GIT_NAME', 'Olsc GitWeb'), os.environ.get('OLSC_GIT_EMAIL', 'olsc@localhost'))
+DEFAULT_DESCRIPTION = 'Unnamed repository; edit this file'
+
+
+def check(result, what):
+    if result['returncode'] != 0:
+        stderr = result['stderr'].decode('utf-8', errors='replace').strip()
+        raise RuntimeError(f'{what} 失败: {stderr or result["returncode"]}')
+    return result
+
+
+def write_config(git_dir, settings):
+    """把配置项追加到仓库的 config 文件，省去逐项调用 git config。"""
+    sections = {}
+    for key, value in settings:
+        section, name = key.rsplit('.', 1)
+        sections.setdefault(section, []).append((name, value))
+    with open(os.path.join(git_dir, 'config'), 'a', encoding='utf-8') as f:
+        for section, items in sections.items():
+            f.write(f'[{section}]\n')
+            for name, value in items:
+                f.write(f'\t{name} = {value}\n')
+
+
+def read_head_ref(git_dir):
+    """读取 HEAD 指向的分支引用（如 refs/heads/master）。"""
+    with open(os.path.join(git_dir, 'HEAD'), encoding='utf-8') as f:
+        head = f.read().strip()
+    return head[5:].strip() if head.startswith('ref:') else 'refs/heads/master'
+
+
+def fast_import_stream(ref, files, message, committer, when=None):
+    """生成一次提交的 fast-import 输入：files 为 {路径: bytes}。"""
+    when = int(when if when is not None else time.time())
+    out = []
+    for mark, content in enumerate(files.values(), 1):
+        out.append(b'blob\nmark :%d\ndata %d\n' % (mark, len(content)) + content + b'\n')
+    name, email = committer
+    msg = message.encode('utf-8')
+    out.append(f'commit {ref}\ncommitter {name} <{email}> {when} +0000\n'.encode('utf-8'))
+    out.append(b'data %d\n' % len(msg) + msg + b'\n')
+    for mark, path in enumerate(files, 1):
+        out.append(f'M 100644 :{mark} {path}\n'.encode('utf-8'))
+    out.append(b'\ndone\n')
+    return b''.join(out)
+
+
+def create_bare_repo(path, files, message='Initial commit', committer=COMMITTER, op='maintenance'):
+    """创建裸仓库并直接写入一次包含 files 的初始提交，返回分支引用。
+
+    只启动 git init 与 git fast-import 两个子进程；对象以包的形式写入，不经过工作区。
+    """
+    check(gitexec.run(['git', 'init', '-q', '--bare', path], op=op), 'git init')
+    write_config(path, REPO_CONFIG)
+    ref = read_head_ref(path)
+    stream = fast_import_stream(ref, files, message, committer)
+    check(gitexec.run(['git', 'fast-import', '--quiet', '--done'], cwd=path, op=op, input=stream),
+          'git fast-import')
+    return ref
+
+
+def is_bare_repo_dir(path):
+    return (os.path.isfile(os.path.join(path, 'HEAD')) and os.path.isdir(os.path.join(path, 'objects'))
+            and os.path.isdir(os.path.join(path, 'refs')))
+
+
+def source_name(path):
+    name = os.path.basename(os.path.normpath(path))
+    for suffix in ('.git', '.bundle'):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def find_sources(paths):
+    """展开导入来源：裸仓库目录、.bundle 文件，或包含它们的目录（不递归）。"""
+    sources = []
+    for path in paths:
+        path = os.path.abspath(path)
+        if os.path.isfile(path) and path.endswith('.bundle'):
+            sources.append(path)
+        elif os.path.isdir(path) and is_bare_repo_dir(path):
+            sources.append(path)
+        elif os.path.isdir(path):
+            for entry in sorted(os.listdir(path)):
+                child = os.path.join(path, entry)
+                if (os.path.isfile(child) and entry.endswith('.bundle')) or \
+                        (os.path.isdir(child) and is_bare_repo_dir(child)):
+                    sources.append(child)
+    return sources
+
+
+def source_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(os.path.join(path, 'objects')):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def import_one(source, repo_path, op='import'):
+    """把一个裸仓库或 bundle 导入为 repo_path，返回仓库描述。
+
+    同一文件系统上的裸仓库由 git 以硬链接方式复制对象，几乎不占用额外空间；
+    来源中的钩子不会被复制。来源借用了其他仓库的对象（objects/info/alternates 会随
+    本地克隆一起复制）时，把借来的对象打包进新仓库并删除 alternates，导入的仓库不再
+    依赖来源所在的位置。先在同卷的临时目录中完成，再改名到位。
+    """
+    temp_path = f'{repo_path}_temp_init'
+    if os.path.exists(temp_path):
+        shutil.rmtree(temp_path)
+    try:
+        config = [f'--config={key}={value}' for key, value in REPO_CONFIG]
+        check(gitexec.run(['git', 'clone', '--mirror', '--quiet'] + config + ['--', source, temp_path], op=op),
+              'git clone')
+        alternates = os.path.join(temp_path, 'objects', 'info', 'alternates')
+        if os.path.exists(alternates):
+            check(gitexec.run(['git', 'repack', '-a', '-d', '-q'], cwd=temp_path, op=op), 'git repack')
+            os.remove(alternates)
+        check(gitexec.run(['git', 'config', '--remove-section', 'remote.origin'], cwd=temp_path, op=op),
+              'git config')
+        check(gitexec.run(['git', 'update-server-info'], cwd=temp_path, op=op), 'git update-server-info')
+
+        description = ''
+        if os.path.isdir(source):
+            try:
+                with open(os.path.join(source, 'description'), encoding='utf-8') as f:
+                    description = f.read().strip()
+            except (OSError, UnicodeDecodeError):
+                pass
+            if description.startswith(DEFAULT_DESCRIPTION):
+                description = ''
+        os.rename(temp_path, repo_path)
+        return description
+    finally:
+        if os.path.exists(temp_path):
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+
+def import_repos(paths, pool, jobs=4, progress=None):
+    """并行导入多个仓库，最多同时运行 jobs 个。
+
+    已存在的同名仓库跳过；单个仓库失败不影响其他仓库。全部完成后在一个事务中登记元数据。
+    progress(已完成数, 总数, 仓库名) 在每个仓库结束时调用。
+    返回 {'imported': [...], 'skipped': [...], 'failed': [{'name', 'error'}]}。
+    """
+    sources = find_sources(paths)
+    report = {'imported': [], 'skipped': [], 'failed': []}
+    planned = {}
+    for source in sources:
+        name = source_name(source)
+        if not name or name.startswith('.') or name in planned or pool.locate(name):
+            report['skipped'].append(name)
+            continue
+        planned[name] = source
+
+    stats = pool.root_stats()
+    lock = threading.Lock()
+
+    def place(name, source):
+        size = source_size(source)
+        with lock:
+            root = pool.choose_root(size, stats=stats)
+            for stat in stats:
+                if stat['root'] == root:
+                    stat['free'] -= size
+                    stat['repos'] += 1
+        repo_path = os.path.join(root, name)
+        description = import_one(source, repo_path)
+        return root, description
+
+    registered = []
+    done = 0
+    with ThreadPoolExecutor(max_workers=max(1, jobs), thread_name_prefix='olsc-import') as executor:
+        futures = {executor.submit(place, name, source): name for name, source in planned.items()}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                root, description = future.result()
+                registered.append((name, root, description))
+                report['imported'].append(name)
+            except Exception as e:
+                report['failed'].append({'name': name, 'error': str(e)})
+            done += 1
+            if progress is not None:
+                progress(done, len(planned), name)
+
+    db.register_repos(registered)
+    report['imported'].sort()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='批量导入裸仓库或 bundle 文件')
+    parser.add_argument('paths', nargs='+', help='裸仓库目录、.bundle 文件，或包含它们的目录')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 4, help='同时导入的仓库数')
+    parser.add_argument('--dry-run', action='store_true', help='只列出将要导入的仓库')
+    args = parser.parse_args()
+
+    if args.dry_run:
+        for source in find_sources(args.paths):
+            print(f'{source_name(source)}\t{source}')
+        return 0
+
+    # 不导入 web：那会在命令行进程里启动任务队列、Webhook 投递等后台线程
+    db.init_db()
+    started = time.monotonic()
+
+    def progress(done, total, name):
+        print(f'[{done}/{total}] {name}', file=sys.stderr)
+
+    report = import_repos(args.paths, storage.pool_from_environ(), args.jobs, progress)
+    print(f'导入 {len(report["imported"])} 个，跳过 {len(report["skipped"])} 个，'
+          f'失败 {len(report["failed"])} 个，用时 {time.monotonic() - started:.1f} 秒')
+    for failure in report['failed']:
+        print(f'  {failure["name"]}: {failure["error"]}')
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
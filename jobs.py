@@ -0,0 +1,114 @@
+"""后台任务队列：把耗时与仓库大小相关的操作移出 HTTP 请求。
+
+任务写入 SQLite（db.jobs）后由工作线程执行，进度随时写回数据库，
+页面通过轮询或 SSE 读取。工作线程通过租约认领任务，多个进程可以同时运行；
+执行中的进程退出后租约过期，任务由其他工作线程重新执行，因此任务处理函数
+需要可以安全地重复执行。
+"""
+import json
+import os
+import threading
+import time
+import traceback
+
+import db
+
+
+class JobContext:
+    """传给任务处理函数的上下文：任务参数与进度上报。"""
+
+    def __init__(self, queue, job):
+        self.queue = queue
+        self.id = job['id']
+        self.kind = job['kind']
+        self.repo_name = job['repo_name']
+        self.params = json.loads(job['params'])
+        self.attempt = job['attempts']
+        self._last_report = 0.0
+
+    def progress(self, fraction, message='', force=False):
+        """上报进度（0～1）。同一任务每秒最多写一次数据库，force=True 时立即写入。"""
+        now = time.monotonic()
+        if not force and now - self._last_report < 1.0:
+            return
+        self._last_report = now
+        db.update_job_progress(self.id, self.queue.owner, max(0.0, min(fraction, 1.0)), message,
+                               self.queue.lease_seconds)
+
+
+class JobQueue:
+    """持久化的后台任务队列与工作线程池。
+
+    register() 按任务类型注册处理函数 handler(ctx)，返回值（可 JSON 序列化）保存为任务结果，
+    抛出异常时任务标记为失败。
+    """
+
+    PRUNE_INTERVAL = 3600
+
+    def __init__(self, workers=2, poll_interval=1.0, lease_seconds=300, max_attempts=3, keep_days=7):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.keep_days = keep_days
+        self.owner = f'{os.getpid()}:{id(self)}'
+        self._handlers = {}
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._last_prune = 0.0
+        self._lock = threading.Lock()
+
+    def register(self, kind, handler):
+        self._handlers[kind] = handler
+
+    def submit(self, kind, repo_name=None, params=None, dedupe_key=None):
+        """加入任务并唤醒工作线程，返回任务 ID。"""
+        if kind not in self._handlers:
+            raise ValueError(f'未知的任务类型: {kind}')
+        job_id = db.add_job(kind, repo_name, json.dumps(params or {}, ensure_ascii=False), dedupe_key)
+        self._wakeup.set()
+        return job_id
+
+    def start(self):
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            for i in range(len(self._threads), self.workers):
+                thread = threading.Thread(target=self._run, name=f'job-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            try:
+                job = db.claim_job(self.owner, self.lease_seconds, self.max_attempts)
+                if job is None:
+                    self._maybe_prune()
+                    self._wakeup.wait(self.poll_interval)
+                    self._wakeup.clear()
+                    continue
+                self.execute(job)
+            except Exception:
+                traceback.print_exc()
+                time.sleep(self.poll_interval)
+
+    def _maybe_prune(self):
+        with self._lock:
+            if time.monotonic() - self._last_prune < self.PRUNE_INTERVAL:
+                return
+            self._last_prune = time.monotonic()
+        db.prune_jobs(self.keep_days)
+
+    def execute(self, job):
+        """执行一个已认领的任务并记录结果。"""
+        handler = self._handlers.get(job['kind'])
+        if handler is None:
+            db.finish_job(job['id'], self.owner, error=f'未知的任务类型: {job["kind"]}')
+            return
+        ctx = JobContext(self, job)
+        try:
+            result = handler(ctx)
+        except Exception as e:
+            traceback.print_exc()
+            db.finish_job(job['id'], self.owner, error=str(e) or type(e).__name__)
+            return
+        db.finish_job(job['id'], self.owner, result=json.dumps(result, ensure_ascii=False))
@@ -0,0 +1,111 @@
+"""Git LFS 对象存储。
+
+对象按 SHA-256 内容寻址保存在一个目录树中（objects/ab/cd/abcd…），所有仓库共享同一份，
+同一文件推送到多个仓库只存一次；仓库能访问哪些对象记录在 db.lfs_objects 中。
+上传边接收边计算校验和，写入临时文件，大小与 SHA-256 都吻合后才原子地改名到位，
+因此存储中不会出现不完整或内容不符的对象。
+"""
+import hashlib
+import os
+import re
+
+
+POINTER_VERSION = 'https://git-lfs.github.com/spec/v1'
+POINTER_MAX_SIZE = 1024
+OID_RE = re.compile(r'^[0-9a-f]{64}$')
+CHUNK_SIZE = 1024 * 1024
+
+
+class ObjectMismatch(Exception):
+    """上传的内容与声明的大小或 SHA-256 不符。"""
+
+
+def root_from_environ(data_dir):
+    """LFS 存储目录：OLSC_LFS_DIR，默认为主数据目录下的 .lfs/。"""
+    return os.environ.get('OLSC_LFS_DIR') or os.path.join(data_dir, '.lfs')
+
+
+def is_valid_oid(oid):
+    return isinstance(oid, str) and OID_RE.match(oid) is not None
+
+
+def parse_pointer(data):
+    """解析 LFS 指针文件，返回 {'oid', 'size'}；不是指针时返回 None。"""
+    if len(data) > POINTER_MAX_SIZE or not data.startswith(b'version '):
+        return None
+    try:
+        lines = data.decode('ascii').splitlines()
+    except UnicodeDecodeError:
+        return None
+    fields = dict(line.split(' ', 1) for line in lines if ' ' in line)
+    if fields.get('version') != POINTER_VERSION:
+        return None
+    oid = fields.get('oid', '')
+    size = fields.get('size', '')
+    if not oid.startswith('sha256:') or not is_valid_oid(oid[7:]) or not size.isdigit():
+        return None
+    return {'oid': oid[7:], 'size': int(size)}
+
+
+class LfsStore:
+    """磁盘上按内容寻址的 LFS 对象存储。"""
+
+    def __init__(self, root):
+        self.root = root
+        self.tmp_dir = os.path.join(root, 'tmp')
+
+    def path(self, oid):
+        return os.path.join(self.root, 'objects', oid[:2], oid[2:4], oid)
+
+    def size(self, oid):
+        """对象的大小，不存在时返回 None。"""
+        try:
+            return os.stat(self.path(oid)).st_size
+        except OSError:
+            return None
+
+    def exists(self, oid, size=None):
+        actual = self.size(oid)
+        return actual is not None and (size is None or actual == size)
+
+    def put(self, oid, stream, size=None):
+        """从 stream（有 read 方法）流式写入对象并校验，返回写入的字节数。
+
+        对象已存在时仍读完并校验请求体，但不会覆盖已有文件。
+        """
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        tmp_path = os.path.join(self.tmp_dir, f'{oid}.{os.getpid()}.{id(stream)}')
+        digest = hashlib.sha256()
+        written = 0
+        try:
+            with open(tmp_path, 'wb') as f:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+                    written += len(chunk)
+                    if size is not None and written > size:
+                        raise ObjectMismatch(f'对象大小超过声明的 {size} 字节')
+                f.flush()
+                os.fsync(f.fileno())
+            if size is not None and written != size:
+                raise ObjectMismatch(f'对象大小为 {written} 字节，声明为 {size} 字节')
+            if digest.hexdigest() != oid:
+                raise ObjectMismatch(f'SHA-256 校验失败：实际为 {digest.hexdigest()}')
+            path = self.path(oid)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+            return written
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def delete(self, oid):
+        try:
+            os.remove(self.path(oid))
+            return True
+        except FileNotFoundError:
+            return False
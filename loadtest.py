@@ -0,0 +1,390 @@
+"""Smart HTTP 负载测试。
+
+在本地启动服务（或指向已运行的服务），用 N 个并发客户端反复执行
+git clone / fetch / push 以及原始 upload-pack 请求，报告吞吐量、
+首字节时间、错误率和服务进程 RSS 随时间的变化：
+
+    python loadtest.py --clients 16 --duration 60 --mix clone=6,fetch=2,push=1,pack=1
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from bench import add_repo_args, make_synthetic_repo, percentile
+
+
+OPERATIONS = ('clone', 'fetch', 'push', 'pack')
+
+
+def pkt_line(data):
+    if isinstance(data, str):
+        data = data.encode()
+    return b'%04x' % (len(data) + 4) + data
+
+
+def parse_advertisement(data):
+    """解析 v0 引用广告，返回 {ref: sha}。"""
+    refs = {}
+    pos = 0
+    while pos + 4 <= len(data):
+        length = int(data[pos:pos + 4], 16)
+        if length == 0:
+            pos += 4
+            continue
+        line = data[pos + 4:pos + length].rstrip(b'\n')
+        pos += length
+        if line.startswith(b'#'):
+            continue
+        line = line.split(b'\0', 1)[0]
+        sha, _, ref = line.partition(b' ')
+        if len(sha) == 40 and not ref.endswith(b'^{}'):
+            refs[ref.decode()] = sha.decode()
+    return refs
+
+
+def timed_request(url, data=None, headers=None, timeout=300):
+    """发送请求并读完响应，返回 (首字节耗时, 总耗时, 字节数, 响应体)。"""
+    req = urllib.request.Request(url, data=data, headers=headers or {})
+    started = time.perf_counter()
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        first = resp.read(1)
+        ttfb = time.perf_counter() - started
+        body = first + resp.read()
+    return ttfb, time.perf_counter() - started, len(body), body
+
+
+def process_tree_rss(pid):
+    """统计进程及其所有子孙进程的 RSS（KB），仅支持 Linux /proc。"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'r') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    total = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        try:
+            with open(f'/proc/{current}/status', 'r') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+                        break
+        except OSError:
+            continue
+        stack.extend(children.get(current, []))
+    return total
+
+
+class RssSampler(threading.Thread):
+    """后台定时记录服务进程树的 RSS。"""
+
+    def __init__(self, pid, interval):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._halt = threading.Event()
+        self.t0 = time.monotonic()
+
+    def run(self):
+        while not self._halt.is_set():
+            self.samples.append((round(time.monotonic() - self.t0, 2), process_tree_rss(self.pid)))
+            self._halt.wait(self.interval)
+
+    def stop(self):
+        self._halt.set()
+        self.join()
+
+
+class Client:
+    """单个负载客户端，拥有独立的工作目录。"""
+
+    def __init__(self, index, base_url, repo_name, workdir, args, stats):
+        self.index = index
+        self.repo_url = f'{base_url}/{repo_name}.git'
+        self.workdir = os.path.join(workdir, f'client{index}')
+        self.args = args
+        self.stats = stats
+        self.rng = random.Random(args.seed * 1000 + index)
+        self.clone_dir = None
+        self.pushes = 0
+        os.makedirs(self.workdir)
+
+    def git(self, *args, cwd=None):
+        command = ['git', '-c', f'protocol.version={self.args.protocol}', *args]
+        result = subprocess.run(command, cwd=cwd, capture_output=True, timeout=self.args.timeout)
+        if result.returncode != 0:
+            lines = result.stderr.decode('utf-8', 'replace').strip().splitlines()
+            raise RuntimeError(lines[-1] if lines else f'git 退出码 {result.returncode}')
+        return result
+
+    def clone_args(self):
+        extra = []
+        if self.args.filter:
+            extra.append(f'--filter={self.args.filter}')
+        if self.args.shallow:
+            extra.append(f'--depth={self.args.shallow}')
+        return extra
+
+    def ensure_clone(self):
+        if self.clone_dir is None:
+            path = os.path.join(self.workdir, 'work')
+            self.git('clone', '-q', *self.clone_args(), self.repo_url, path)
+            self.clone_dir = path
+        return self.clone_dir
+
+    def op_clone(self):
+        target = os.path.join(self.workdir, 'clone')
+        shutil.rmtree(target, ignore_errors=True)
+        self.git('clone', '-q', '--bare', *self.clone_args(), self.repo_url, target)
+        size = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(target) for f in files)
+        shutil.rmtree(target, ignore_errors=True)
+        return {'bytes': size}
+
+    def op_fetch(self):
+        path = self.ensure_clone()
+        self.git('fetch', '-q', 'origin', cwd=path)
+        return {}
+
+    def op_push(self):
+        path = self.ensure_clone()
+        self.pushes += 1
+        with open(os.path.join(path, f'loadtest-{self.index}.txt'), 'a', encoding='utf-8') as f:
+            f.write(f'push {self.pushes} {time.time()}\n')
+        self.git('add', '-A', cwd=path)
+        self.git('-c', 'user.name=loadtest', '-c', 'user.email=loadtest@example.com',
+                 'commit', '-q', '-m', f'loadtest push {self.pushes}', cwd=path)
+        self.git('push', '-q', 'origin', f'HEAD:refs/heads/loadtest/{self.args.run_id}/client{self.index}', cwd=path)
+        return {}
+
+    def op_pack(self):
+        """不经过 git 客户端，直接请求引用广告和完整 packfile，测量首字节时间。"""
+        ttfb_refs, _, _, body = timed_request(f'{self.repo_url}/info/refs?service=git-upload-pack')
+        refs = parse_advertisement(body)
+        wants = sorted(set(refs.values()))
+        if not wants:
+            raise RuntimeError('引用广告为空')
+        request = [pkt_line(f'want {wants[0]} multi_ack_detailed side-band-64k ofs-delta\n')]
+        request += [pkt_line(f'want {sha}\n') for sha in wants[1:]]
+        request += [b'0000', pkt_line('done\n')]
+        ttfb, _, size, _ = timed_request(
+            f'{self.repo_url}/git-upload-pack', data=b''.join(request),
+            headers={'Content-Type': 'application/x-git-upload-pack-request'}, timeout=self.args.timeout)
+        return {'bytes': size, 'ttfb': ttfb, 'ttfb_refs': ttfb_refs}
+
+    def run(self, deadline, weights):
+        ops = list(weights)
+        weight_values = [weights[op] for op in ops]
+        while time.monotonic() < deadline:
+            op = self.rng.choices(ops, weights=weight_values)[0]
+            started = time.perf_counter()
+            try:
+                extra = getattr(self, f'op_{op}')()
+                error = None
+            except (RuntimeError, OSError, subprocess.TimeoutExpired, urllib.error.URLError) as e:
+                extra = {}
+                error = str(e)[:200]
+            self.stats.record(op, time.perf_counter() - started, error, **extra)
+
+
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.ops = {}
+        self.errors = {}
+
+    def record(self, op, duration, error, bytes=0, ttfb=None, ttfb_refs=None):
+        with self._lock:
+            entry = self.ops.setdefault(op, {'durations': [], 'ttfb': [], 'ttfb_refs': [], 'bytes': 0, 'errors': 0})
+            if error:
+                entry['errors'] += 1
+                self.errors[error] = self.errors.get(error, 0) + 1
+                return
+            entry['durations'].append(duration)
+            entry['bytes'] += bytes
+            if ttfb is not None:
+                entry['ttfb'].append(ttfb)
+            if ttfb_refs is not None:
+                entry['ttfb_refs'].append(ttfb_refs)
+
+    def summary(self, elapsed):
+        result = {}
+        for op, entry in sorted(self.ops.items()):
+            ok = len(entry['durations'])
+            total = ok + entry['errors']
+            ms = [d * 1000 for d in entry['durations']]
+            result[op] = {
+                'ok': ok,
+                'errors': entry['errors'],
+                'error_rate': round(entry['errors'] / total, 4) if total else 0,
+                'ops_per_sec': round(ok / elapsed, 2),
+                'mb_per_sec': round(entry['bytes'] / elapsed / 1024 / 1024, 2),
+                'p50_ms': round(percentile(ms, 50), 1),
+                'p90_ms': round(percentile(ms, 90), 1),
+                'p99_ms': round(percentile(ms, 99), 1),
+            }
+            if entry['ttfb']:
+                ttfb = [t * 1000 for t in entry['ttfb']]
+                refs = [t * 1000 for t in entry['ttfb_refs']]
+                result[op].update({
+                    'ttfb_p50_ms': round(percentile(ttfb, 50), 1),
+                    'ttfb_p90_ms': round(percentile(ttfb, 90), 1),
+                    'refs_ttfb_p50_ms': round(percentile(refs, 50), 1),
+                })
+        return result
+
+
+def parse_mix(text):
+    weights = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f'未知操作: {name}，可选 {", ".join(OPERATIONS)}')
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def start_server(workdir, port, script):
+    """在独立数据目录中启动服务进程并等待其就绪。"""
+    env = dict(os.environ,
+               OLSC_PORT=str(port),
+               OLSC_DATA_DIR=os.path.join(workdir, 'data'),
+               OLSC_DB_FILE=os.path.join(workdir, 'repos.db'),
+               OLSC_KEY_FILE=os.path.join(workdir, 'key.txt'))
+    log = open(os.path.join(workdir, 'server.log'), 'wb')
+    proc = subprocess.Popen([sys.executable, script], cwd=os.path.dirname(os.path.abspath(script)),
+                            env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'服务启动失败，见 {log.name}')
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/login', timeout=1).close()
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError('服务启动超时')
+
+
+def free_port():
+    import socket
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Olsc_GitWeb Smart HTTP 负载测试')
+    add_repo_args(parser)
+    parser.add_argument('--clients', type=int, default=8, help='并发客户端数')
+    parser.add_argument('--duration', type=float, default=30, help='持续时间（秒）')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('clone=6,fetch=2,push=1,pack=1'),
+                        help='操作权重，如 clone=6,fetch=2,push=1,pack=1')
+    parser.add_argument('--protocol', choices=('0', '2'), default='2', help='git 协议版本')
+    parser.add_argument('--filter', help='部分克隆过滤器，如 blob:none')
+    parser.add_argument('--shallow', type=int, help='浅克隆深度')
+    parser.add_argument('--timeout', type=float, default=600, help='单个操作超时（秒）')
+    parser.add_argument('--url', help='使用已运行的服务（如 http://host:8080），此时需预先准备仓库')
+    parser.add_argument('--repo', default='loadtest', help='仓库名')
+    parser.add_argument('--server-script', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web.py'),
+                        help='本地启动的服务脚本')
+    parser.add_argument('--server-pid', type=int, help='--url 模式下用于采样 RSS 的服务进程 PID')
+    parser.add_argument('--rss-interval', type=float, default=1.0, help='RSS 采样间隔（秒）')
+    parser.add_argument('--json', help='把结果写入 JSON 文件')
+    parser.add_argument('--keep', action='store_true', help='保留临时目录')
+    args = parser.parse_args()
+    args.run_id = f'{int(time.time())}-{os.getpid()}'
+
+    workdir = tempfile.mkdtemp(prefix='olsc-load-')
+    server = None
+    try:
+        if args.url:
+            base_url = args.url.rstrip('/')
+            server_pid = args.server_pid
+        else:
+            os.makedirs(os.path.join(workdir, 'data'))
+            info = make_synthetic_repo(os.path.join(workdir, 'data', args.repo), args.files, args.depth,
+                                       args.commits, args.blob_size, args.refs, args.seed, args.binary_size)
+            print(f'生成合成仓库: {info["commits"]} 次提交, {args.files} 个文件', file=sys.stderr)
+            port = free_port()
+            server = start_server(workdir, port, args.server_script)
+            base_url = f'http://127.0.0.1:{port}'
+            server_pid = server.pid
+
+        sampler = None
+        if server_pid and os.path.isdir('/proc'):
+            sampler = RssSampler(server_pid, args.rss_interval)
+            sampler.start()
+
+        stats = Stats()
+        clients = [Client(i, base_url, args.repo, workdir, args, stats) for i in range(args.clients)]
+        started = time.monotonic()
+        deadline = started + args.duration
+        threads = [threading.Thread(target=c.run, args=(deadline, args.mix)) for c in clients]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.monotonic() - started
+        if sampler:
+            sampler.stop()
+
+        report = {
+            'clients': args.clients,
+            'elapsed': round(elapsed, 2),
+            'protocol': args.protocol,
+            'operations': stats.summary(elapsed),
+            'errors': stats.errors,
+            'rss_kb': {
+                'max': max((kb for _, kb in sampler.samples), default=0),
+                'last': sampler.samples[-1][1] if sampler.samples else 0,
+                'timeline': sampler.samples,
+            } if sampler else None,
+        }
+
+        print(f'{"op":<7} {"ok":>6} {"err":>5} {"ops/s":>7} {"MB/s":>7} {"p50":>9} {"p90":>9} {"p99":>9} {"ttfb50":>8}')
+        for op, r in report['operations'].items():
+            ttfb = f'{r["ttfb_p50_ms"]:.0f}ms' if 'ttfb_p50_ms' in r else '-'
+            print(f'{op:<7} {r["ok"]:>6} {r["errors"]:>5} {r["ops_per_sec"]:>7} {r["mb_per_sec"]:>7} '
+                  f'{r["p50_ms"]:>7.0f}ms {r["p90_ms"]:>7.0f}ms {r["p99_ms"]:>7.0f}ms {ttfb:>8}')
+        if report['rss_kb']:
+            print(f'服务进程树 RSS: 峰值 {report["rss_kb"]["max"]} KB, 结束时 {report["rss_kb"]["last"]} KB')
+        for error, count in sorted(stats.errors.items(), key=lambda kv: -kv[1])[:10]:
+            print(f'  错误 x{count}: {error}')
+
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+    finally:
+        if server is not None:
+            server.terminate()
+            try:
+                server.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        if args.keep:
+            print(f'保留工作目录: {workdir}', file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
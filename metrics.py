@@ -0,0 +1,327 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        self._collect = collect
+
+    def _refresh(self):
+        """对由回调提供数值的指标，在导出前读取最新值。"""
+        if self._collect:
+            for labels, value in self._collect():
+                with self._lock:
+                    self._values[self._key(labels)] = value
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+    def snapshot(self):
+        with self._lock:
+            return {k: (list(v) if isinstance(v, list) else v) for k, v in self._values.items()}
+
+    def values(self):
+        """导出用的当前数值（先刷新回调指标）。"""
+        self._refresh()
+        return self.snapshot()
+
+    def merge(self, target, key, value):
+        """把另一个进程的数值累加到 target 中。"""
+        target[key] = target.get(key, 0) + value
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def expose(self, values=None):
+        lines = self.header()
+        for key, value in sorted((self.values() if values is None else values).items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def expose(self, values=None):
+        lines = self.header()
+        for key, value in sorted((self.values() if values is None else values).items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def merge(self, target, key, value):
+        current = target.get(key)
+        target[key] = list(value) if current is None else [a + b for a, b in zip(current, value)]
+
+    def expose(self, values=None):
+        lines = self.header()
+        for key, data in sorted((self.values() if values is None else values).items()):
+            for bound, count in zip(self.buckets, data):
+                labels = _format_labels(self.labelnames, key, ('le', _format_value(bound)))
+                lines.append(f'{self.name}_bucket{labels} {count}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(data[-2])}')
+            lines.append(f'{self.name}_count{labels} {data[-1]}')
+        return lines
+
+
+class Registry:
+    """指标注册表，按 Prometheus 文本格式 (0.0.4) 导出。"""
+
+    def __init__(self):
+        self._metrics = []
+        self.multiprocess_dir = None
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def enable_multiprocess(self, directory, interval=5):
+        """多工作进程模式：各进程定期把自己的数值写入目录，导出时合并所有进程的数据。"""
+        os.makedirs(directory, exist_ok=True)
+        self.multiprocess_dir = directory
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.write_snapshot()
+
+        threading.Thread(target=loop, daemon=True).start()
+        atexit.register(self.write_snapshot)
+
+    def write_snapshot(self):
+        data = {m.name: [[list(k), v] for k, v in m.values().items()] for m in self._metrics}
+        path = os.path.join(self.multiprocess_dir, f'{os.getpid()}.json')
+        tmp = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+
+    def _merged_values(self):
+        """合并所有进程的快照；已退出进程的计数器与直方图保留，仪表值丢弃。"""
+        self.write_snapshot()
+        merged = {m.name: {} for m in self._metrics}
+        for filename in os.listdir(self.multiprocess_dir):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                pid = int(filename[:-5])
+                with open(os.path.join(self.multiprocess_dir, filename), 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            alive = _pid_alive(pid)
+            for metric in self._metrics:
+                if metric.kind == 'gauge' and not alive:
+                    continue
+                for key, value in data.get(metric.name, []):
+                    metric.merge(merged[metric.name], tuple(key), value)
+        return merged
+
+    def expose(self):
+        lines = []
+        merged = self._merged_values() if self.multiprocess_dir else {}
+        for metric in self._metrics:
+            lines.extend(metric.expose(merged[metric.name]) if self.multiprocess_dir else metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.counter(
+    'olsc_http_requests_total', 'HTTP 请求数', ('endpoint', 'method', 'status'))
+HTTP_REQUEST_DURATION = REGISTRY.histogram(
+    'olsc_http_request_duration_seconds', 'HTTP 请求处理耗时（到响应开始发送）', ('endpoint', 'method'))
+HTTP_IN_FLIGHT = REGISTRY.gauge(
+    'olsc_http_requests_in_flight', '正在处理的 HTTP 请求数')
+
+GIT_COMMANDS = REGISTRY.counter(
+    'olsc_git_commands_total', 'git 子进程数（按子命令、操作类别与结束状态）', ('subcommand', 'op', 'status'))
+GIT_COMMAND_DURATION = REGISTRY.histogram(
+    'olsc_git_command_duration_seconds', 'git 子进程运行时长', ('subcommand', 'op'))
+GIT_OUTPUT_BYTES = REGISTRY.counter(
+    'olsc_git_output_bytes_total', 'git 子进程标准输出字节数', ('subcommand',))
+
+GIT_TRANSFER_BYTES = REGISTRY.counter(
+    'olsc_git_transfer_bytes_total', 'Smart HTTP 传输字节数', ('repo', 'service', 'direction'))
+GIT_TRANSFER_OBJECTS = REGISTRY.counter(
+    'olsc_git_transfer_objects_total', 'Smart HTTP 传输的打包对象数', ('repo', 'service'))
+GIT_TRANSFERS = REGISTRY.counter(
+    'olsc_git_transfers_total', 'Smart HTTP 请求数（克隆/拉取/推送）', ('repo', 'service', 'status'))
+
+LFS_TRANSFER_BYTES = REGISTRY.counter(
+    'olsc_lfs_transfer_bytes_total', 'Git LFS 对象传输字节数（下载按对象大小计）', ('repo', 'direction'))
+
+PUSH_EVENTS = REGISTRY.counter(
+    'olsc_push_events_total', '发布的推送事件数', ('repo',))
+EVENT_DELIVERIES = REGISTRY.counter(
+    'olsc_event_deliveries_total', '推送事件投递给订阅者的次数，status 为 ok 或 error', ('subscriber', 'status'))
+WEBHOOK_ATTEMPTS = REGISTRY.counter(
+    'olsc_webhook_attempts_total', 'Webhook 投递尝试次数，status 为 success、retry 或 failed', ('status',))
+
+CACHE_REQUESTS = REGISTRY.counter(
+    'olsc_cache_requests_total', '缓存查询次数，result 为 hit 或 miss', ('cache', 'result'))
+
+
+def git_subcommand(args):
+    """从 git 命令行中提取子命令名（跳过 -c key=value 等全局参数）。"""
+    i = 1
+    while i < len(args):
+        arg = args[i]
+        if arg in ('-c', '-C', '--git-dir', '--work-tree'):
+            i += 2
+            continue
+        if arg.startswith('-'):
+            i += 1
+            continue
+        return arg
+    return 'unknown'
+
+
+def observe_git_process(proc):
+    """gitexec 的进程结束回调：记录子进程次数、耗时、输出量与结束状态。"""
+    subcommand = git_subcommand(proc.args)
+    if proc.timed_out:
+        status = 'timeout'
+    elif proc.truncated:
+        status = 'truncated'
+    elif proc.cancelled:
+        status = 'cancelled'
+    elif proc.returncode == 0:
+        status = 'ok'
+    else:
+        status = 'error'
+    GIT_COMMANDS.inc(subcommand=subcommand, op=proc.op, status=status)
+    GIT_COMMAND_DURATION.observe(proc.duration or 0, subcommand=subcommand, op=proc.op)
+    GIT_OUTPUT_BYTES.inc(proc.bytes_out, subcommand=subcommand)
+
+
+def record_cache(cache, hit):
+    """记录一次缓存查询结果。"""
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+def pack_object_count(data):
+    """在数据中查找 packfile 头并返回其中声明的对象数，找不到返回 None。"""
+    for version in (b'\x00\x00\x00\x02', b'\x00\x00\x00\x03'):
+        pos = data.find(b'PACK' + version)
+        if pos != -1 and len(data) >= pos + 12:
+            return int.from_bytes(data[pos + 8:pos + 12], 'big')
+    return None
+
+
+access_logger = logging.getLogger('olsc.git_access')
+access_logger.propagate = False
+
+
+def configure_access_log(path):
+    """把 git 访问日志（每行一个 JSON）写入指定文件。"""
+    handler = logging.FileHandler(path, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    access_logger.addHandler(handler)
+    access_logger.setLevel(logging.INFO)
+
+
+def log_git_access(**fields):
+    """写一条结构化 git 访问日志。"""
+    if not access_logger.handlers:
+        return
+    fields.setdefault('ts', time.strftime('%Y-%m-%dT%H:%M:%S%z'))
+    access_logger.info(json.dumps(fields, ensure_ascii=False, sort_keys=True))
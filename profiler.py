@@ -0,0 +1,177 @@
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+_current = contextvars.ContextVar('olsc_trace', default=None)
+
+
+class Trace:
+    """一次请求内按类别（git、db、render、markdown 等）记录的耗时片段。"""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans = []
+        self.duration = None
+
+    def add(self, kind, label, started, duration):
+        self.spans.append((kind, label, started - self.started, duration))
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+        return self.duration
+
+    def breakdown(self):
+        """按类别汇总：{kind: {'count': n, 'ms': 总耗时}}。"""
+        totals = {}
+        for kind, _, _, duration in self.spans:
+            entry = totals.setdefault(kind, {'count': 0, 'ms': 0.0})
+            entry['count'] += 1
+            entry['ms'] += duration * 1000
+        for entry in totals.values():
+            entry['ms'] = round(entry['ms'], 2)
+        return totals
+
+    def to_dict(self, top=20):
+        slowest = sorted(self.spans, key=lambda s: s[3], reverse=True)[:top]
+        return {
+            'name': self.name,
+            'ms': round((self.duration or 0) * 1000, 2),
+            'breakdown': self.breakdown(),
+            'slowest': [{'kind': k, 'label': l, 'at_ms': round(at * 1000, 2), 'ms': round(d * 1000, 2)}
+                        for k, l, at, d in slowest],
+        }
+
+    def server_timing(self):
+        """生成 Server-Timing 响应头，浏览器开发者工具可直接展示。"""
+        parts = [f'{kind};dur={entry["ms"]};desc="{entry["count"]}x"' for kind, entry in self.breakdown().items()]
+        parts.append(f'total;dur={round((self.duration or 0) * 1000, 2)}')
+        return ', '.join(parts)
+
+
+def start_trace(name):
+    trace = Trace(name)
+    _current.set(trace)
+    return trace
+
+
+def end_trace():
+    trace = _current.get()
+    _current.set(None)
+    if trace is not None:
+        trace.finish()
+    return trace
+
+
+def current_trace():
+    return _current.get()
+
+
+def record(kind, label, duration, started=None):
+    """向当前请求的跟踪中补记一个已结束的片段（未开启跟踪时忽略）。"""
+    trace = _current.get()
+    if trace is not None:
+        if started is None:
+            started = time.perf_counter() - duration
+        trace.add(kind, label, started, duration)
+
+
+@contextmanager
+def span(kind, label=''):
+    """记录代码块耗时。"""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(kind, label, started, time.perf_counter() - started)
+
+
+def traced(kind, label=None):
+    """函数装饰器版本的 span。"""
+    def decorator(func):
+        name = label or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(kind, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument_module(module, kind, names=None):
+    """把模块中的公开函数替换为带跟踪的版本（例如 db 模块的查询函数）。"""
+    for name in names or [n for n in dir(module) if not n.startswith('_')]:
+        func = getattr(module, name)
+        if callable(func) and getattr(func, '__module__', None) == module.__name__:
+            setattr(module, name, traced(kind, name)(func))
+
+
+class SlowRequestLog:
+    """把超过阈值的请求及其耗时分解写入 JSON Lines 文件。"""
+
+    def __init__(self, path, threshold_ms):
+        self.path = path
+        self.threshold_ms = threshold_ms
+        self._lock = threading.Lock()
+
+    def maybe_write(self, trace, **extra):
+        if trace.duration is None or trace.duration * 1000 < self.threshold_ms:
+            return False
+        entry = trace.to_dict()
+        entry.update(extra)
+        entry['ts'] = time.strftime('%Y-%m-%dT%H:%M:%S%z')
+        line = json.dumps(entry, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+        return True
+
+
+_sampling_lock = threading.Lock()
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+
+def sample_stacks(seconds, interval=0.005, include_idle=False):
+    """对所有线程做低开销的定时栈采样，返回 folded stacks 文本。
+
+    输出每行为 "root;...;leaf 次数"，可直接交给 flamegraph.pl、speedscope
+    等工具生成火焰图。同一时间只允许一个采样任务运行。
+    """
+    if not _sampling_lock.acquire(blocking=False):
+        raise RuntimeError('已有采样任务在运行')
+    try:
+        me = threading.get_ident()
+        counts = {}
+        deadline = time.monotonic() + seconds
+        idle_leaves = ('select', 'poll', 'wait', 'accept', 'sleep', 'acquire', 'read1', 'readinto', '_recv_into')
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                if not include_idle and stack and stack[0].rsplit(':', 1)[-1] in idle_leaves:
+                    continue
+                key = ';'.join(reversed(stack))
+                counts[key] = counts.get(key, 0) + 1
+            time.sleep(interval)
+        return '\n'.join(f'{stack} {n}' for stack, n in sorted(counts.items(), key=lambda kv: -kv[1])) + '\n'
+    finally:
+        _sampling_lock.release()
@@ -0,0 +1,270 @@
+"""生产环境启动脚本：多进程预派生工作进程，支持平滑重载。
+
+安装了 gunicorn 时使用 gunicorn（默认 gthread 工作进程）；否则使用内置的
+基于 werkzeug 的预派生服务器。两种模式下工作进程都在 fork 之后才导入 web，
+因此 SIGHUP 会以新代码启动新一批工作进程，旧进程处理完当前请求后退出：
+
+    python serve.py --workers 16 --threads 8
+    kill -HUP <主进程 PID>
+"""
+import argparse
+import os
+import shutil
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = None
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.environ.get('OLSC_DATA_DIR') or os.path.join(BASE_DIR, 'data')
+RUN_DIR = os.path.join(DATA_DIR, '.run')
+CPU_COUNT = os.cpu_count() or 4
+
+
+def load_app(asgi=False):
+    sys.path.insert(0, BASE_DIR)
+    if asgi:
+        from asgi import app
+    else:
+        from web import app
+    return app
+
+
+if BaseApplication is not None:
+    class GunicornServer(BaseApplication):
+        """以代码方式配置的 gunicorn 应用，不需要额外的配置文件。"""
+
+        def __init__(self, options, asgi=False):
+            self.options = options
+            self.asgi = asgi
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return load_app(self.asgi)
+
+
+class PreforkServer:
+    """内置的预派生服务器：主进程监听端口，工作进程共享同一个套接字。
+
+    工作进程意外退出时自动补齐；SIGHUP 启动新一代工作进程并让旧进程平滑退出；
+    SIGTERM/SIGINT 等待所有请求结束（最长 graceful_timeout 秒）后退出。
+    工作进程无法加载应用时主进程直接退出，避免无限重启。
+    """
+
+    BOOT_ERROR = 3
+
+    def __init__(self, host, port, workers, graceful_timeout, idle_timeout, backlog=2048):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.graceful_timeout = graceful_timeout
+        self.idle_timeout = idle_timeout
+        self.backlog = backlog
+        self.generation = 0
+        self.children = {}
+        self.retiring = {}
+        self.reload_requested = False
+        self.stopping = False
+
+    def run(self):
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(self.backlog)
+
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        print(f'[master {os.getpid()}] 监听 {self.host}:{self.port}，{self.workers} 个工作进程', flush=True)
+
+        while not self.stopping:
+            if self.reload_requested:
+                self.reload_requested = False
+                self._reload()
+            self._reap()
+            while sum(1 for g in self.children.values() if g == self.generation) < self.workers and not self.stopping:
+                self._spawn()
+            self._kill_overdue()
+            time.sleep(0.2)
+
+        self._shutdown()
+
+    def _on_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def _on_stop(self, signum, frame):
+        self.stopping = True
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self._worker_main()
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 1
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        self.children[pid] = self.generation
+
+    def _worker_main(self):
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        class RequestHandler(WSGIRequestHandler):
+            timeout = self.idle_timeout
+
+        try:
+            app = load_app()
+        except Exception:
+            traceback.print_exc()
+            raise SystemExit(self.BOOT_ERROR)
+        server = make_server(self.host, self.port, app, threaded=True, request_handler=RequestHandler,
+                             fd=self.sock.fileno())
+        server.daemon_threads = False
+        server.block_on_close = True
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown, daemon=True).start())
+        print(f'[worker {os.getpid()}] 已启动', flush=True)
+        server.serve_forever()
+        server.server_close()
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            generation = self.children.pop(pid, None)
+            self.retiring.pop(pid, None)
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == self.BOOT_ERROR:
+                print(f'[master] 工作进程 {pid} 无法加载应用，停止服务', flush=True)
+                self.stopping = True
+            elif generation == self.generation and not self.stopping:
+                print(f'[master] 工作进程 {pid} 异常退出 (status={status})，重新启动', flush=True)
+                time.sleep(0.5)
+
+    def _reload(self):
+        old = [pid for pid, g in self.children.items() if g == self.generation]
+        self.generation += 1
+        print(f'[master] 重载：启动第 {self.generation} 代工作进程', flush=True)
+        for _ in range(self.workers):
+            self._spawn()
+        deadline = time.monotonic() + self.graceful_timeout
+        for pid in old:
+            self._signal(pid, signal.SIGTERM)
+            self.retiring[pid] = deadline
+
+    def _kill_overdue(self):
+        now = time.monotonic()
+        for pid, deadline in list(self.retiring.items()):
+            if now >= deadline:
+                self._signal(pid, signal.SIGKILL)
+                del self.retiring[pid]
+
+    def _signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def _shutdown(self):
+        print('[master] 正在停止，等待进行中的请求结束', flush=True)
+        for pid in self.children:
+            self._signal(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout
+        while self.children and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in list(self.children):
+            self._signal(pid, signal.SIGKILL)
+        self.sock.close()
+
+
+def reset_run_dir():
+    """清理上一次运行遗留的多进程指标快照；并发名额的锁文件随进程释放，无需清理。"""
+    shutil.rmtree(os.path.join(RUN_DIR, 'metrics'), ignore_errors=True)
+    os.makedirs(RUN_DIR, exist_ok=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Olsc_GitWeb 生产环境服务')
+    parser.add_argument('--host', default=os.environ.get('OLSC_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('OLSC_PORT', '8080')))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('OLSC_WORKERS', CPU_COUNT)),
+                        help='工作进程数（默认等于 CPU 核数）')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('OLSC_THREADS', '8')),
+                        help='每个工作进程的线程数（gunicorn gthread）')
+    parser.add_argument('--worker-class', default=os.environ.get('OLSC_WORKER_CLASS', 'gthread'),
+                        help='gunicorn 工作进程类型，如 gthread、gevent')
+    parser.add_argument('--timeout', type=int, default=int(os.environ.get('OLSC_WORKER_TIMEOUT', '120')),
+                        help='工作进程无响应超时（秒）；内置服务器中为空闲连接超时')
+    parser.add_argument('--graceful-timeout', type=int, default=int(os.environ.get('OLSC_GRACEFUL_TIMEOUT', '600')),
+                        help='重载/停止时等待进行中请求（如长时间克隆）的最长秒数')
+    parser.add_argument('--keepalive', type=int, default=int(os.environ.get('OLSC_KEEPALIVE', '5')))
+    parser.add_argument('--builtin', action='store_true', help='即使安装了 gunicorn 也使用内置预派生服务器')
+    parser.add_argument('--asgi', action='store_true',
+                        help='使用 asyncio 传输（asgi.py）处理 .git/ 请求，需要 uvicorn')
+    args = parser.parse_args()
+
+    os.environ['OLSC_MULTIPROCESS'] = '1'
+    reset_run_dir()
+
+    if args.asgi:
+        if uvicorn is None:
+            parser.error('--asgi 需要安装 uvicorn（以及用于其他页面的 a2wsgi）')
+        if BaseApplication is not None and not args.builtin:
+            worker_class = args.worker_class if args.worker_class != 'gthread' else 'uvicorn.workers.UvicornWorker'
+            GunicornServer({
+                'bind': f'{args.host}:{args.port}',
+                'workers': args.workers,
+                'worker_class': worker_class,
+                'timeout': args.timeout,
+                'graceful_timeout': args.graceful_timeout,
+                'keepalive': args.keepalive,
+                'preload_app': False,
+            }, asgi=True).run()
+        else:
+            uvicorn.run('asgi:app', host=args.host, port=args.port, workers=args.workers, app_dir=BASE_DIR,
+                        timeout_keep_alive=args.keepalive, timeout_graceful_shutdown=args.graceful_timeout)
+    elif BaseApplication is not None and not args.builtin:
+        GunicornServer({
+            'bind': f'{args.host}:{args.port}',
+            'workers': args.workers,
+            'threads': args.threads,
+            'worker_class': args.worker_class,
+            'timeout': args.timeout,
+            'graceful_timeout': args.graceful_timeout,
+            'keepalive': args.keepalive,
+            'preload_app': False,
+        }).run()
+    else:
+        PreforkServer(args.host, args.port, args.workers, args.graceful_timeout, args.timeout).run()
+
+
+if __name__ == '__main__':
+    main()
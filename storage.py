@@ -0,0 +1,391 @@
+"""多存储卷上的仓库放置与在线迁移。
+
+仓库可以分布在多个存储根目录（通常各自是一块磁盘）上，所在位置记录在
+db.repo_placements 中；没有记录的仓库（旧数据或手工放入的目录）在第一次访问时
+按根目录顺序查找并补记。新仓库放在“每个仓库平均可用空间”最大的根目录上，
+兼顾容量与负载（仓库数近似代表该卷承担的 I/O）。
+
+迁移在服务运行中进行：先在目标卷上复制一份，再取得仓库的排他锁、补齐复制
+期间的变化并切换位置。推送持有同一把锁的共享锁，切换的短暂窗口内新推送会
+收到 503 并由客户端重试。
+"""
+import os
+import shutil
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import db
+
+
+class RepoLocked(Exception):
+    """仓库正在迁移，暂时不能写入。"""
+
+
+def data_dir_from_environ():
+    """主数据目录：OLSC_DATA_DIR，默认为程序目录下的 data/。"""
+    return os.environ.get('OLSC_DATA_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def roots_from_environ(data_dir):
+    """主数据目录加上 OLSC_STORAGE_ROOTS 中列出的其他存储根目录。"""
+    return [data_dir] + [p for p in os.environ.get('OLSC_STORAGE_ROOTS', '').split(os.pathsep) if p]
+
+
+def pool_from_environ():
+    """按与服务相同的环境变量构造 StoragePool，供命令行工具使用（不导入 web，不启动后台线程）。"""
+    data_dir = data_dir_from_environ()
+    return StoragePool(roots_from_environ(data_dir), os.path.join(data_dir, '.run', 'locks'),
+                       float(os.environ.get('OLSC_STORAGE_RESERVE_RATIO', '0.05')))
+
+
+def tree_size(path):
+    """目录中所有文件的总字节数。"""
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def remove_tree(path, report=None):
+    """逐个删除目录中的文件（自底向上），每删除一批调用 report(已删除数, 总数)。"""
+    total = sum(len(filenames) for _, _, filenames in os.walk(path))
+    removed = 0
+    for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+        for filename in filenames:
+            file_path = os.path.join(dirpath, filename)
+            try:
+                os.remove(file_path)
+            except PermissionError:
+                os.chmod(file_path, 0o644)
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+            removed += 1
+            if report is not None and removed % 500 == 0:
+                report(removed, total)
+        for dirname in dirnames:
+            dir_path = os.path.join(dirpath, dirname)
+            if os.path.islink(dir_path):
+                os.remove(dir_path)
+            else:
+                os.rmdir(dir_path)
+    os.rmdir(path)
+    if report is not None:
+        report(removed, total)
+    return removed
+
+
+def sync_tree(src, dst):
+    """把 src 同步到 dst：复制新增或大小、修改时间不同的文件，删除 dst 中多余的文件。
+
+    复制过程中 src 里消失的文件（例如被 repack 删除的旧包）直接跳过，
+    返回复制的文件数。
+    """
+    copied = 0
+    os.makedirs(dst, exist_ok=True)
+    for dirpath, dirnames, filenames in os.walk(src):
+        rel = os.path.relpath(dirpath, src)
+        target_dir = dst if rel == '.' else os.path.join(dst, rel)
+        os.makedirs(target_dir, exist_ok=True)
+        for filename in filenames:
+            source = os.path.join(dirpath, filename)
+            target = os.path.join(target_dir, filename)
+            try:
+                st = os.lstat(source)
+                try:
+                    dt = os.lstat(target)
+                    if dt.st_size == st.st_size and dt.st_mtime_ns == st.st_mtime_ns:
+                        continue
+                except FileNotFoundError:
+                    pass
+                shutil.copy2(source, target, follow_symlinks=False)
+                copied += 1
+            except FileNotFoundError:
+                continue
+
+        existing = set(dirnames) | set(filenames)
+        for name in os.listdir(target_dir):
+            if name in existing:
+                continue
+            path = os.path.join(target_dir, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+    return copied
+
+
+def refs_snapshot(repo_path):
+    """仓库中所有引用文件与 packed-refs 的内容，用于确认两份副本的引用一致。"""
+    git_dir = os.path.join(repo_path, '.git')
+    if not os.path.isdir(git_dir):
+        git_dir = repo_path
+    snapshot = {}
+    for name in ('HEAD', 'packed-refs'):
+        path = os.path.join(git_dir, name)
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                snapshot[name] = f.read()
+    for dirpath, dirnames, filenames in os.walk(os.path.join(git_dir, 'refs')):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            with open(path, 'rb') as f:
+                snapshot[os.path.relpath(path, git_dir)] = f.read()
+    return snapshot
+
+
+class StoragePool:
+    """一组存储根目录。第一个根目录是主数据目录（同时存放 .run、.cache 等运行数据）。
+
+    reserve_ratio：可用空间低于该比例的卷不再放置新仓库，也不作为迁移目标。
+    lock_dir：仓库写入锁所在目录；不支持 fcntl 的平台上不加锁。
+    """
+
+    MOVE_SUFFIX = '.moving'
+
+    def __init__(self, roots, lock_dir, reserve_ratio=0.05):
+        self.roots = []
+        for root in roots:
+            root = os.path.abspath(root)
+            if root not in self.roots:
+                self.roots.append(root)
+        self.lock_dir = lock_dir
+        self.reserve_ratio = reserve_ratio
+        self._paths = {}
+        self._lock = threading.Lock()
+        self._move_lock = threading.Lock()
+        self.moves = []
+        for root in self.roots:
+            os.makedirs(root, exist_ok=True)
+        os.makedirs(lock_dir, exist_ok=True)
+
+    @staticmethod
+    def is_repo_dir_name(name):
+        return not name.startswith('.') and not name.endswith('_temp_init')
+
+    def locate(self, name):
+        """返回仓库所在路径，不存在时返回 None。"""
+        with self._lock:
+            path = self._paths.get(name)
+        if path and os.path.isdir(path):
+            return path
+
+        root = db.get_repo_placement(name)
+        if root in self.roots:
+            path = os.path.join(root, name)
+            if os.path.isdir(path):
+                with self._lock:
+                    self._paths[name] = path
+                return path
+
+        for root in self.roots:
+            path = os.path.join(root, name)
+            if os.path.isdir(path):
+                db.set_repo_placement(name, root)
+                with self._lock:
+                    self._paths[name] = path
+                return path
+        return None
+
+    def iter_repos(self):
+        """按名称顺序产出所有卷上的 (仓库名, 路径)。"""
+        names = set()
+        for root in self.roots:
+            try:
+                entries = os.listdir(root)
+            except OSError:
+                continue
+            names.update(d for d in entries if self.is_repo_dir_name(d) and os.path.isdir(os.path.join(root, d)))
+        for name in sorted(names):
+            path = self.locate(name)
+            if path:
+                yield name, path
+
+    def root_stats(self):
+        """各卷的容量、可用空间与仓库数。"""
+        counts = {}
+        for root in db.get_repo_placements().values():
+            counts[root] = counts.get(root, 0) + 1
+        stats = []
+        for root in self.roots:
+            usage = shutil.disk_usage(root)
+            stats.append({
+                'root': root,
+                'device': os.stat(root).st_dev,
+                'total': usage.total,
+                'free': usage.free,
+                'free_ratio': usage.free / usage.total if usage.total else 0,
+                'repos': counts.get(root, 0),
+            })
+        return stats
+
+    def choose_root(self, size=0, exclude=(), stats=None):
+        """为新仓库（或迁入的仓库）选择卷：在可用空间足够的卷中取每个仓库平均可用空间最大的。
+
+        批量放置时可传入 root_stats() 的结果并由调用方逐个扣减，避免每次重新统计。
+        """
+        candidates = []
+        for stat in stats if stats is not None else self.root_stats():
+            if stat['root'] in exclude:
+                continue
+            if stat['free'] - size < stat['total'] * self.reserve_ratio:
+                continue
+            candidates.append(((stat['free'] - size) / (stat['repos'] + 1), stat['root']))
+        if not candidates:
+            raise OSError('没有可用空间足够的存储卷')
+        return max(candidates)[1]
+
+    def new_repo_path(self, name):
+        """新仓库应创建的路径（尚未记录放置位置，创建成功后调用 record）。"""
+        return os.path.join(self.choose_root(), name)
+
+    def record(self, name, path):
+        root = os.path.dirname(os.path.abspath(path))
+        db.set_repo_placement(name, root)
+        with self._lock:
+            self._paths[name] = os.path.join(root, name)
+
+    def forget(self, name):
+        db.remove_repo_placement(name)
+        with self._lock:
+            self._paths.pop(name, None)
+
+    def _lock_file(self, name):
+        return os.path.join(self.lock_dir, f'{name}.lock')
+
+    def lock_for_write(self, name):
+        """推送前取得仓库的共享锁，返回锁句柄；仓库正在迁移切换时抛出 RepoLocked。"""
+        if fcntl is None:
+            return None
+        fd = os.open(self._lock_file(name), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise RepoLocked(name)
+        return fd
+
+    def unlock(self, fd):
+        if fd is not None:
+            os.close(fd)
+
+    @contextmanager
+    def exclusive(self, name):
+        """等待进行中的推送结束并阻止新的推送。"""
+        if fcntl is None:
+            yield
+            return
+        fd = os.open(self._lock_file(name), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def move(self, name, target_root, on_switch=None, grace=30):
+        """把仓库在线迁移到 target_root，返回新路径。
+
+        on_switch(old_path, new_path) 在持有排他锁、新副本已就位时调用，
+        用于更新数据库或其他仓库中引用旧路径的地方。旧副本改名为隐藏目录，
+        grace 秒后删除，给仍在读取旧路径的克隆留出时间。
+        """
+        target_root = os.path.abspath(target_root)
+        if target_root not in self.roots:
+            raise ValueError(f'未配置的存储卷: {target_root}')
+
+        with self._move_lock:
+            old_path = self.locate(name)
+            if old_path is None:
+                raise FileNotFoundError(name)
+            old_root = os.path.dirname(old_path)
+            if old_root == target_root:
+                return old_path
+            new_path = os.path.join(target_root, name)
+            if os.path.exists(new_path):
+                raise FileExistsError(new_path)
+
+            record = {'repo': name, 'from': old_root, 'to': target_root,
+                      'started': time.time(), 'status': 'copying'}
+            self.moves.append(record)
+            del self.moves[:-50]
+            staging = os.path.join(target_root, f'.{name}{self.MOVE_SUFFIX}')
+            try:
+                sync_tree(old_path, staging)
+                record['status'] = 'switching'
+                with self.exclusive(name):
+                    for _ in range(3):
+                        sync_tree(old_path, staging)
+                        if refs_snapshot(old_path) == refs_snapshot(staging):
+                            break
+                    else:
+                        raise RuntimeError('迁移期间引用仍在变化')
+                    os.rename(staging, new_path)
+                    if on_switch is not None:
+                        on_switch(old_path, new_path)
+                    trash = os.path.join(old_root, f'.{name}.moved-{int(time.time())}')
+                    os.rename(old_path, trash)
+                    self.record(name, new_path)
+            except Exception as e:
+                record.update(status='failed', error=str(e), finished=time.time())
+                shutil.rmtree(staging, ignore_errors=True)
+                raise
+
+        record.update(status='done', finished=time.time())
+        timer = threading.Timer(grace, shutil.rmtree, (trash,), {'ignore_errors': True})
+        timer.daemon = True
+        timer.start()
+        return new_path
+
+    def plan_rebalance(self, threshold=0.1, max_moves=10):
+        """生成迁移计划：反复把可用比例最低的卷上的一个仓库移到可用比例最高的卷，
+        直到两者相差不超过 threshold。同一块设备上的根目录之间不迁移。
+        """
+        stats = {s['root']: s for s in self.root_stats()}
+        sizes = {}
+        for name, root in db.get_repo_placements().items():
+            if root in stats and os.path.isdir(os.path.join(root, name)):
+                sizes[name] = (root, tree_size(os.path.join(root, name)))
+
+        plan = []
+        while len(plan) < max_moves:
+            ordered = sorted(stats.values(), key=lambda s: s['free'] / s['total'] if s['total'] else 0)
+            src, dst = ordered[0], ordered[-1]
+            if src['device'] == dst['device']:
+                break
+            src_ratio = src['free'] / src['total']
+            dst_ratio = dst['free'] / dst['total']
+            if dst_ratio - src_ratio <= threshold:
+                break
+            budget = (dst_ratio - src_ratio) / 2 * min(src['total'], dst['total'])
+            movable = [(size, name) for name, (root, size) in sizes.items()
+                       if root == src['root'] and 0 < size <= budget
+                       and dst['free'] - size >= dst['total'] * self.reserve_ratio]
+            if not movable:
+                break
+            size, name = max(movable)
+            plan.append({'repo': name, 'from': src['root'], 'to': dst['root'], 'size': size})
+            sizes[name] = (dst['root'], size)
+            src['free'] += size
+            src['repos'] -= 1
+            dst['free'] -= size
+            dst['repos'] += 1
+        return plan
+
+    def rebalance(self, plan, on_switch=None):
+        """依次执行迁移计划，单个仓库失败不影响其余仓库。"""
+        for step in plan:
+            try:
+                self.move(step['repo'], step['to'], on_switch=on_switch)
+            except Exception:
+                traceback.print_exc()
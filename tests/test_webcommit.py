@@ -0,0 +1,68 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import webcommit
+
+
+def git(repo_path, *args, input=None):
+    env = dict(os.environ, GIT_AUTHOR_NAME='t', GIT_AUTHOR_EMAIL='t@t', GIT_COMMITTER_NAME='t',
+               GIT_COMMITTER_EMAIL='t@t')
+    return subprocess.run(['git', *args], cwd=repo_path, env=env, input=input, capture_output=True,
+                          check=True).stdout.decode('utf-8')
+
+
+class CommitChangesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.repo = os.path.join(self.tmp.name, 'repo.git')
+        work = os.path.join(self.tmp.name, 'work')
+        subprocess.run(['git', 'init', '-q', '--bare', '-b', 'master', self.repo], check=True)
+        subprocess.run(['git', 'init', '-q', '-b', 'master', work], check=True)
+        with open(os.path.join(work, 'README.md'), 'w') as f:
+            f.write('hello\n')
+        os.mkdir(os.path.join(work, 'src'))
+        with open(os.path.join(work, 'src', 'main.py'), 'w') as f:
+            f.write('print(1)\n')
+        os.symlink('README.md', os.path.join(work, 'link'))
+        git(work, 'add', '-A')
+        git(work, 'commit', '-qm', 'init')
+        git(work, 'push', '-q', self.repo, 'master')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def ls_tree(self, path):
+        return git(self.repo, 'ls-tree', 'master', '--', path).split()
+
+    def test_edit_keeps_symlink_mode(self):
+        webcommit.commit_changes(self.repo, 'master', {'link': b'src/main.py'}, 'retarget link')
+        mode, kind, sha, _ = self.ls_tree('link')
+        self.assertEqual(mode, '120000')
+        self.assertEqual(git(self.repo, 'cat-file', 'blob', sha), 'src/main.py')
+
+    def test_edit_regular_file(self):
+        webcommit.commit_changes(self.repo, 'master', {'README.md': b'changed\n'}, 'edit')
+        self.assertEqual(self.ls_tree('README.md')[0], '100644')
+        self.assertEqual(git(self.repo, 'show', 'master:README.md'), 'changed\n')
+
+    def test_rejects_type_changes(self):
+        with self.assertRaises(ValueError):
+            webcommit.commit_changes(self.repo, 'master', {'src': b'oops'}, 'file over dir')
+        with self.assertRaises(ValueError):
+            webcommit.commit_changes(self.repo, 'master', {'README.md/x': b'oops'}, 'dir over file')
+
+    def test_unknown_branch(self):
+        with self.assertRaises(webcommit.BranchNotFound):
+            webcommit.commit_changes(self.repo, 'mastr', {'a': b'1'}, 'typo')
+        result = webcommit.commit_changes(self.repo, 'new', {'a': b'1'}, 'create', expected=webcommit.ZERO_ID)
+        self.assertIsNone(result['parent'])
+
+
+if __name__ == '__main__':
+    unittest.main()
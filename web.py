@@ -1,14 +1,23 @@
 import os
-import stat
-import subprocess
+import re
 import json
+import base64
 import shutil
+import threading
 import mimetypes
 import hashlib
-from flask import Flask, request, jsonify, render_template, redirect, url_for, abort, send_file, flash, get_flashed_messages, Response, session
+import gzip
+from flask import Flask, request, jsonify, render_template, redirect, url_for, abort, send_file, flash, get_flashed_messages, Response, session, g
+from flask import before_render_template, template_rendered, stream_template, stream_with_context
 from functools import wraps
 from werkzeug.utils import secure_filename
 import datetime
+import time
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import quote
 
 
 try:
@@ -17,7 +26,20 @@ except ImportError:
     markdown = None
 
 
+import backup
 import db
+import events
+import gitexec
+import importer
+import jobs
+import lfs
+import metrics
+import profiler
+import storage
+import webcommit
+from admission import AdmissionController, AdmissionRejected, ProcessSlots
+from cache import SharedCache
+from webhooks import WebhookDispatcher
 
 app = Flask(__name__)
 app.secret_key = 'git-manager-secret-key-very-secure-random-string-2026'
@@ -29,17 +51,187 @@ app.config['MAX_CONTENT_LENGTH'] = None
 
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DATA_DIR = os.path.join(BASE_DIR, 'data')
-KEY_FILE = os.path.join(BASE_DIR, 'key.txt')
-PORT = 8080
+DATA_DIR = storage.data_dir_from_environ()
+KEY_FILE = os.environ.get('OLSC_KEY_FILE') or os.path.join(BASE_DIR, 'key.txt')
+PORT = int(os.environ.get('OLSC_PORT', '8080'))
+
+
+app.config['USE_X_SENDFILE'] = os.environ.get('OLSC_X_SENDFILE', '0') == '1'
+
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+NO_CACHE_HEADERS = {
+    'Cache-Control': 'no-cache, max-age=0, must-revalidate',
+    'Expires': 'Fri, 01 Jan 1980 00:00:00 GMT',
+    'Pragma': 'no-cache',
+}
+# Dumb HTTP 客户端会请求的 objects/info 下的文件
+DUMB_OBJECTS_INFO_FILES = ('info/packs', 'info/http-alternates')
+
+
+PARTIAL_CLONE_ENABLED = os.environ.get('OLSC_PARTIAL_CLONE', '1') != '0'
+SERVER_GITCONFIG = os.path.join(DATA_DIR, '.gitconfig')
+
+
+CLONE_CONFIG_OPTIONS = [
+    ('uploadpack.allowFilter', '部分克隆', '允许 --filter=blob:none / tree:0 等过滤克隆'),
+    ('uploadpack.allowAnySHA1InWant', '按需拉取对象', '允许客户端按任意 SHA1 请求对象，部分克隆的仓库需要它来补齐缺失的 blob'),
+]
+
+
+CPU_COUNT = os.cpu_count() or 4
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('OLSC_ADMISSION_QUEUE_TIMEOUT', '10'))
+ADMISSION_LIMITS = {
+    'upload-pack': {'global_limit': CPU_COUNT * 2, 'per_repo_limit': CPU_COUNT},
+    'receive-pack': {'global_limit': CPU_COUNT, 'per_repo_limit': 2},
+    'archive': {'global_limit': max(2, CPU_COUNT // 2), 'per_repo_limit': 1},
+    'grep': {'global_limit': CPU_COUNT, 'per_repo_limit': 2},
+    'log': {'global_limit': CPU_COUNT, 'per_repo_limit': 2},
+    'blame': {'global_limit': CPU_COUNT, 'per_repo_limit': 2},
+}
+for _op_class, _conf in json.loads(os.environ.get('OLSC_ADMISSION_LIMITS', '{}')).items():
+    ADMISSION_LIMITS.setdefault(_op_class, {}).update(_conf)
+
+
+QUERY_THREADS = int(os.environ.get('OLSC_QUERY_THREADS', str(CPU_COUNT * 2)))
+TREE_PAGE_SIZE = int(os.environ.get('OLSC_TREE_PAGE_SIZE', '200'))
+LAST_COMMITS_BATCH = 100
+BLAME_MAX_LINES = int(os.environ.get('OLSC_BLAME_MAX_LINES', '20000'))
+BLAME_REUSE_MAX_CHANGES = int(os.environ.get('OLSC_BLAME_REUSE_MAX_CHANGES', '200'))
+HISTORY_PAGE_SIZE = 50
+
+WEBHOOK_WORKERS = int(os.environ.get('OLSC_WEBHOOK_WORKERS', '4'))
+WEBHOOK_COALESCE_SECONDS = float(os.environ.get('OLSC_WEBHOOK_COALESCE_SECONDS', '2'))
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get('OLSC_WEBHOOK_MAX_ATTEMPTS', '8'))
+WEBHOOK_TIMEOUT = float(os.environ.get('OLSC_WEBHOOK_TIMEOUT', '10'))
+JOB_WORKERS = int(os.environ.get('OLSC_JOB_WORKERS', '2'))
+# 每个 SSE 连接占用一个工作线程，超时后断开，浏览器自动重连
+JOB_EVENTS_TIMEOUT = 60
+ARCHIVE_CACHE_SECONDS = int(os.environ.get('OLSC_ARCHIVE_CACHE_SECONDS', '86400'))
+IMPORT_JOBS = int(os.environ.get('OLSC_IMPORT_JOBS', '4'))
+BACKUP_DIR = os.environ.get('OLSC_BACKUP_DIR', '')
+BACKUP_TIME = os.environ.get('OLSC_BACKUP_TIME', '02:00')
+BACKUP_JOBS = int(os.environ.get('OLSC_BACKUP_JOBS', '4'))
+BACKUP_RATE = float(os.environ.get('OLSC_BACKUP_RATE', '0'))
+BACKUP_MAX_CHAIN = int(os.environ.get('OLSC_BACKUP_MAX_CHAIN', '30'))
+query_pool = ThreadPoolExecutor(max_workers=QUERY_THREADS, thread_name_prefix='olsc-query')
+
+MULTIPROCESS = os.environ.get('OLSC_MULTIPROCESS', '0') == '1'
+STORAGE_ROOTS = storage.roots_from_environ(DATA_DIR)
+STORAGE_RESERVE_RATIO = float(os.environ.get('OLSC_STORAGE_RESERVE_RATIO', '0.05'))
+STORAGE_REBALANCE_THRESHOLD = float(os.environ.get('OLSC_STORAGE_REBALANCE_THRESHOLD', '0.1'))
+RUN_DIR = os.path.join(DATA_DIR, '.run')
+CACHE_FILE = os.environ.get('OLSC_CACHE_FILE') or os.path.join(DATA_DIR, '.cache', 'cache.db')
+ARCHIVE_DIR = os.path.join(DATA_DIR, '.cache', 'archives')
+TRASH_DIR_NAME = '.trash'
+LFS_DIR = lfs.root_from_environ(DATA_DIR)
+LFS_MEDIA_TYPE = 'application/vnd.git-lfs+json'
+
+admission_control = AdmissionController(
+    ADMISSION_LIMITS,
+    default_queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+    slots=ProcessSlots(os.path.join(RUN_DIR, 'admission')) if MULTIPROCESS else None
+)
+
+
+METRICS_TOKEN = os.environ.get('OLSC_METRICS_TOKEN', '')
+GIT_ACCESS_LOG = os.environ.get('OLSC_GIT_ACCESS_LOG', os.path.join(DATA_DIR, '.logs', 'git_access.log'))
+SLOW_REQUEST_LOG = os.environ.get('OLSC_SLOW_REQUEST_LOG', os.path.join(DATA_DIR, '.logs', 'slow_requests.log'))
+
+
+profiling = {
+    'enabled': os.environ.get('OLSC_PROFILE', '0') == '1',
+}
+slow_request_log = profiler.SlowRequestLog(SLOW_REQUEST_LOG, float(os.environ.get('OLSC_SLOW_REQUEST_MS', '500')))
 
 
 if not os.path.exists(DATA_DIR):
     os.makedirs(DATA_DIR)
 
+for _log_path in (GIT_ACCESS_LOG, SLOW_REQUEST_LOG):
+    if _log_path:
+        os.makedirs(os.path.dirname(_log_path), exist_ok=True)
+
+if GIT_ACCESS_LOG:
+    metrics.configure_access_log(GIT_ACCESS_LOG)
+
+if MULTIPROCESS:
+    metrics.REGISTRY.enable_multiprocess(os.path.join(RUN_DIR, 'metrics'))
+
+shared_cache = SharedCache(CACHE_FILE)
+storage_pool = storage.StoragePool(STORAGE_ROOTS, os.path.join(RUN_DIR, 'locks'), STORAGE_RESERVE_RATIO)
+lfs_store = lfs.LfsStore(LFS_DIR)
+
+gitexec.add_observer(metrics.observe_git_process)
+gitexec.add_observer(lambda proc: profiler.record('git', metrics.git_subcommand(proc.args), proc.duration or 0))
+profiler.instrument_module(db, 'db')
+
+def _count_active_git_processes():
+    """按操作类别统计仍在运行的 git 子进程。"""
+    counts = {op: 0 for op in gitexec.OPERATION_PROFILES}
+    for proc in gitexec.active_processes():
+        counts[proc['op']] = counts.get(proc['op'], 0) + 1
+    return [({'op': op}, n) for op, n in counts.items()]
+
+
+metrics.REGISTRY.gauge(
+    'olsc_admission_running', '各操作类别正在执行的数量', ('op_class',),
+    collect=lambda: [({'op_class': k}, v['running']) for k, v in admission_control.stats().items()])
+metrics.REGISTRY.gauge(
+    'olsc_admission_queued', '各操作类别排队等待的数量', ('op_class',),
+    collect=lambda: [({'op_class': k}, v['queued']) for k, v in admission_control.stats().items()])
+metrics.REGISTRY.counter(
+    'olsc_admission_rejected_total', '因并发已满被拒绝 (503) 的次数', ('op_class',),
+    collect=lambda: [({'op_class': k}, v['rejected_total']) for k, v in admission_control.stats().items()])
+metrics.REGISTRY.gauge(
+    'olsc_git_processes_active', '正在运行的 git 子进程数', ('op',),
+    collect=_count_active_git_processes)
+
 
 db.init_db()
 
+# 推送事件：after_receive_pack 发布，订阅者在后台线程中按顺序处理
+event_bus = events.EventBus()
+event_bus.subscribe('repo-activity', lambda event: db.touch_repo(event.repo))
+
+webhook_dispatcher = WebhookDispatcher(
+    workers=WEBHOOK_WORKERS,
+    coalesce_seconds=WEBHOOK_COALESCE_SECONDS,
+    max_attempts=WEBHOOK_MAX_ATTEMPTS,
+    timeout=WEBHOOK_TIMEOUT
+)
+event_bus.subscribe('webhooks', webhook_dispatcher.handle_push)
+webhook_dispatcher.start()
+
+# 后台任务：处理函数在定义处注册，全部注册后再启动工作线程
+job_queue = jobs.JobQueue(workers=JOB_WORKERS)
+
+def write_server_gitconfig():
+    """生成服务端全局 git 配置，作为所有仓库克隆相关选项的默认值。
+
+    仓库自身的 config 优先级更高，因此单个仓库可以在设置页中覆盖这些默认值。
+    """
+    sections = {
+        'include': {'path': '~/.gitconfig'},
+        'core': {'commitGraph': 'true'},
+        'gc': {'writeCommitGraph': 'true'},
+        'repack': {'writeBitmaps': 'true'},
+        'pack': {'useBitmaps': 'true'},
+    }
+    if PARTIAL_CLONE_ENABLED:
+        sections['uploadpack'] = {key.split('.', 1)[1]: 'true' for key, _, _ in CLONE_CONFIG_OPTIONS}
+
+    lines = []
+    for section, values in sections.items():
+        lines.append(f'[{section}]')
+        lines.extend(f'\t{key} = {value}' for key, value in values.items())
+    tmp_path = f'{SERVER_GITCONFIG}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, SERVER_GITCONFIG)
+
+write_server_gitconfig()
+
 def get_password_hash():
     """从 key.txt 读取密码哈希"""
     if os.path.exists(KEY_FILE):
@@ -72,163 +264,617 @@ def get_repo_path(repo_name):
     
 
     real_name = repo_name[:-4] if repo_name.endswith('.git') else repo_name
+    if not real_name or real_name.startswith('.'):
+        return None
 
-    
-    path = os.path.join(DATA_DIR, real_name)
+    return storage_pool.locate(real_name)
 
-    
-    if os.path.exists(path) and os.path.isdir(path):
-        return path
-    return None
+def lock_repo_for_push(repo_name):
+    """推送前取得仓库的写入锁；仓库正在迁移切换时按并发已满处理，返回 503 让客户端稍后重试。"""
+    try:
+        return storage_pool.lock_for_write(repo_name)
+    except storage.RepoLocked:
+        raise AdmissionRejected('receive-pack', repo_name, retry_after=5, reason='moving')
+
+@contextmanager
+def repo_write_lock(repo_name):
+    """在仓库写入锁内修改引用或配置，产出取得锁之后的仓库路径（仓库已不存在时为 None）。
 
-def run_git_command(repo_path, command_args):
-    """在指定的仓库中运行 git 命令。"""
+    等锁期间仓库可能已被迁移到其他卷，锁外解析的路径不能再用。
+    """
+    lock = lock_repo_for_push(repo_name)
     try:
+        yield get_repo_path(repo_name)
+    finally:
+        storage_pool.unlock(lock)
 
-        env = os.environ.copy()
-        env['GIT_TERMINAL_PROMPT'] = '0'
+def get_git_dir(repo_path):
+    """返回仓库的 git 目录：裸仓库即其本身，非裸仓库为其中的 .git。"""
+    git_dir = os.path.join(repo_path, '.git')
+    if os.path.isdir(git_dir):
+        return git_dir
+    return repo_path
+
+def update_server_info(repo_path):
+    """重新生成 info/refs 与 objects/info/packs，供 Dumb HTTP 客户端使用。"""
+    return run_git_command(repo_path, ['update-server-info'])
+
+def run_git_command(repo_path, command_args, op='default', timeout=None, max_output=None, env=None):
+    """在指定的仓库中运行 git 命令。
+
+    执行受 op 对应资源配置（超时、输出上限、nice/ionice、rlimit）约束，
+    超限时进程被杀死，结果中的 timed_out / truncated 标记原因。
+    """
+    try:
+
+        if env is None:
+            env = os.environ.copy()
+            env['GIT_TERMINAL_PROMPT'] = '0'
         
-        result = subprocess.run(
+        result = gitexec.run(
             ['git', '-c', 'core.quotepath=false'] + command_args,
             cwd=repo_path,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+            op=op,
             env=env,
-            check=False
+            timeout=timeout,
+            max_output=max_output
         )
         
 
-        stdout = result.stdout.decode('utf-8', errors='replace')
-        stderr = result.stderr.decode('utf-8', errors='replace')
+        stdout = result['stdout'].decode('utf-8', errors='replace')
+        stderr = result['stderr'].decode('utf-8', errors='replace')
+        if result['timed_out']:
+            stderr = stderr or f'git {command_args[0]} 超时'
         
         return {
-            'success': result.returncode == 0,
+            'success': result['returncode'] == 0,
             'stdout': stdout,
-            'stderr': stderr
+            'stderr': stderr,
+            'timed_out': result['timed_out'],
+            'truncated': result['truncated']
         }
     except Exception as e:
         return { 'success': False, 'error': str(e) }
 
+def iter_git_records(repo_path, command_args, sep='\n', text=True, op='default', env=None):
+    """流式读取 git 输出的记录（按换行或 NUL 分隔），返回可迭代的 RecordStream。
+
+    记录在读取时逐条产出，不保留完整输出；提前结束迭代会终止 git 进程。
+    迭代结束后可通过 success / stderr 查看执行结果。
+    """
+    if env is None:
+        env = os.environ.copy()
+        env['GIT_TERMINAL_PROMPT'] = '0'
+    return gitexec.RecordStream(
+        ['git', '-c', 'core.quotepath=false'] + command_args,
+        cwd=repo_path,
+        op=op,
+        env=env,
+        sep=sep,
+        text=text
+    )
+
+class GitOutputStream:
+    """流式响应体：逐块产出 git 进程的输出，close() 结束进程并释放并发名额。
+
+    响应在读取第一块之前就被关闭时，生成器的 finally 不会执行，因此创建响应后还要用
+    Response.call_on_close(stream.close) 注册清理。close() 可重复调用，
+    on_close 中的回调只在第一次关闭时执行。status 为 ok（输出已读完）、error（读取出错）
+    或 cancelled（未读完就被关闭）。
+    """
+
+    def __init__(self, proc, chunks, first, release=None):
+        self.proc = proc
+        self.chunks = chunks
+        self.first = first
+        self.release = release
+        self.on_close = []
+        self.closed = False
+        self.status = 'cancelled'
+
+    def __iter__(self):
+        try:
+            if self.first:
+                yield self.first
+            for chunk in self.chunks:
+                yield chunk
+            self.status = 'ok'
+        except GeneratorExit:
+            raise
+        except Exception:
+            self.status = 'error'
+            raise
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.proc.close()
+        finally:
+            if self.release:
+                self.release()
+            for callback in self.on_close:
+                callback()
+
+def start_streaming_git(args, cwd=None, op='default', env=None, input=None, release=None):
+    """启动 git 进程并等待首块输出。
+
+    返回 (GitOutputStream, None)；若进程在输出任何数据前失败，返回 (None, stderr)。
+    """
+    proc = gitexec.GitProcess(args, cwd=cwd, op=op, env=env, input=input)
+    chunks = proc.iter_chunks()
+    first = next(chunks, b'')
+    if not first and proc.wait() != 0:
+        proc.close()
+        if release:
+            release()
+        return None, proc.stderr or b'git failed'
+    return GitOutputStream(proc, chunks, first, release), None
+
+def parse_git_protocol(header):
+    """清理 Git-Protocol 请求头，仅保留合法的 key=value 参数。"""
+    params = [p for p in (header or '').split(':') if p and all(c.isalnum() or c in '=._-' for c in p)]
+    return ':'.join(params)
+
+def get_git_protocol():
+    """读取客户端 Git-Protocol 请求头。"""
+    return parse_git_protocol(request.headers.get('Git-Protocol', ''))
+
+def is_protocol_v2(git_protocol):
+    """判断客户端是否请求协议 v2。"""
+    return 'version=2' in git_protocol.split(':')
+
+def read_request_body():
+    """读取请求体，处理 git 客户端发送的 gzip 压缩数据。"""
+    data = request.get_data(cache=False)
+    if request.headers.get('Content-Encoding', '').lower() in ('gzip', 'x-gzip'):
+        data = gzip.decompress(data)
+    return data
+
+def iter_pkt_lines(data):
+    """解析 pkt-line 数据，依次产出每行内容；flush/delim 等特殊包产出 None。"""
+    pos = 0
+    while pos + 4 <= len(data):
+        try:
+            length = int(data[pos:pos + 4], 16)
+        except ValueError:
+            return
+        if length < 4:
+            yield None
+            pos += 4
+            continue
+        yield data[pos + 4:pos + length]
+        pos += length
+
+def get_v2_command(data):
+    """返回协议 v2 请求中的命令名（如 ls-refs、fetch），非 v2 请求返回 None。"""
+    for line in iter_pkt_lines(data):
+        if line is None:
+            break
+        if line.startswith(b'command='):
+            return line[8:].strip().decode('ascii', errors='replace')
+        break
+    return None
+
+def format_advertisement(service_name, git_protocol, refs_data):
+    """组装 info/refs 响应：v0 需要在引用列表前加 "# service=" 包，v2 upload-pack 不需要。"""
+    if service_name == 'git-upload-pack' and is_protocol_v2(git_protocol):
+        return refs_data
+    header = f'# service={service_name}\n'
+    return f'{len(header) + 4:04x}{header}0000'.encode() + refs_data
+
+def parse_receive_commands(data):
+    """解析 receive-pack 请求开头的引用更新命令。
+
+    返回 ([(旧 SHA, 新 SHA, 引用名)], 客户端声明的能力集合)；命令列表不完整时返回 (None, 能力)。
+    """
+    commands = []
+    capabilities = set()
+    for line in iter_pkt_lines(data):
+        if line is None:
+            return commands, capabilities
+        line, _, caps = line.rstrip(b'\n').partition(b'\0')
+        if caps:
+            capabilities.update(caps.decode('ascii', errors='replace').split())
+        parts = line.decode('utf-8', errors='replace').split(' ', 2)
+        if len(parts) == 3 and not parts[0].startswith('shallow'):
+            commands.append(tuple(parts))
+    return None, capabilities
+
+def parse_report_status(output, sideband):
+    """解析 receive-pack 的 report-status，返回 {引用名: 是否成功}；没有报告时返回 None。"""
+    if sideband:
+        report = b''.join(line[1:] for line in iter_pkt_lines(output) if line and line[:1] == b'\x01')
+    else:
+        report = output
+    results = None
+    for line in iter_pkt_lines(report):
+        if line is None:
+            break
+        text = line.rstrip(b'\n').decode('utf-8', errors='replace')
+        if text.startswith('unpack '):
+            results = {}
+        elif results is not None and text.startswith('ok '):
+            results[text[3:]] = True
+        elif results is not None and text.startswith('ng '):
+            results[text[3:].split(' ', 1)[0]] = False
+    return results
+
+def read_ref_values(repo_path, refs):
+    """返回 {引用名: 当前 SHA}，不存在的引用不出现在结果中。"""
+    res = run_git_command(repo_path, ['for-each-ref', '--format=%(objectname) %(refname)'] + list(refs))
+    values = {}
+    for line in res['stdout'].splitlines() if res['success'] else []:
+        sha, _, ref = line.partition(' ')
+        values[ref] = sha
+    return values
+
+def push_event_from_request(repo_path, request_head, output, remote_addr=''):
+    """根据推送请求的命令列表与 receive-pack 的结果构造 PushEvent，没有引用更新时返回 None。
+
+    客户端请求了 report-status 时以报告为准；否则对比引用的当前值确认哪些命令已生效。
+    """
+    commands, capabilities = parse_receive_commands(request_head)
+    if not commands:
+        return None
+    report = None
+    if capabilities & {'report-status', 'report-status-v2'}:
+        report = parse_report_status(output, bool(capabilities & {'side-band', 'side-band-64k'}))
+    if report is not None:
+        applied = [c for c in commands if report.get(c[2])]
+    else:
+        current = read_ref_values(repo_path, [c[2] for c in commands])
+        applied = [c for c in commands
+                   if current.get(c[2]) == c[1] or (events.is_zero_id(c[1]) and c[2] not in current)]
+    if not applied:
+        return None
+    return events.PushEvent(os.path.basename(repo_path),
+                            [events.RefUpdate(ref, old, new) for old, new, ref in applied],
+                            remote_addr=remote_addr)
+
+def after_receive_pack(repo_path, request_head=b'', output=b'', remote_addr=''):
+    """推送成功后的处理（WSGI 与 ASGI 传输共用）：更新 dumb HTTP 信息并发布推送事件。"""
+    update_server_info(repo_path)
+    event = push_event_from_request(repo_path, request_head, output, remote_addr)
+    if event is not None:
+        event_bus.publish(event)
+
+def git_service_env(git_protocol=''):
+    """构造 upload-pack / receive-pack 的运行环境。"""
+    env = os.environ.copy()
+    env['GIT_TERMINAL_PROMPT'] = '0'
+    env.pop('GIT_PROTOCOL', None)
+    env['GIT_CONFIG_GLOBAL'] = SERVER_GITCONFIG
+    if git_protocol:
+        env['GIT_PROTOCOL'] = git_protocol
+    return env
+
 def git_http_backend(repo_path, service):
-    """直接使用 Git 命令实现 Smart HTTP 协议，避免 git http-backend 的路径问题。"""
+    """直接使用 Git 命令实现 Smart HTTP 协议，避免 git http-backend 的路径问题。
+
+    upload-pack 支持协议 v2：Git-Protocol 请求头会作为 GIT_PROTOCOL 传给 git，
+    ls-refs（含 ref-prefix 过滤）和 fetch 命令由 upload-pack 原生处理，
+    客户端只会收到它请求的引用。
+    """
 
     
     if not repo_path:
         return Response("未找到仓库", status=404)
     
 
-    git_dir = os.path.join(repo_path, '.git')
-    if not os.path.exists(git_dir):
-        git_dir = repo_path
-    
-
-    
+    git_dir = get_git_dir(repo_path)
+    git_protocol = get_git_protocol()
+    env = git_service_env(git_protocol)
+    transfer = {
+        'started': time.monotonic(),
+        'repo': os.path.basename(repo_path),
+        'service': service.lstrip('/'),
+        'protocol': git_protocol or 'version=0',
+        'remote_addr': request.remote_addr,
+        'user_agent': request.headers.get('User-Agent', ''),
+    }
 
     if service == '/info/refs':
         service_name = request.args.get('service', '')
 
-        
-        if service_name == 'git-upload-pack':
-
+        if service_name in ('git-upload-pack', 'git-receive-pack'):
             try:
-                result = subprocess.run(
-                    ['git', 'upload-pack', '--stateless-rpc', '--advertise-refs', git_dir],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    check=False
+                result = gitexec.run(
+                    ['git', service_name[4:], '--stateless-rpc', '--advertise-refs', git_dir],
+                    op='advertise',
+                    env=env
                 )
                 
-                if result.returncode != 0:
+                if result['returncode'] != 0:
 
-                    return Response(result.stderr, status=500, mimetype='text/plain')
+                    return Response(result['stderr'], status=500, mimetype='text/plain')
                 
 
-                response_data = f'001e# service=git-upload-pack\n0000'.encode() + result.stdout
+                response_data = format_advertisement(service_name, git_protocol, result['stdout'])
+                transfer['service'] = f'{service_name}-advertisement'
+                record_git_transfer(transfer, 'ok', 0, len(response_data))
                 return Response(
                     response_data,
                     status=200,
-                    mimetype='application/x-git-upload-pack-advertisement'
+                    mimetype=f'application/x-{service_name}-advertisement',
+                    headers=NO_CACHE_HEADERS
                 )
             except Exception as e:
 
                 return Response(str(e), status=500, mimetype='text/plain')
-                
-        elif service_name == 'git-receive-pack':
 
-            try:
-                result = subprocess.run(
-                    ['git', 'receive-pack', '--stateless-rpc', '--advertise-refs', git_dir],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    check=False
-                )
-                
-                if result.returncode != 0:
+        elif not service_name:
+            return send_git_file(git_dir, 'info/refs', 'text/plain', regenerate=True)
+    
+    elif service in ('/git-upload-pack', '/git-receive-pack'):
+        service_name = service[1:]
+        body = read_request_body()
 
-                    return Response(result.stderr, status=500, mimetype='text/plain')
-                
 
-                response_data = f'001f# service=git-receive-pack\n0000'.encode() + result.stdout
-                return Response(
-                    response_data,
-                    status=200,
-                    mimetype='application/x-git-receive-pack-advertisement'
-                )
-            except Exception as e:
+        op_class = service_name[4:]
+        command = get_v2_command(body) if is_protocol_v2(git_protocol) else None
+        if command:
+            transfer['command'] = command
+        if command == 'ls-refs':
+            op_class = None
+        slot = admission_control.acquire(op_class, repo_path) if op_class else None
+        release = lambda: admission_control.release(slot)
+        args = ['git', service_name[4:], '--stateless-rpc', git_dir]
 
+        if service_name == 'git-upload-pack':
+            try:
+                stream, error = start_streaming_git(args, op='upload-pack', env=env, input=body, release=release)
+            except Exception as e:
+                release()
                 return Response(str(e), status=500, mimetype='text/plain')
-    
-    elif service == '/git-upload-pack':
-
-        try:
-            result = subprocess.run(
-                ['git', 'upload-pack', '--stateless-rpc', git_dir],
-                input=request.data,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                check=False
-            )
-            
-            if result.returncode != 0:
-
-                return Response(result.stderr, status=500, mimetype='text/plain')
-            
-            return Response(
-                result.stdout,
+            if error is not None:
+                record_git_transfer(transfer, 'error', len(body))
+                return Response(error, status=500, mimetype='text/plain')
+            response = Response(
+                instrument_git_stream(stream, transfer, len(body)),
                 status=200,
-                mimetype='application/x-git-upload-pack-result'
+                mimetype='application/x-git-upload-pack-result',
+                headers=NO_CACHE_HEADERS,
+                direct_passthrough=True
             )
-        except Exception as e:
-
-            return Response(str(e), status=500, mimetype='text/plain')
-    
-    elif service == '/git-receive-pack':
+            response.call_on_close(stream.close)
+            return response
 
         try:
-            result = subprocess.run(
-                ['git', 'receive-pack', '--stateless-rpc', git_dir],
-                input=request.data,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                check=False
-            )
+            result = gitexec.run(args, op='receive-pack', env=env, input=body)
+            objects = metrics.pack_object_count(body)
             
-            if result.returncode != 0:
+            if result['returncode'] != 0:
 
-                return Response(result.stderr, status=500, mimetype='text/plain')
+                record_git_transfer(transfer, 'error', len(body), 0, objects)
+                return Response(result['stderr'], status=500, mimetype='text/plain')
+
+            after_receive_pack(repo_path, body, result['stdout'], request.remote_addr or '')
+            record_git_transfer(transfer, 'ok', len(body), len(result['stdout']), objects)
             
             return Response(
-                result.stdout,
+                result['stdout'],
                 status=200,
-                mimetype='application/x-git-receive-pack-result'
+                mimetype='application/x-git-receive-pack-result',
+                headers=NO_CACHE_HEADERS
             )
         except Exception as e:
 
             return Response(str(e), status=500, mimetype='text/plain')
+        finally:
+            release()
     
 
     return Response("Unknown service", status=404)
 
+def record_git_transfer(info, status, bytes_in=0, bytes_out=0, objects=None):
+    """记录一次 Smart HTTP 传输的指标与结构化访问日志。"""
+    duration = time.monotonic() - info['started']
+    repo, service = info['repo'], info['service']
+    metrics.GIT_TRANSFERS.inc(repo=repo, service=service, status=status)
+    metrics.GIT_TRANSFER_BYTES.inc(bytes_in, repo=repo, service=service, direction='in')
+    metrics.GIT_TRANSFER_BYTES.inc(bytes_out, repo=repo, service=service, direction='out')
+    if objects:
+        metrics.GIT_TRANSFER_OBJECTS.inc(objects, repo=repo, service=service)
+    metrics.log_git_access(
+        status=status,
+        bytes_in=bytes_in,
+        bytes_out=bytes_out,
+        objects=objects,
+        duration=round(duration, 4),
+        **{k: v for k, v in info.items() if k != 'started'}
+    )
+
+def instrument_git_stream(stream, info, bytes_in):
+    """包装 GitOutputStream：统计发送字节数、识别 packfile 对象数，流关闭时记录传输指标。
+
+    指标在 stream.close() 中记录，响应在开始发送前就被关闭时也不会遗漏（记为 cancelled）。
+    """
+    state = {'sent': 0, 'head': b'', 'objects': None}
+    stream.on_close.append(lambda: record_git_transfer(info, stream.status, bytes_in, state['sent'],
+                                                       state['objects']))
+    try:
+        for chunk in stream:
+            state['sent'] += len(chunk)
+            if state['objects'] is None and len(state['head']) < 65536:
+                state['head'] += chunk
+                state['objects'] = metrics.pack_object_count(state['head'])
+            yield chunk
+    finally:
+        stream.close()
+
+@app.errorhandler(AdmissionRejected)
+def handle_admission_rejected(e):
+    """并发已满时返回 503，并告知客户端何时重试。"""
+    return Response(str(e), status=503, mimetype='text/plain',
+                    headers={'Retry-After': str(e.retry_after)})
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.monotonic()
+    metrics.HTTP_IN_FLIGHT.inc()
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or 'not_found'
+    started = g.get('request_started')
+    if started is not None:
+        metrics.HTTP_REQUEST_DURATION.observe(time.monotonic() - started, endpoint=endpoint, method=request.method)
+    metrics.HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    return response
+
+@app.teardown_request
+def finish_request_timer(exc):
+    if g.pop('request_started', None) is not None:
+        metrics.HTTP_IN_FLIGHT.dec()
+
+@app.before_request
+def start_profiling_trace():
+    if profiling['enabled']:
+        profiler.start_trace(request.endpoint or request.path)
+
+@app.after_request
+def finish_profiling_trace(response):
+    trace = profiler.end_trace()
+    if trace is not None:
+        response.headers['Server-Timing'] = trace.server_timing()
+        if SLOW_REQUEST_LOG:
+            slow_request_log.maybe_write(trace, method=request.method, path=request.full_path.rstrip('?'),
+                                         status=response.status_code)
+    return response
+
+@before_render_template.connect_via(app)
+def _start_render_span(sender, template, context, **extra):
+    g.setdefault('render_started', []).append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def _finish_render_span(sender, template, context, **extra):
+    starts = g.get('render_started')
+    if starts:
+        started = starts.pop()
+        profiler.record('render', template.name, time.perf_counter() - started, started)
+
+@app.route('/admin/profiling', methods=['GET', 'POST'])
+@require_auth
+def admin_profiling():
+    """查看或在运行时开关请求耗时分解与慢请求日志，无需重启服务。"""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or request.form
+        if 'enabled' in data:
+            profiling['enabled'] = str(data['enabled']).lower() in ('1', 'true', 'on')
+        if 'threshold_ms' in data:
+            slow_request_log.threshold_ms = float(data['threshold_ms'])
+    return jsonify({
+        'enabled': profiling['enabled'],
+        'threshold_ms': slow_request_log.threshold_ms,
+        'slow_request_log': SLOW_REQUEST_LOG,
+    })
+
+@app.route('/admin/slow-requests')
+@require_auth
+def admin_slow_requests():
+    """返回最近的慢请求记录。"""
+    limit = request.args.get('limit', 50, type=int)
+    entries = []
+    if SLOW_REQUEST_LOG and os.path.exists(SLOW_REQUEST_LOG):
+        with open(SLOW_REQUEST_LOG, 'r', encoding='utf-8') as f:
+            lines = deque(f, maxlen=limit)
+        entries = [json.loads(line) for line in reversed(lines) if line.strip()]
+    return jsonify(entries)
+
+@app.route('/admin/profile')
+@require_auth
+def admin_sample_profile():
+    """对运行中的服务做 N 秒栈采样，返回 flamegraph 兼容的 folded stacks。"""
+    seconds = min(max(request.args.get('seconds', 10, type=float), 0.1), 120)
+    interval = max(request.args.get('interval_ms', 5, type=float), 1) / 1000
+    include_idle = request.args.get('idle') == '1'
+    try:
+        folded = profiler.sample_stacks(seconds, interval, include_idle)
+    except RuntimeError as e:
+        return Response(str(e), status=409, mimetype='text/plain')
+    return Response(folded, mimetype='text/plain')
+
+@app.route('/admin/storage', methods=['GET', 'POST'])
+@require_auth
+def admin_storage():
+    """查看各存储卷的容量与仓库分布，或在后台迁移仓库。
+
+    POST {"action": "move", "repo": 名称, "root": 目标卷} 迁移单个仓库；
+    POST {"action": "rebalance"} 按可用空间比例生成并执行迁移计划，dry_run 为真时只返回计划。
+    """
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or request.form
+        action = data.get('action')
+        if action == 'move':
+            repo_name = data.get('repo', '')
+            root = os.path.abspath(data.get('root', ''))
+            if not get_repo_path(repo_name):
+                return jsonify({'error': '未找到仓库'}), 404
+            if root not in storage_pool.roots:
+                return jsonify({'error': '未配置的存储卷'}), 400
+            plan = [{'repo': repo_name, 'to': root}]
+        elif action == 'rebalance':
+            plan = storage_pool.plan_rebalance(STORAGE_REBALANCE_THRESHOLD)
+            if str(data.get('dry_run', '')).lower() in ('1', 'true', 'on'):
+                return jsonify({'plan': plan})
+        else:
+            return jsonify({'error': '未知操作'}), 400
+        threading.Thread(target=storage_pool.rebalance, args=(plan, relocate_repo),
+                         name='storage-rebalance', daemon=True).start()
+        return jsonify({'plan': plan}), 202
+
+    return jsonify({
+        'roots': storage_pool.root_stats(),
+        'placements': db.get_repo_placements(),
+        'moves': storage_pool.moves,
+    })
+
+@app.route('/admin/import', methods=['POST'])
+@require_auth
+def admin_import():
+    """在后台批量导入服务器上的裸仓库或 bundle 文件。
+
+    POST {"paths": [目录或文件, ...], "jobs": 并发数}，路径可以是裸仓库、.bundle 文件，
+    或直接包含它们的目录；返回任务 ID，进度见 /jobs/<id>。
+    """
+    data = request.get_json(silent=True) or {}
+    paths = data.get('paths')
+    if isinstance(paths, str):
+        paths = [paths]
+    if not paths or not all(isinstance(p, str) and os.path.isabs(p) for p in paths):
+        return jsonify({'error': 'paths 必须是绝对路径列表'}), 400
+    missing = [p for p in paths if not os.path.exists(p)]
+    if missing:
+        return jsonify({'error': '路径不存在', 'paths': missing}), 400
+    try:
+        concurrency = max(1, int(data.get('jobs') or IMPORT_JOBS))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'jobs 必须是整数'}), 400
+    job_id = job_queue.submit('import', params={'paths': paths, 'jobs': concurrency})
+    return jsonify({'job': job_id, 'url': url_for('view_job', job_id=job_id)}), 202
+
+@app.route('/admin/backup', methods=['GET', 'POST'])
+@require_auth
+def admin_backup():
+    """GET 查看最近一次备份的清单；POST 立即在后台开始一次备份。"""
+    if not BACKUP_DIR:
+        return jsonify({'error': '未配置 OLSC_BACKUP_DIR'}), 404
+    if request.method == 'POST':
+        job_id = job_queue.submit('backup', dedupe_key='backup')
+        return jsonify({'job': job_id, 'url': url_for('view_job', job_id=job_id)}), 202
+    return jsonify({'latest': backup.latest_manifest(BACKUP_DIR), 'schedule': BACKUP_TIME})
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """以 Prometheus 文本格式导出运行指标。"""
+    if METRICS_TOKEN and request.headers.get('Authorization', '') != f'Bearer {METRICS_TOKEN}':
+        abort(401)
+    return Response(metrics.REGISTRY.expose(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 @app.template_filter('basename')
 def basename_filter(s):
     return os.path.basename(s)
@@ -237,12 +883,17 @@ def basename_filter(s):
 def dirname_filter(s):
     return os.path.dirname(s)
 
+def render_markdown(text):
+    """渲染 Markdown，未安装 markdown 库时原样返回。"""
+    if not markdown:
+        return text
+    with profiler.span('markdown'):
+        return markdown.markdown(text, extensions=['fenced_code', 'tables', 'nl2br'])
+
 @app.template_filter('markdown')
 def markdown_filter(s):
     if not s: return ""
-    if markdown:
-        return markdown.markdown(s, extensions=['fenced_code', 'tables', 'nl2br'])
-    return s
+    return render_markdown(s)
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -278,21 +929,16 @@ def index():
     repos = []
     repo_info_map = db.get_all_repo_info()
     
-    if os.path.exists(DATA_DIR):
-        for d in os.listdir(DATA_DIR):
-            if d.startswith('.') or d.endswith('_temp_init'): continue
-            path = os.path.join(DATA_DIR, d)
-            if os.path.isdir(path):
-
-                is_git = os.path.exists(os.path.join(path, '.git')) or \
-                         (os.path.exists(os.path.join(path, 'HEAD')) and os.path.exists(os.path.join(path, 'config')))
-                info = repo_info_map.get(d, {})
-                repos.append({ 
-                    'name': d, 
-                    'is_git': is_git,
-                    'description': info.get('description', ''),
-                    'language': info.get('language', '混合语言')
-                })
+    for d, path in storage_pool.iter_repos():
+        is_git = os.path.exists(os.path.join(path, '.git')) or \
+                 (os.path.exists(os.path.join(path, 'HEAD')) and os.path.exists(os.path.join(path, 'config')))
+        info = repo_info_map.get(d, {})
+        repos.append({ 
+            'name': d, 
+            'is_git': is_git,
+            'description': info.get('description', ''),
+            'language': info.get('language', '混合语言')
+        })
     return render_template('index.html', repos=repos)
 
 @app.route('/search')
@@ -311,78 +957,76 @@ def search():
     repositories = []
     repo_info_map = db.get_all_repo_info()
     
-    if os.path.exists(DATA_DIR):
-        for d in os.listdir(DATA_DIR):
-            if d.startswith('.') or d.endswith('_temp_init'): continue
-            path = os.path.join(DATA_DIR, d)
-            if os.path.isdir(path):
-                info = repo_info_map.get(d, {})
-                description = info.get('description', '')
-                language = info.get('language', '')
-                
+    all_repos = list(storage_pool.iter_repos())
+    for d, path in all_repos:
+        info = repo_info_map.get(d, {})
+        description = info.get('description', '')
+        language = info.get('language', '')
+        
 
-                if (query_lower in d.lower() or 
-                    query_lower in description.lower() or 
-                    query_lower in language.lower()):
-                    repositories.append({
-                        'name': d,
-                        'description': description,
-                        'language': language
-                    })
+        if (query_lower in d.lower() or 
+            query_lower in description.lower() or 
+            query_lower in language.lower()):
+            repositories.append({
+                'name': d,
+                'description': description,
+                'language': language
+            })
     
 
+    # 并发已满的仓库跳过，其余仓库的结果照常返回并标记为不完整
+    skipped_repos = set()
     code_results = []
-    if os.path.exists(DATA_DIR):
-        for repo_name in os.listdir(DATA_DIR):
-            if repo_name.startswith('.') or repo_name.endswith('_temp_init'): continue
-            repo_path = os.path.join(DATA_DIR, repo_name)
-            if not os.path.isdir(repo_path): continue
-            
-
-            result = run_git_command(repo_path, ['grep', '-n', '-i', '--', query])
-            if result['success'] and result['stdout']:
-                for line in result['stdout'].splitlines()[:10]:
-
-                    parts = line.split(':', 2)
-                    if len(parts) >= 3:
-                        filename, line_num, content = parts
-                        code_results.append({
-                            'repo': repo_name,
-                            'file': filename,
-                            'line_number': line_num,
-                            'snippet': content.strip(),
-                            'ref': 'HEAD'
-                        })
+    for repo_name, repo_path in all_repos:
+        try:
+            with admission_control.admit('grep', repo_path):
+                with iter_git_records(repo_path, ['grep', '-n', '-i', '-z', '-I', '--', query, 'HEAD'], op='grep') as records:
+                    for count, line in enumerate(records):
+                        if count >= 10:
+                            break
+
+                        parts = line.split('\0', 2)
+                        if len(parts) >= 3:
+                            filename, line_num, content = parts
+                            code_results.append({
+                                'repo': repo_name,
+                                'file': filename.split(':', 1)[-1],
+                                'line_number': line_num,
+                                'snippet': content.strip(),
+                                'ref': 'HEAD'
+                            })
+        except AdmissionRejected:
+            skipped_repos.add(repo_name)
     
 
     commits = []
-    if os.path.exists(DATA_DIR):
-        for repo_name in os.listdir(DATA_DIR):
-            if repo_name.startswith('.') or repo_name.endswith('_temp_init'): continue
-            repo_path = os.path.join(DATA_DIR, repo_name)
-            if not os.path.isdir(repo_path): continue
-            
-
-            result = run_git_command(repo_path, [
-                'log', 
-                '--all',
-                '--grep=' + query, 
-                '--author=' + query,
-                '--pretty=format:%H|%an|%ar|%s',
-                '-n', '10'
-            ])
+    for repo_name, repo_path in all_repos:
+        try:
+            with admission_control.admit('log', repo_path):
+                with iter_git_records(repo_path, [
+                    'log', 
+                    '--all',
+                    '--grep=' + query, 
+                    '--author=' + query,
+                    '--pretty=format:%H%x00%an%x00%ar%x00%s',
+                    '-n', '10'
+                ], op='log') as records:
+                    log_lines = list(records)
+        except AdmissionRejected:
+            skipped_repos.add(repo_name)
+            continue
             
-            if result['success'] and result['stdout']:
-                for line in result['stdout'].splitlines():
-                    parts = line.split('|', 3)
-                    if len(parts) >= 4:
-                        commits.append({
-                            'repo': repo_name,
-                            'hash': parts[0],
-                            'author': parts[1],
-                            'date': parts[2],
-                            'message': parts[3]
-                        })
+        if log_lines:
+            for line in log_lines:
+                parts = line.split('\0', 3)
+                if len(parts) >= 4:
+                    commits.append({
+                        'repo': repo_name,
+                        'hash': parts[0],
+                        'author': parts[1],
+                        'date': parts[2],
+                        'message': parts[3]
+                    })
     
 
     total_results = len(repositories) + len(code_results) + len(commits)
@@ -396,7 +1040,9 @@ def search():
                           total_results=total_results,
                           repo_count=len(repositories),
                           code_count=len(code_results),
-                          commit_count=len(commits))
+                          commit_count=len(commits),
+                          partial=bool(skipped_repos),
+                          skipped_repos=sorted(skipped_repos))
 
 @app.route('/repo/<repo_name>/edit', methods=['GET', 'POST'])
 @require_auth
@@ -423,64 +1069,265 @@ def edit_repo_info(repo_name):
 @app.route('/create', methods=['POST'])
 @require_auth
 def create_repo():
-    """创建一个新的 git 仓库。"""
+    """创建一个新的 git 仓库（在后台任务中执行）。"""
     name = request.form.get('name')
     if not name or '..' in name or '/' in name:
         return jsonify({ 'error': '无效的名称' }), 400
     
 
     if name.endswith('.git'): name = name[:-4]
-    
-    repo_path = os.path.join(DATA_DIR, name)
+    if get_repo_path(name):
+        flash(f'仓库 {name} 已存在', 'error')
+        return redirect(url_for('index'))
+
+    job_id = job_queue.submit('create_repo', name, {'name': name}, dedupe_key=f'create_repo:{name}')
+    return redirect(url_for('view_job', job_id=job_id))
 
+def run_create_repo_job(ctx):
+    """后台任务：直接在裸仓库中写入带 README 的初始提交，不经过工作区。"""
+    name = ctx.params['name']
+    if get_repo_path(name):
+        return {'repo': name}
 
-    temp_path = os.path.join(DATA_DIR, f"{name}_temp_init")
+    repo_path = storage_pool.new_repo_path(name)
+    temp_path = f'{repo_path}_temp_init'
     if os.path.exists(temp_path):
         shutil.rmtree(temp_path)
-    os.makedirs(temp_path)
-    
-    try:
-
-        run_git_command(temp_path, ['init'])
-        
-
-        readme_path = os.path.join(temp_path, 'README.md')
-        with open(readme_path, 'w', encoding='utf-8') as f:
-            f.write(f'# {name}\n\n这是一个新创建的 Git 仓库。\n')
-        
-        run_git_command(temp_path, ['add', 'README.md'])
-        run_git_command(temp_path, ['commit', '-m', 'Initial commit'])
-        
 
+    try:
+        ctx.progress(0.3, '创建初始提交', force=True)
+        readme = f'# {name}\n\n这是一个新创建的 Git 仓库。\n'.encode('utf-8')
+        importer.create_bare_repo(temp_path, {'README.md': readme})
+        os.rename(temp_path, repo_path)
+        update_server_info(repo_path)
+        storage_pool.record(name, repo_path)
+    finally:
+        if os.path.exists(temp_path):
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+    return {'repo': name}
+
+def get_objects_dir(repo_path):
+    return os.path.join(get_git_dir(repo_path), 'objects')
+
+def get_alternates_file(repo_path):
+    return os.path.join(get_objects_dir(repo_path), 'info', 'alternates')
+
+def get_http_alternates_file(repo_path):
+    return os.path.join(get_objects_dir(repo_path), 'info', 'http-alternates')
+
+def write_http_alternates(repo_path, parent_name):
+    """写入 objects/info/http-alternates，让 Dumb HTTP 客户端到上游（及上游的上游）取借用的对象。
+
+    alternates 中是服务器上的绝对路径，对客户端没有意义；这里写的地址相对于本仓库的
+    objects/ 目录（../../<上游>.git/objects），与服务的主机名和挂载前缀无关。
+    """
+    names = []
+    while parent_name and parent_name not in names:
+        names.append(parent_name)
+        parent_name = db.get_fork_parent(parent_name)
+    path = get_http_alternates_file(repo_path)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(''.join(f'../../{quote(name)}.git/objects\n' for name in names))
+    os.replace(tmp_path, path)
+
+def create_fork(parent_path, name):
+    """创建共享上游对象库的 fork，返回新仓库路径。
+
+    新仓库是一个空的裸仓库，objects/info/alternates 指向上游的对象目录，
+    只复制引用不复制对象，因此耗时和磁盘占用都与仓库大小无关。
+    fork 之后推送的新对象写入 fork 自己的对象目录。Dumb HTTP 客户端通过
+    objects/info/http-alternates 找到上游的对象。
+    """
+    repo_path = storage_pool.new_repo_path(name)
+    temp_path = os.path.join(os.path.dirname(repo_path), f"{name}_temp_init")
+    if os.path.exists(temp_path):
+        shutil.rmtree(temp_path)
+    os.makedirs(temp_path)
 
-        if os.path.exists(repo_path):
-             shutil.rmtree(repo_path)
-             
-        run_git_command(temp_path, ['clone', '--bare', '.', repo_path])
-        
+    try:
+        steps = [['init', '--bare'],
+                 ['config', 'http.receivepack', 'true'],
+                 ['config', 'receive.denyNonFastForwards', 'false']]
+        for args in steps:
+            res = run_git_command(temp_path, args)
+            if not res['success']:
+                raise RuntimeError(res.get('stderr') or res.get('error'))
+
+        with open(get_alternates_file(temp_path), 'w', encoding='utf-8') as f:
+            f.write(os.path.realpath(get_objects_dir(parent_path)) + '\n')
+        write_http_alternates(temp_path, os.path.basename(parent_path))
+
+        refs = run_git_command(parent_path, ['for-each-ref', '--format=create %(refname) %(objectname)',
+                                             'refs/heads/', 'refs/tags/'])
+        if not refs['success']:
+            raise RuntimeError(refs.get('stderr') or refs.get('error'))
+        res = gitexec.run(['git', 'update-ref', '--stdin'], cwd=temp_path, op='maintenance',
+                          input=refs['stdout'].encode('utf-8'))
+        if res['returncode'] != 0:
+            raise RuntimeError(res['stderr'].decode('utf-8', errors='replace'))
+        run_git_command(temp_path, ['pack-refs', '--all'])
+
+        head = run_git_command(parent_path, ['symbolic-ref', 'HEAD'])
+        if head['success'] and head['stdout'].strip():
+            run_git_command(temp_path, ['symbolic-ref', 'HEAD', head['stdout'].strip()])
+
+        # 上游的 gc 不能删除 fork 仍在引用、而上游自身已不可达的对象
+        run_git_command(parent_path, ['config', 'gc.pruneExpire', 'never'])
+
+        os.rename(temp_path, repo_path)
+        storage_pool.record(name, repo_path)
+    finally:
+        if os.path.exists(temp_path):
+            shutil.rmtree(temp_path, ignore_errors=True)
 
+    update_server_info(repo_path)
+    return repo_path
 
-        run_git_command(repo_path, ['config', 'http.receivepack', 'true'])
+def find_dependent_repos(repo_path):
+    """查找通过 alternates 借用该仓库对象的所有仓库。"""
+    objects_dir = os.path.realpath(get_objects_dir(repo_path))
+    dependents = []
+    for d, path in storage_pool.iter_repos():
+        if os.path.realpath(path) == os.path.realpath(repo_path): continue
+        try:
+            with open(get_alternates_file(path), encoding='utf-8') as f:
+                lines = f.read().splitlines()
+        except OSError:
+            continue
+        if any(line.strip() and os.path.realpath(line.strip()) == objects_dir for line in lines):
+            dependents.append(path)
+    return dependents
+
+def dissociate_repo(repo_path):
+    """把借用的对象复制进仓库自身并移除 alternates，使其不再依赖上游。
+
+    先完整重新打包（会把 alternates 中可达的对象一并打入），移除 alternates 后
+    用 fsck 检查连通性；检查失败时恢复 alternates，仓库保持原状。
+    """
+    env = git_service_env()
+    res = run_git_command(repo_path, ['repack', '-a', '-d'], op='maintenance', env=env)
+    if not res['success']:
+        return res
+    alternates = get_alternates_file(repo_path)
+    backup = alternates + '.dissociating'
+    os.replace(alternates, backup)
+    res = run_git_command(repo_path, ['fsck', '--connectivity-only', '--no-dangling'], op='maintenance', env=env)
+    if not res['success']:
+        os.replace(backup, alternates)
+        return res
+    os.remove(backup)
+    try:
+        os.remove(get_http_alternates_file(repo_path))
+    except FileNotFoundError:
+        pass
+    update_server_info(repo_path)
+    return {'success': True}
+
+def relocate_repo(old_path, new_path, name=None):
+    """仓库迁移到其他存储卷时，更新指向旧路径的发布附件记录和 fork 的 alternates。
+
+    name 默认为新路径的目录名；移入回收目录时目录名带有时间戳，需要显式传入仓库名。
+    """
+    name = name or os.path.basename(new_path)
+    db.rebase_release_asset_paths(name, old_path, new_path)
+    old_objects = os.path.realpath(get_objects_dir(old_path))
+    new_objects = os.path.realpath(get_objects_dir(new_path))
+    for d, path in storage_pool.iter_repos():
+        alternates = get_alternates_file(path)
+        try:
+            with open(alternates, encoding='utf-8') as f:
+                lines = f.read().splitlines()
+        except OSError:
+            continue
+        updated = [new_objects if line.strip() and os.path.realpath(line.strip()) == old_objects else line
+                   for line in lines]
+        if updated != lines:
+            tmp_path = f'{alternates}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(updated) + '\n')
+            os.replace(tmp_path, alternates)
+
+def move_repo_to_trash(name, repo_path):
+    """把仓库改名移入所在卷的回收目录，返回新路径。
+
+    同一文件系统内的改名与仓库大小无关，仓库立即从列表中消失；文件由 purge_repo
+    任务在后台删除。借用该仓库对象的 fork 的 alternates 改为指向回收目录，
+    在后台任务让它们脱离之前仍然可用。
+    """
+    trash_dir = os.path.join(os.path.dirname(repo_path), TRASH_DIR_NAME)
+    os.makedirs(trash_dir, exist_ok=True)
+    trash_path = os.path.join(trash_dir, f'{name}.{time.time_ns()}')
+    parent_path = get_repo_path(db.get_fork_parent(name) or '')
+    with storage_pool.exclusive(name):
+        os.rename(repo_path, trash_path)
+    storage_pool.forget(name)
+    relocate_repo(repo_path, trash_path, name)
+    db.remove_fork(name)
+    # 否则同名仓库重新创建后会继承旧的 Webhook 与发行版，待投递的事件也会继续发出；
+    # 附件文件在回收目录中，由 purge_repo 任务一并删除
+    db.delete_repo_webhooks(name)
+    db.delete_repo_releases(name)
+    if parent_path and not find_dependent_repos(parent_path):
+        run_git_command(parent_path, ['config', '--unset', 'gc.pruneExpire'])
+    return trash_path
+
+def run_purge_repo_job(ctx):
+    """后台任务：让仍借用已删除仓库对象的 fork 脱离，然后删除回收目录中的文件，
+    以及已不被任何仓库引用的 LFS 对象。"""
+    path = ctx.params['path']
+    if not os.path.exists(path):
+        return {'removed': 0}
+
+    dependents = find_dependent_repos(path)
+    steps = len(dependents) + 1
+    for i, fork_path in enumerate(dependents):
+        fork_name = os.path.basename(fork_path)
+        ctx.progress(i / steps, f'正在让 fork {fork_name} 脱离', force=True)
+        res = dissociate_repo(fork_path)
+        if not res['success']:
+            raise RuntimeError(f'fork {fork_name} 脱离失败，已删除的仓库保留在 {path}: '
+                               f'{res.get("stderr") or res.get("error")}')
+        db.remove_fork(fork_name)
+
+    base = len(dependents) / steps
+    report = lambda removed, total: ctx.progress(base + (1 - base) * removed / max(total, 1),
+                                                 f'已删除 {removed}/{total} 个文件')
+    removed = storage.remove_tree(path, report)
+    shutil.rmtree(os.path.join(ARCHIVE_DIR, ctx.repo_name), ignore_errors=True)
+    for oid in db.get_unreferenced_lfs_objects(ctx.params.get('lfs_objects', [])):
+        lfs_store.delete(oid)
+    return {'removed': removed}
+
+@app.route('/<repo_name>/fork', methods=['POST'])
+@require_auth
+def fork_repo(repo_name):
+    """把仓库 fork 为一个共享对象库的新仓库。"""
+    clean_name = repo_name[:-4] if repo_name.endswith('.git') else repo_name
+    parent_path = get_repo_path(clean_name)
+    if not parent_path: abort(404)
 
-        run_git_command(repo_path, ['config', 'receive.denyNonFastForwards', 'false'])
+    name = (request.form.get('name') or '').strip()
+    if name.endswith('.git'): name = name[:-4]
+    if not name or '..' in name or '/' in name or '\\' in name or name.startswith('.') or name.endswith('_temp_init'):
+        flash('无效的名称', 'error')
+        return redirect(url_for('view_repo', repo_name=clean_name))
+    if get_repo_path(name):
+        flash(f'仓库 {name} 已存在', 'error')
+        return redirect(url_for('view_repo', repo_name=clean_name))
 
-        
+    try:
+        create_fork(parent_path, name)
     except Exception as e:
-        print(f"创建仓库失败: {e}")
-        return jsonify({ 'error': f'创建失败: {str(e)}' }), 500
-    finally:
-
-        if os.path.exists(temp_path):
+        flash(f'Fork 失败: {e}', 'error')
+        return redirect(url_for('view_repo', repo_name=clean_name))
 
-            def remove_readonly(func, path, excinfo):
-                os.chmod(path, stat.S_IWRITE)
-                func(path)
-                
-            try:
-                shutil.rmtree(temp_path, onerror=remove_readonly)
-            except Exception as e:
-                print(f"清理临时目录失败: {e}")
-    
+    db.add_fork(name, clean_name)
+    db.copy_lfs_objects(clean_name, name)
+    info = db.get_repo_info(clean_name) or {}
+    db.update_repo_info(name, info.get('description', ''), info.get('language', ''), info.get('is_private', 0))
+    flash(f'已从 {clean_name} fork 出 {name}', 'success')
     return redirect(url_for('view_repo', repo_name=name))
 
 
@@ -503,42 +1350,68 @@ def git_upload_pack(repo_name):
 
 @app.route('/<repo_name>.git/git-receive-pack', methods=['POST'])
 def git_receive_pack(repo_name):
-    repo_path = get_repo_path(repo_name)
-    if not repo_path:
+    if not get_repo_path(repo_name):
         abort(404)
-    return git_http_backend(repo_path, '/git-receive-pack')
+    write_lock = lock_repo_for_push(repo_name)
+    try:
+        return git_http_backend(get_repo_path(repo_name), '/git-receive-pack')
+    finally:
+        storage_pool.unlock(write_lock)
 
 
+def send_git_file(git_dir, relpath, mimetype, immutable=False, regenerate=False):
+    """发送 git 目录中的文件，支持 Range 请求；内容寻址的对象使用长期不可变缓存。"""
+    parts = relpath.split('/')
+    if any(p in ('', '.', '..') for p in parts) or '\\' in relpath:
+        abort(404)
+
+    file_path = os.path.join(git_dir, *parts)
+    if regenerate and not os.path.isfile(file_path):
+        update_server_info(git_dir)
+    if not os.path.isfile(file_path):
+        abort(404)
+
+    response = send_file(file_path, mimetype=mimetype, conditional=True, etag=not immutable)
+    if immutable:
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    else:
+        response.headers.update(NO_CACHE_HEADERS)
+    return response
+
 @app.route('/<repo_name>.git/HEAD')
 def git_head(repo_name):
     """提供 HEAD 文件。"""
     repo_path = get_repo_path(repo_name)
     if not repo_path:
         abort(404)
-    head_file = os.path.join(repo_path, '.git', 'HEAD')
-    if os.path.exists(head_file):
-        return send_file(head_file, mimetype='text/plain')
-    abort(404)
+    return send_git_file(get_git_dir(repo_path), 'HEAD', 'text/plain')
 
 @app.route('/<repo_name>.git/objects/<path:objpath>')
 def git_objects(repo_name, objpath):
-    """提供对象文件。"""
+    """提供对象文件及 objects/info 下的索引文件。"""
     repo_path = get_repo_path(repo_name)
     if not repo_path:
         abort(404)
-    obj_file = os.path.join(repo_path, '.git', 'objects', objpath)
-    if os.path.exists(obj_file) and os.path.isfile(obj_file):
-
-        if objpath.endswith('/pack'):
-            mimetype = 'application/x-git-packed-objects'
-        elif objpath.endswith('.pack'):
-            mimetype = 'application/x-git-packed-objects'
-        elif objpath.endswith('.idx'):
-            mimetype = 'application/x-git-packed-objects-toc'
-        else:
-            mimetype = 'application/x-git-loose-object'
-        return send_file(obj_file, mimetype=mimetype)
-    abort(404)
+    git_dir = get_git_dir(repo_path)
+
+    if objpath.startswith('info/') and objpath not in DUMB_OBJECTS_INFO_FILES:
+        # alternates 是服务器上的绝对路径，其余文件客户端用不到，都不对外暴露
+        abort(404)
+    if objpath == 'info/http-alternates' and not os.path.isfile(get_http_alternates_file(repo_path)):
+        parent_name = db.get_fork_parent(repo_name)
+        if parent_name and os.path.isfile(get_alternates_file(repo_path)):
+            write_http_alternates(repo_path, parent_name)
+
+    if objpath.startswith('info/'):
+        return send_git_file(git_dir, f'objects/{objpath}', 'text/plain', regenerate=objpath == 'info/packs')
+
+    if objpath.endswith('.pack'):
+        mimetype = 'application/x-git-packed-objects'
+    elif objpath.endswith('.idx'):
+        mimetype = 'application/x-git-packed-objects-toc'
+    else:
+        mimetype = 'application/x-git-loose-object'
+    return send_git_file(git_dir, f'objects/{objpath}', mimetype, immutable=True)
 
 @app.route('/<repo_name>.git/refs/<path:refpath>')
 def git_refs(repo_name, refpath):
@@ -546,29 +1419,276 @@ def git_refs(repo_name, refpath):
     repo_path = get_repo_path(repo_name)
     if not repo_path:
         abort(404)
-    ref_file = os.path.join(repo_path, '.git', 'refs', refpath)
-    if os.path.exists(ref_file) and os.path.isfile(ref_file):
-        return send_file(ref_file, mimetype='text/plain')
-    abort(404)
+    return send_git_file(get_git_dir(repo_path), f'refs/{refpath}', 'text/plain')
+
+def lfs_response(data, status=200):
+    return Response(json.dumps(data), status=status, mimetype=LFS_MEDIA_TYPE)
+
+def lfs_error(message, status):
+    return lfs_response({'message': message}, status)
+
+@app.route('/<repo_name>.git/info/lfs/objects/batch', methods=['POST'])
+def lfs_batch(repo_name):
+    """Git LFS 批量接口：为每个对象返回上传或下载地址（basic 传输）。
+
+    存储只按内容去重，不代表访问权限：上传时只有本仓库的 fork 来源链上已关联的对象
+    才直接关联到本仓库；其他对象即使存储中已有，也要求客户端上传一次，校验通过后
+    才关联（已有的文件不会被覆盖）。
+    """
+    repo_path = get_repo_path(repo_name)
+    if not repo_path:
+        return lfs_error('未找到仓库', 404)
+    data = request.get_json(force=True, silent=True) or {}
+    operation = data.get('operation')
+    objects = data.get('objects')
+    if operation not in ('upload', 'download') or not isinstance(objects, list):
+        return lfs_error('请求格式错误', 422)
+    if data.get('hash_algo', 'sha256') != 'sha256':
+        return lfs_error('只支持 sha256', 409)
+    if 'basic' not in data.get('transfers', ['basic']):
+        return lfs_error('只支持 basic 传输', 409)
+
+    is_valid = lambda o: (isinstance(o, dict) and lfs.is_valid_oid(o.get('oid'))
+                          and isinstance(o.get('size'), int) and o['size'] >= 0)
+    linked = db.get_lfs_objects(repo_name, [o['oid'] for o in objects if is_valid(o)])
+    shared = {}
+    if operation == 'upload':
+        shared = lfs_upstream_objects(repo_name, [o['oid'] for o in objects if is_valid(o) and o['oid'] not in linked])
+    href = lambda endpoint, **kw: url_for(endpoint, repo_name=repo_name, _external=True, **kw)
+    results = []
+    for obj in objects:
+        if not is_valid(obj):
+            results.append({'oid': str(obj.get('oid', '')) if isinstance(obj, dict) else '', 'size': 0,
+                            'error': {'code': 422, 'message': '无效的对象 ID 或大小'}})
+            continue
+        oid, size = obj['oid'], obj['size']
+        item = {'oid': oid, 'size': size, 'authenticated': True}
+        stored = lfs_store.exists(oid, size)
+        if operation == 'upload':
+            if stored and linked.get(oid) == size:
+                pass
+            elif stored and shared.get(oid) == size:
+                db.add_lfs_object(repo_name, oid, size)
+            else:
+                item['actions'] = {
+                    'upload': {'href': href('lfs_upload', oid=oid)},
+                    'verify': {'href': href('lfs_verify')},
+                }
+        elif stored and oid in linked:
+            item['actions'] = {'download': {'href': href('lfs_download', oid=oid)}}
+        else:
+            item['error'] = {'code': 404, 'message': '对象不存在'}
+        results.append(item)
+    return lfs_response({'transfer': 'basic', 'objects': results, 'hash_algo': 'sha256'})
+
+@app.route('/<repo_name>.git/info/lfs/objects/<oid>', methods=['PUT'])
+def lfs_upload(repo_name, oid):
+    """流式接收 LFS 对象，边写边校验大小与 SHA-256。"""
+    repo_path = get_repo_path(repo_name)
+    if not repo_path or not lfs.is_valid_oid(oid):
+        abort(404)
+    try:
+        written = lfs_store.put(oid, request.stream, request.content_length)
+    except lfs.ObjectMismatch as e:
+        return lfs_error(str(e), 422)
+    db.add_lfs_object(repo_name, oid, written)
+    metrics.LFS_TRANSFER_BYTES.inc(written, repo=repo_name, direction='in')
+    return Response(status=200)
+
+@app.route('/<repo_name>.git/info/lfs/objects/<oid>', methods=['GET'])
+def lfs_download(repo_name, oid):
+    """下载 LFS 对象，支持 Range 与条件请求。"""
+    repo_path = get_repo_path(repo_name)
+    if not repo_path or not lfs.is_valid_oid(oid):
+        abort(404)
+    return send_lfs_object(repo_name, oid, 'application/octet-stream')
+
+@app.route('/<repo_name>.git/info/lfs/verify', methods=['POST'])
+def lfs_verify(repo_name):
+    repo_path = get_repo_path(repo_name)
+    if not repo_path:
+        return lfs_error('未找到仓库', 404)
+    data = request.get_json(force=True, silent=True) or {}
+    oid, size = data.get('oid'), data.get('size')
+    # 只确认已经上传到本仓库（PUT 校验通过时关联）的对象，不凭 oid 与大小关联存储中的对象
+    if (not lfs.is_valid_oid(oid) or db.get_lfs_objects(repo_name, [oid]).get(oid) != size
+            or not lfs_store.exists(oid, size)):
+        return lfs_error('对象不存在或大小不符', 404)
+    return lfs_response({'oid': oid, 'size': size})
+
+def lfs_upstream_objects(repo_name, oids):
+    """oids 中已关联到本仓库 fork 来源链上某个仓库的对象：{oid: 大小}。"""
+    found = {}
+    seen = {repo_name}
+    parent = db.get_fork_parent(repo_name)
+    while parent and parent not in seen and len(found) < len(oids):
+        seen.add(parent)
+        found.update(db.get_lfs_objects(parent, [oid for oid in oids if oid not in found]))
+        parent = db.get_fork_parent(parent)
+    return found
+
+def send_lfs_object(repo_name, oid, mimetype, download_name=None):
+    """发送仓库可访问的 LFS 对象；对象内容不可变，以 oid 作为 ETag。"""
+    if not db.get_lfs_objects(repo_name, [oid]) or not lfs_store.exists(oid):
+        abort(404)
+    response = send_file(lfs_store.path(oid), mimetype=mimetype, conditional=True, etag=oid,
+                         download_name=download_name, max_age=31536000)
+    length = response.content_length
+    if length:
+        metrics.LFS_TRANSFER_BYTES.inc(length, repo=repo_name, direction='out')
+    return response
+
+def read_lfs_pointer(repo_path, blob, size):
+    """blob 是 LFS 指针文件时返回 {'oid', 'size'}，否则返回 None。"""
+    if size > lfs.POINTER_MAX_SIZE:
+        return None
+    res = gitexec.run(['git', 'cat-file', 'blob', blob], cwd=repo_path)
+    return lfs.parse_pointer(res['stdout']) if res['returncode'] == 0 else None
+
+def submit_query(func, *args, **kwargs):
+    """在查询线程池中执行函数，保留当前请求的跟踪上下文。"""
+    return query_pool.submit(contextvars.copy_context().run, func, *args, **kwargs)
 
+def is_bare_repo(repo_path):
+    return not os.path.exists(os.path.join(repo_path, '.git'))
 
 def get_repo_refs(repo_path):
-    """获取所有分支和标签。"""
+    """获取所有分支和标签（一次 for-each-ref）。"""
     branches = []
     tags = []
     
-
-    res_b = run_git_command(repo_path, ['branch', '--format=%(refname:short)'])
-    if res_b['success']:
-        branches = [b.strip() for b in res_b['stdout'].splitlines() if b.strip()]
-    
-
-    res_t = run_git_command(repo_path, ['tag'])
-    if res_t['success']:
-        tags = [t.strip() for t in res_t['stdout'].splitlines() if t.strip()]
+    with iter_git_records(repo_path, ['for-each-ref', '--format=%(refname)', 'refs/heads', 'refs/tags']) as records:
+        for refname in records:
+            if refname.startswith('refs/heads/'):
+                branches.append(refname[len('refs/heads/'):])
+            elif refname.startswith('refs/tags/'):
+                tags.append(refname[len('refs/tags/'):])
         
     return { 'branches': branches, 'tags': tags }
 
+def get_display_ref(repo_path, ref):
+    """HEAD 显示为当前分支名。"""
+    if ref != 'HEAD':
+        return ref
+    res = run_git_command(repo_path, ['rev-parse', '--abbrev-ref', 'HEAD'])
+    return res['stdout'].strip() if res['success'] and res['stdout'].strip() != 'HEAD' else 'HEAD'
+
+def list_tree(repo_path, ref, subpath):
+    """列出目录内容（ls-tree -l），未附带提交信息。"""
+    target = f"{ref}:{subpath.strip('/')}" if subpath.strip('/') else ref
+    items = []
+    with iter_git_records(repo_path, ['ls-tree', '-l', '-z', target], sep='\0') as records:
+        for record in records:
+
+            meta, _, name = record.partition('\t')
+            parts = meta.split()
+            if len(parts) < 4 or not name: continue
+            
+            mode, obj_type, sha, size = parts
+            items.append({
+                'name': name,
+                'path': os.path.join(subpath, name).replace('\\', '/'),
+                'is_dir': obj_type == 'tree',
+                'size': size if size != '-' else 0,
+                'sha': sha,
+                'commit_message': '',
+                'commit_time': ''
+            })
+    items.sort(key=lambda x: (not x['is_dir'], x['name']))
+    return items
+
+def get_latest_commit(repo_path, ref, path):
+    """路径上最近的一次提交。"""
+    res = run_git_command(repo_path, ['log', '-1', '--format=%H%x00%an%x00%ar%x00%s', ref, '--', path])
+    parts = res['stdout'].strip('\n').split('\0') if res['success'] else []
+    if len(parts) < 4:
+        return None
+    return {'hash': parts[0], 'author': parts[1], 'time': parts[2], 'message': parts[3]}
+
+README_NAMES = ['README.md', 'README.txt', 'readme.md']
+
+def read_readme(repo_path, items):
+    """从已取得的目录列表中找到 README 并读取，返回 (内容, 是否 Markdown)。"""
+    blobs = {item['name']: item['sha'] for item in items if not item['is_dir']}
+    for readme in README_NAMES:
+        if readme not in blobs:
+            continue
+        res = run_git_command(repo_path, ['cat-file', 'blob', blobs[readme]])
+        if not res['success']:
+            continue
+        if readme.lower().endswith('.md'):
+            return res['stdout'], True
+        return f"<pre>{res['stdout']}</pre>", False
+    return None, False
+
+def relative_time(timestamp):
+    """把 Unix 时间戳格式化为与 git 的 %ar 相同的相对时间。"""
+    diff = max(0, int(time.time()) - int(timestamp))
+
+    def plural(n, unit):
+        return f"{n} {unit}{'' if n == 1 else 's'}"
+
+    if diff < 90:
+        return f"{plural(diff, 'second')} ago"
+    diff = (diff + 30) // 60
+    if diff < 90:
+        return f"{plural(diff, 'minute')} ago"
+    diff = (diff + 30) // 60
+    if diff < 36:
+        return f"{plural(diff, 'hour')} ago"
+    days = (diff + 12) // 24
+    if days < 14:
+        return f"{plural(days, 'day')} ago"
+    if days < 70:
+        return f"{plural((days + 3) // 7, 'week')} ago"
+    if days < 365:
+        return f"{plural((days + 15) // 30, 'month')} ago"
+    if days < 1825:
+        total_months = (days * 12 * 2 + 365) // (365 * 2)
+        years, months = divmod(total_months, 12)
+        if months:
+            return f"{plural(years, 'year')}, {plural(months, 'month')} ago"
+        return f"{plural(years, 'year')} ago"
+    return f"{plural((days + 183) // 365, 'year')} ago"
+
+
+def resolve_commit(repo_path, ref):
+    """把引用解析为提交 SHA，失败返回 None。"""
+    res = run_git_command(repo_path, ['rev-parse', '--verify', '-q', f'{ref}^{{commit}}'])
+    sha = res['stdout'].strip() if res['success'] else ''
+    return sha or None
+
+
+def get_last_commits(repo_path, commit_sha, paths, cached_only=False):
+    """查询每个路径在 commit_sha 之前最后一次被修改的提交。
+
+    结果按 (提交 SHA, 路径) 存入共享缓存：同一提交下的历史不会改变，因此无需失效。
+    未命中的路径在查询线程池中并发查询（调用方不能运行在该线程池中）；
+    cached_only=True 时只返回缓存中已有的结果。
+    返回 {path: {'hash', 'message', 'timestamp'}}，没有记录的路径不出现在结果中。
+    """
+    keys = {path: f'{commit_sha}:{path}' for path in paths}
+    cached = shared_cache.get_many('last_commit', keys.values())
+    result = {path: cached[key] for path, key in keys.items() if cached.get(key)}
+    if cached_only:
+        return result
+
+    missing = [path for path in paths if path not in result]
+    futures = [submit_query(run_git_command, repo_path,
+                            ['--literal-pathspecs', 'log', '-1', '--format=%H%x00%s%x00%at', commit_sha, '--', path])
+               for path in missing]
+    fresh = {}
+    for path, future in zip(missing, futures):
+        res = future.result()
+        if not res['success']:
+            continue
+        parts = res['stdout'].strip('\n').split('\0')
+        if len(parts) == 3:
+            result[path] = fresh[keys[path]] = {'hash': parts[0], 'message': parts[1], 'timestamp': int(parts[2])}
+    shared_cache.set_many('last_commit', fresh)
+    return result
+
+
 @app.route('/<repo_name>/')
 def view_repo(repo_name):
     """重定向到默认分支。"""
@@ -590,110 +1710,91 @@ def view_repo(repo_name):
 @app.route('/<repo_name>/tree/<ref>/', defaults={ 'subpath': '' })
 @app.route('/<repo_name>/tree/<ref>/<path:subpath>')
 def view_tree(repo_name, ref, subpath=''):
-    """查看仓库特定引用和路径的文件树。"""
+    """查看仓库特定引用和路径的文件树。
+
+    目录列表直接由 ls-tree 分页返回；每个条目的最近提交只填入缓存中已有的，
+    其余由页面通过 last_commits 接口按可见行批量获取。
+    """
     clean_name = repo_name[:-4] if repo_name.endswith('.git') else repo_name
     repo_path = get_repo_path(clean_name)
     if not repo_path: abort(404)
 
-
-    if ref == 'HEAD':
-        res = run_git_command(repo_path, ['rev-parse', '--abbrev-ref', 'HEAD'])
-        display_ref = res['stdout'].strip() if res['success'] and res['stdout'].strip() != 'HEAD' else 'HEAD'
-    else:
-        display_ref = ref
-
-
-    refs = get_repo_refs(repo_path)
-    
-
-
-    target = f"{ref}:{subpath.strip('/')}" if subpath.strip('/') else ref
-    
-    res = run_git_command(repo_path, ['ls-tree', '-l', target])
-    
-    items = []
-    if res['success']:
-        for line in res['stdout'].splitlines():
-
-            parts = line.split(None, 4)
-            if len(parts) < 5: continue
-            
-            mode, obj_type, sha, size, name = parts
-            is_dir = obj_type == 'tree'
-            
-
-            file_path = os.path.join(subpath, name).replace('\\', '/') if subpath else name
-            commit_res = run_git_command(repo_path, ['log', '-1', '--format=%H|%s|%ar', ref, '--', file_path])
-            commit_msg = ''
-            commit_time = ''
-            if commit_res['success'] and commit_res['stdout'].strip():
-                commit_parts = commit_res['stdout'].strip().split('|', 2)
-                if len(commit_parts) >= 2:
-                    commit_msg = commit_parts[1]
-                    commit_time = commit_parts[2] if len(commit_parts) >= 3 else ''
-            
-            items.append({
-                'name': name,
-                'path': os.path.join(subpath, name).replace('\\', '/'),
-                'is_dir': is_dir,
-                'size': size if size != '-' else 0,
-                'sha': sha,
-                'commit_message': commit_msg,
-                'commit_time': commit_time
-            })
-    elif not subpath:
-
-
-        pass
-
-
-    items.sort(key=lambda x: (not x['is_dir'], x['name']))
-    
-
-    path_for_log = subpath if subpath else '.'
-    latest_commit_res = run_git_command(repo_path, ['log', '-1', '--format=%H|%an|%ar|%s', ref, '--', path_for_log])
-    latest_commit = None
-    if latest_commit_res['success'] and latest_commit_res['stdout'].strip():
-        commit_parts = latest_commit_res['stdout'].strip().split('|', 3)
-        if len(commit_parts) >= 4:
-            latest_commit = {
-                'hash': commit_parts[0],
-                'author': commit_parts[1],
-                'time': commit_parts[2],
-                'message': commit_parts[3]
-            }
-    
-
-    git_status = run_git_command(repo_path, ['status', '-s'])
-    
-    readme_content = None
-    readme_is_markdown = False
-    
-
-    for readme in ['README.md', 'README.txt', 'readme.md']:
-        readme_path = os.path.join(subpath, readme).replace('\\', '/')
-        r_target = f"{ref}:{readme_path}"
-        res_r = run_git_command(repo_path, ['show', r_target])
-        if res_r['success']:
-            content = res_r['stdout']
-            if readme.lower().endswith('.md'):
-                readme_content = content
-                readme_is_markdown = True
-            else:
-                readme_content = f"<pre>{content}</pre>"
-            break
+    page = max(request.args.get('page', 1, type=int), 1)
+
+    display_ref_f = submit_query(get_display_ref, repo_path, ref)
+    refs_f = submit_query(get_repo_refs, repo_path)
+    items_f = submit_query(list_tree, repo_path, ref, subpath)
+    commit_sha_f = submit_query(resolve_commit, repo_path, ref)
+    latest_commit_f = submit_query(get_latest_commit, repo_path, ref, subpath if subpath else '.')
+    status_f = None
+    if not is_bare_repo(repo_path):
+        status_f = submit_query(run_git_command, repo_path, ['status', '-s'])
+
+    all_items = items_f.result()
+    readme_f = submit_query(read_readme, repo_path, all_items)
+
+    total = len(all_items)
+    pages = max((total + TREE_PAGE_SIZE - 1) // TREE_PAGE_SIZE, 1)
+    page = min(page, pages)
+    items = all_items[(page - 1) * TREE_PAGE_SIZE:page * TREE_PAGE_SIZE]
+
+    commit_sha = commit_sha_f.result()
+    if items and commit_sha:
+        last_commits = get_last_commits(repo_path, commit_sha, [item['path'] for item in items], cached_only=True)
+        for item in items:
+            last = last_commits.get(item['path'])
+            if last:
+                item['commit_message'] = last['message']
+                item['commit_time'] = relative_time(last['timestamp'])
+
+    display_ref = display_ref_f.result()
+    readme_content, readme_is_markdown = readme_f.result()
+    status = None
+    if status_f is not None and (ref == 'HEAD' or ref == display_ref):
+        status = status_f.result()['stdout']
 
     return render_template('repo.html', 
                            repo_name=clean_name, 
                            ref=ref,
                            display_ref=display_ref,
-                           refs=refs,
+                           refs=refs_f.result(),
                            current_path=subpath, 
                            items=items,
-                           latest_commit=latest_commit, 
+                           commit_sha=commit_sha,
+                           page=page,
+                           pages=pages,
+                           total_items=total,
+                           page_size=TREE_PAGE_SIZE,
+                           last_commits_batch=LAST_COMMITS_BATCH,
+                           latest_commit=latest_commit_f.result(), 
                            readme=readme_content,
                            readme_is_markdown=readme_is_markdown,
-                           status=git_status['stdout'] if ref == 'HEAD' or ref == display_ref else None)
+                           fork_parent=db.get_fork_parent(clean_name),
+                           status=status)
+
+@app.route('/<repo_name>/last-commits/<commit_sha>', methods=['POST'])
+def last_commits(repo_name, commit_sha):
+    """批量查询文件树条目的最近提交，请求体为 {"paths": [...]}。"""
+    clean_name = repo_name[:-4] if repo_name.endswith('.git') else repo_name
+    repo_path = get_repo_path(clean_name)
+    if not repo_path: abort(404)
+    if len(commit_sha) not in (40, 64) or any(c not in '0123456789abcdef' for c in commit_sha):
+        return jsonify({'error': '无效的提交'}), 400
+
+    data = request.get_json(silent=True) or {}
+    paths = [p for p in data.get('paths', []) if isinstance(p, str) and p and not p.startswith('-')]
+    if len(paths) > LAST_COMMITS_BATCH:
+        return jsonify({'error': f'每次最多查询 {LAST_COMMITS_BATCH} 个路径'}), 400
+
+    result = get_last_commits(repo_path, commit_sha, paths)
+    return jsonify({
+        path: {
+            'hash': info['hash'],
+            'message': info['message'],
+            'time': relative_time(info['timestamp'])
+        }
+        for path, info in result.items()
+    })
 
 @app.route('/<repo_name>/blob/<ref>/<path:filepath>')
 def view_file(repo_name, ref, filepath):
@@ -716,40 +1817,44 @@ def view_file(repo_name, ref, filepath):
 
     if request.args.get('raw') == '1':
 
+        target = f"{ref}:{filepath}"
+        res_size = run_git_command(repo_path, ['cat-file', '-s', target])
+        if not res_size['success']:
+            abort(404)
+        pointer = read_lfs_pointer(repo_path, target, int(res_size['stdout'].strip() or 0))
+        if pointer:
+            return send_lfs_object(clean_name, pointer['oid'], mime_type or 'application/octet-stream')
         try:
-            target = f"{ref}:{filepath}"
-            result = subprocess.run(
-                ['git', 'show', target],
-                cwd=repo_path,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                check=False
-            )
-            if result.returncode == 0:
-                return Response(result.stdout, mimetype=mime_type or 'application/octet-stream')
-            else:
-                abort(404)
+            stream, error = start_streaming_git(['git', 'show', target], cwd=repo_path, op='archive')
         except Exception:
             abort(500)
+        if error is not None:
+            abort(404)
+        response = Response(stream, mimetype=mime_type or 'application/octet-stream', direct_passthrough=True)
+        response.call_on_close(stream.close)
+        return response
 
 
-    target = f"{ref}:{filepath}"
-    res = run_git_command(repo_path, ['show', target])
-    
-    if not res['success']:
+    res_info = run_git_command(repo_path, ['ls-tree', '-l', '-z', ref, '--', filepath])
+    meta = res_info['stdout'].split('\t', 1)[0].split() if res_info['success'] else []
+    if len(meta) < 4:
         abort(404)
-        
+    if meta[1] == 'tree':
+        return redirect(url_for('view_tree', repo_name=clean_name, ref=ref, subpath=filepath))
 
-
-    res_info = run_git_command(repo_path, ['ls-tree', '-l', target])
+    blob_sha = meta[2]
     file_size_bytes = 0
-    if res_info['success'] and res_info['stdout']:
-        parts = res_info['stdout'].split()
-        if len(parts) >= 4:
-            try:
-                file_size_bytes = int(parts[3])
-            except ValueError:
-                pass
+    try:
+        file_size_bytes = int(meta[3])
+    except ValueError:
+        pass
+
+    lfs_pointer = read_lfs_pointer(repo_path, blob_sha, file_size_bytes)
+    lfs_missing = False
+    if lfs_pointer:
+        file_size_bytes = lfs_pointer['size']
+        lfs_missing = not (db.get_lfs_objects(clean_name, [lfs_pointer['oid']])
+                           and lfs_store.exists(lfs_pointer['oid']))
 
     if file_size_bytes < 1024:
         file_size = f"{file_size_bytes} B"
@@ -771,25 +1876,49 @@ def view_file(repo_name, ref, filepath):
     per_page = 2000
     total_pages = 1
 
+    if lfs_pointer and (lfs_missing or not (is_image or is_video or is_pdf)):
+        is_image = is_video = is_pdf = False
+        is_binary = True
+
     try:
-        if not (is_image or is_video or is_pdf):
-            full_content = res['stdout']
-            all_lines = full_content.splitlines(keepends=True)
-            total_lines = len(all_lines)
+        if is_binary:
+            pass
+        elif not (is_image or is_video or is_pdf):
+            if page < 1: page = 1
+            start_index = (page - 1) * per_page
+            page_lines = []
+            last_lines = deque(maxlen=per_page)
+            total_lines = 0
+            scanned = 0
+
+            with iter_git_records(repo_path, ['cat-file', 'blob', blob_sha], text=False) as records:
+                for line in records:
+                    if scanned < 8000:
+                        if b'\0' in line:
+                            is_binary = True
+                            break
+                        scanned += len(line) + 1
+                    if start_index <= total_lines < start_index + per_page:
+                        page_lines.append(line)
+                    last_lines.append(line)
+                    total_lines += 1
+
+            if is_binary:
+                raise ValueError('binary content')
             
             if total_lines > 0:
                 total_pages = (total_lines + per_page - 1) // per_page
             else:
                 total_pages = 1
             
-            if page < 1: page = 1
-            if page > total_pages: page = total_pages
+            if page > total_pages:
+                page = total_pages
+                page_lines = list(last_lines)[-(total_lines - (page - 1) * per_page):] if total_lines else []
             
-            start_index = (page - 1) * per_page
-            content = "".join(all_lines[start_index : start_index + per_page])
+            content = b''.join(line + b'\n' for line in page_lines).decode('utf-8', errors='replace')
                  
             if is_markdown and markdown:
-                html_content = markdown.markdown(content, extensions=['fenced_code', 'tables', 'nl2br'])
+                html_content = render_markdown(content)
         else:
             is_binary = True
     except Exception:
@@ -807,11 +1936,212 @@ def view_file(repo_name, ref, filepath):
                             is_video=is_video,
                             is_pdf=is_pdf,
                             is_binary=is_binary,
+                            is_lfs=bool(lfs_pointer),
+                            lfs_missing=lfs_missing,
                             file_size=file_size,
                             current_page=page,
                             total_pages=total_pages,
                             per_page=per_page)
 
+DIFF_HUNK_HEADER = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@', re.M)
+
+def parse_blame_incremental(records, commits):
+    """解析 git blame --incremental 的输出，逐块产出 [起始行, 行数, 提交 SHA]。
+
+    提交第一次出现时，其作者、时间与摘要写入 commits（在产出对应块之前）。
+    """
+    hunk = None
+    info = None
+    for line in records:
+        if hunk is None:
+            parts = line.split(' ')
+            if len(parts) != 4:
+                continue
+            sha = parts[0]
+            hunk = [int(parts[2]), int(parts[3]), sha]
+            info = commits.setdefault(sha, {'author': '', 'timestamp': 0, 'summary': ''})
+            continue
+        key, _, value = line.partition(' ')
+        if key == 'filename':
+            yield hunk
+            hunk = None
+        elif key == 'author':
+            info['author'] = value
+        elif key == 'author-time':
+            info['timestamp'] = int(value)
+        elif key == 'summary':
+            info['summary'] = value
+
+def compress_blame_lines(line_commits):
+    """把逐行的提交 SHA 列表合并为连续的 [起始行, 行数, 提交 SHA] 块。"""
+    hunks = []
+    for number, sha in enumerate(line_commits, 1):
+        if hunks and hunks[-1][2] == sha:
+            hunks[-1][1] += 1
+        else:
+            hunks.append([number, 1, sha])
+    return hunks
+
+def reuse_parent_blame(repo_path, blame_commit, parents, filepath, line_count):
+    """由父版本已缓存的 blame 与两版之间的差异推算 blame_commit 的 blame。
+
+    未改动的行沿用父版本的归属，新增或修改的行归属于 blame_commit，
+    与不带 -M/-C 的 git blame 结果一致。合并提交、父版本未缓存或改动超过
+    BLAME_REUSE_MAX_CHANGES 行时返回 None，由调用方完整运行 git blame。
+    """
+    if len(parents) != 1:
+        return None
+    res = run_git_command(repo_path, ['--literal-pathspecs', 'log', '-1', '--format=%H', parents[0], '--', filepath])
+    parent_key = res['stdout'].strip() if res['success'] else ''
+    if not parent_key:
+        return None
+    parent_blame = shared_cache.get('blame', f'{parent_key}:{filepath}')
+    if not parent_blame:
+        return None
+
+    res = run_git_command(repo_path, ['--literal-pathspecs', 'diff', '-U0', '--no-color', '--no-ext-diff',
+                                      parents[0], blame_commit, '--', filepath])
+    if not res['success']:
+        return None
+    ranges = [(int(a), int(b) if b else 1, int(d) if d else 1)
+              for a, b, _, d in DIFF_HUNK_HEADER.findall(res['stdout'])]
+    if sum(b + d for _, b, d in ranges) > BLAME_REUSE_MAX_CHANGES:
+        return None
+
+    old_lines = []
+    for _, count, sha in parent_blame['hunks']:
+        old_lines.extend([sha] * count)
+    new_lines = []
+    position = 0
+    for start, removed, added in ranges:
+        first = start - 1 if removed else start
+        new_lines.extend(old_lines[position:first])
+        new_lines.extend([blame_commit] * added)
+        position = first + removed
+    new_lines.extend(old_lines[position:])
+    if len(new_lines) != line_count:
+        return None
+
+    res = run_git_command(repo_path, ['log', '-1', '--format=%an%x00%at%x00%s', blame_commit])
+    parts = res['stdout'].rstrip('\n').split('\0') if res['success'] else []
+    if len(parts) != 3:
+        return None
+    commits = {sha: parent_blame['commits'][sha] for sha in set(new_lines) if sha in parent_blame['commits']}
+    commits[blame_commit] = {'author': parts[0], 'timestamp': int(parts[1]), 'summary': parts[2]}
+    return {'hunks': compress_blame_lines(new_lines), 'commits': commits}
+
+def iter_blame_batches(repo_name, hunks, commits, interval=0.05, max_hunks=1000):
+    """把 blame 块分批交给页面：首块立即发送，其后每 interval 秒或 max_hunks 块发送一批。
+
+    每批附带本批首次引用的提交信息；hunks 抛出异常时最后一批只包含错误信息。
+    """
+    sent = set()
+    batch = {'hunks': [], 'commits': {}}
+    last = 0.0
+    try:
+        for hunk in hunks:
+            sha = hunk[2]
+            if sha not in sent:
+                sent.add(sha)
+                info = commits.get(sha) or {}
+                batch['commits'][sha] = {
+                    'summary': info.get('summary', ''),
+                    'author': info.get('author', ''),
+                    'time': relative_time(info.get('timestamp', 0)),
+                    'url': url_for('view_commit', repo_name=repo_name, commit_hash=sha),
+                }
+            batch['hunks'].append(hunk)
+            now = time.monotonic()
+            if now - last >= interval or len(batch['hunks']) >= max_hunks:
+                yield batch
+                batch = {'hunks': [], 'commits': {}}
+                last = now
+    except Exception as e:
+        if batch['hunks']:
+            yield batch
+        yield {'error': str(e)}
+        return
+    if batch['hunks']:
+        yield batch
+
+def run_blame(repo_path, blame_commit, filepath, commits):
+    """流式运行 git blame --incremental，逐块产出结果；完整结束后按 (提交 SHA, 路径) 写入缓存。"""
+    hunks = []
+    with iter_git_records(repo_path, ['blame', '--incremental', blame_commit, '--', filepath], op='blame') as records:
+        for hunk in parse_blame_incremental(records, commits):
+            hunks.append(hunk)
+            yield hunk
+    if not records.success:
+        raise RuntimeError(records.stderr.decode('utf-8', errors='replace').strip() or 'git blame 失败')
+    shared_cache.set('blame', f'{blame_commit}:{filepath}', {'hunks': sorted(hunks), 'commits': commits})
+
+@app.route('/<repo_name>/blame/<ref>/<path:filepath>')
+def view_blame(repo_name, ref, filepath):
+    """逐行追溯文件的最后修改提交；结果在计算过程中分批流式发送给浏览器。"""
+    clean_name = repo_name[:-4] if repo_name.endswith('.git') else repo_name
+    repo_path = get_repo_path(clean_name)
+    if not repo_path: abort(404)
+
+    commit_sha = resolve_commit(repo_path, ref)
+    if not commit_sha:
+        abort(404)
+    res_info = run_git_command(repo_path, ['ls-tree', '-z', commit_sha, '--', filepath])
+    meta = res_info['stdout'].split('\t', 1)[0].split() if res_info['success'] else []
+    if len(meta) < 3:
+        abort(404)
+    if meta[1] != 'blob':
+        return redirect(url_for('view_tree', repo_name=clean_name, ref=ref, subpath=filepath))
+
+    lines = []
+    scanned = 0
+    with iter_git_records(repo_path, ['cat-file', 'blob', meta[2]], text=False) as records:
+        for line in records:
+            if scanned < 8000:
+                if b'\0' in line:
+                    return redirect(url_for('view_file', repo_name=clean_name, ref=ref, filepath=filepath))
+                scanned += len(line) + 1
+            lines.append(line.decode('utf-8', errors='replace'))
+            if len(lines) > BLAME_MAX_LINES:
+                break
+
+    # 文件内容自最后一次修改以来不变，blame 也不变，因此以该提交作为缓存键
+    res = run_git_command(repo_path, ['--literal-pathspecs', 'log', '-1', '--format=%H%x00%P', commit_sha, '--', filepath])
+    blame_commit, _, parents = res['stdout'].strip().partition('\0') if res['success'] else ('', '', '')
+    if not blame_commit:
+        abort(404)
+
+    too_large = len(lines) > BLAME_MAX_LINES
+    batches = []
+    slot = None
+    if not too_large:
+        cache_key = f'{blame_commit}:{filepath}'
+        blame = shared_cache.get('blame', cache_key)
+        if blame is None:
+            blame = reuse_parent_blame(repo_path, blame_commit, parents.split(), filepath, len(lines))
+            if blame is not None:
+                shared_cache.set('blame', cache_key, blame)
+        if blame is not None:
+            batches = iter_blame_batches(clean_name, blame['hunks'], blame['commits'])
+        else:
+            slot = admission_control.acquire('blame', repo_path)
+            commits = {}
+            batches = iter_blame_batches(clean_name, run_blame(repo_path, blame_commit, filepath, commits), commits)
+
+    response = Response(stream_template('blame.html',
+                                        repo_name=clean_name,
+                                        ref=ref,
+                                        display_ref=get_display_ref(repo_path, ref),
+                                        filepath=filepath,
+                                        lines=[] if too_large else lines,
+                                        too_large=too_large,
+                                        max_lines=BLAME_MAX_LINES,
+                                        batches=batches),
+                        mimetype='text/html')
+    if slot is not None:
+        # 响应结束（包括客户端提前断开）时才释放名额，此时 blame 进程已随生成器关闭
+        response.call_on_close(lambda: admission_control.release(slot))
+    return response
+
 @app.route('/<repo_name>/commits', defaults={'ref': 'HEAD'})
 @app.route('/<repo_name>/commits/<ref>')
 def view_commits(repo_name, ref):
@@ -820,12 +2150,10 @@ def view_commits(repo_name, ref):
     repo_path = get_repo_path(clean_name)
     if not repo_path: abort(404)
     
-    output = run_git_command(repo_path, ['log', '--pretty=format:%H|%an|%ar|%s', '-n', '50', ref])
     commits = []
-    if output['success']:
-        lines = output['stdout'].splitlines()
-        for line in lines:
-            parts = line.split('|', 3)
+    with iter_git_records(repo_path, ['log', '--pretty=format:%H%x00%an%x00%ar%x00%s', '-n', '50', ref, '--']) as records:
+        for line in records:
+            parts = line.split('\0', 3)
             if len(parts) == 4:
                 commits.append({
                     'hash': parts[0],
@@ -836,6 +2164,121 @@ def view_commits(repo_name, ref):
                 
     return render_template('commits.html', repo_name=clean_name, commits=commits, ref=ref)
 
+def read_path_history(repo_path, revisions, path, follow, limit=None):
+    """按 git log 顺序读取路径的提交历史。
+
+    follow=True 时跟踪文件重命名，每条记录带有该提交中文件的路径。
+    返回 (记录列表, 最早一条记录之前的文件路径)；读取失败时返回 (None, path)。
+    """
+    args = ['--literal-pathspecs', 'log', '--format=%x01%H%x00%an%x00%at%x00%s']
+    if follow:
+        args += ['--follow', '--name-status']
+    if limit:
+        args += ['-n', str(limit)]
+    args += revisions + ['--', path]
+
+    entries = []
+    name = path
+    with iter_git_records(repo_path, args, op='log') as records:
+        for line in records:
+            if line.startswith('\x01'):
+                parts = line[1:].split('\0', 3)
+                if len(parts) == 4:
+                    entries.append([parts[0], parts[1], int(parts[2]), parts[3], name])
+            elif follow and entries and line:
+                status = line.split('\t')
+                # 重命名/复制记录为 "R100\t旧路径\t新路径"，更早的提交使用旧路径
+                entries[-1][4] = status[-1]
+                name = status[1] if status[0][:1] in ('R', 'C') and len(status) == 3 else status[-1]
+    if not records.success:
+        return None, path
+    return entries, name
+
+def get_path_history(repo_path, tip, path, follow, needed):
+    """返回 (tip 处 path 的前 needed 条历史, 返回的是否已是全部历史)。
+
+    结果按 (tip, 路径) 缓存。分支前进后以上一次缓存的 tip 为起点，只读取新增的
+    提交（old..new）并接在旧历史前面；翻页超出已读部分时按倍增的条数重新读取，
+    因此浏览过的页面不会再次遍历提交图。
+    """
+    cache_key = f'{tip}:{path}'
+    tip_key = f'{repo_path}:{path}'
+    history = shared_cache.get('history', cache_key)
+    changed = False
+
+    if history is None:
+        old_tip = shared_cache.get('history_tip', tip_key)
+        old = shared_cache.get('history', f'{old_tip}:{path}') if old_tip else None
+        if old is not None and run_git_command(repo_path, ['merge-base', '--is-ancestor', old_tip, tip])['success']:
+            entries, name = read_path_history(repo_path, [f'{old_tip}..{tip}'], path, follow)
+            # 新增提交中发生了重命名时，旧缓存对应的是另一个路径，只能重新读取
+            if entries is not None and name == path:
+                history = {'commits': entries + old['commits'], 'complete': old['complete']}
+                changed = True
+
+    if history is None or (not history['complete'] and len(history['commits']) < needed):
+        have = len(history['commits']) if history else 0
+        limit = max(needed, have * 2, HISTORY_PAGE_SIZE * 4)
+        entries, _ = read_path_history(repo_path, [tip], path, follow, limit)
+        if entries is None:
+            return [], True
+        history = {'commits': entries, 'complete': len(entries) < limit}
+        changed = True
+
+    if changed:
+        shared_cache.set('history', cache_key, history)
+        shared_cache.set('history_tip', tip_key, tip)
+    return history['commits'][:needed], history['complete'] and len(history['commits']) <= needed
+
+@app.route('/<repo_name>/commits/<ref>/<path:filepath>')
+def view_history(repo_name, ref, filepath):
+    """查看文件或目录的提交历史，文件会跟踪重命名；用 ?after=<提交> 翻页。"""
+    clean_name = repo_name[:-4] if repo_name.endswith('.git') else repo_name
+    repo_path = get_repo_path(clean_name)
+    if not repo_path: abort(404)
+
+    tip = resolve_commit(repo_path, ref)
+    if not tip:
+        abort(404)
+    res = run_git_command(repo_path, ['ls-tree', tip, '--', filepath])
+    is_dir = res['success'] and res['stdout'].split(' ', 2)[1:2] == ['tree']
+    follow = not is_dir
+
+    after = request.args.get('after', '')
+    with admission_control.admit('log', repo_path):
+        start = 0
+        needed = HISTORY_PAGE_SIZE + 1
+        history, complete = get_path_history(repo_path, tip, filepath, follow, needed)
+        if after:
+            index = next((i for i, entry in enumerate(history) if entry[0] == after), None)
+            while index is None and not complete:
+                needed *= 2
+                history, complete = get_path_history(repo_path, tip, filepath, follow, needed)
+                index = next((i for i, entry in enumerate(history) if entry[0] == after), None)
+            if index is None:
+                abort(404)
+            start = index + 1
+            history, complete = get_path_history(repo_path, tip, filepath, follow, start + HISTORY_PAGE_SIZE + 1)
+
+    page = history[start:start + HISTORY_PAGE_SIZE]
+    commits = [{
+        'hash': sha,
+        'author': author,
+        'date': relative_time(timestamp),
+        'message': subject,
+        'path': path,
+    } for sha, author, timestamp, subject, path in page]
+    next_after = page[-1][0] if len(history) > start + HISTORY_PAGE_SIZE else None
+
+    return render_template('commits.html',
+                           repo_name=clean_name,
+                           commits=commits,
+                           ref=ref,
+                           path=filepath,
+                           is_dir=is_dir,
+                           after=after,
+                           next_after=next_after)
+
 @app.route('/<repo_name>/commit/<commit_hash>')
 def view_commit(repo_name, commit_hash):
     """查看提交差异。"""
@@ -846,9 +2289,10 @@ def view_commit(repo_name, commit_hash):
 
     info_res = run_git_command(repo_path, ['show', '--stat', commit_hash])
 
-    diff_res = run_git_command(repo_path, ['show', commit_hash])
+    MAX_DIFF_SIZE = 50 * 1024
+    diff_res = run_git_command(repo_path, ['show', commit_hash], max_output=MAX_DIFF_SIZE + 1)
     
-    if not info_res['success'] or not diff_res['success']:
+    if not info_res['success'] or not (diff_res['success'] or diff_res.get('truncated')):
         flash(f"无法获取提交信息: {info_res.get('error') or diff_res.get('error') or info_res.get('stderr')}", 'error')
         return redirect(url_for('view_commits', repo_name=clean_name))
 
@@ -856,8 +2300,7 @@ def view_commit(repo_name, commit_hash):
     diff = diff_res.get('stdout', '')
     
 
-    MAX_DIFF_SIZE = 50 * 1024
-    if len(diff) > MAX_DIFF_SIZE:
+    if diff_res.get('truncated') or len(diff) > MAX_DIFF_SIZE:
         diff = diff[:MAX_DIFF_SIZE] + "\n\n... (差异过大，已自动截断以提高性能)"
     
     return render_template('diff.html', 
@@ -873,9 +2316,10 @@ def view_tags(repo_name):
     repo_path = get_repo_path(clean_name)
     if not repo_path: abort(404)
     
-    output = run_git_command(repo_path, ['tag', '-l', '-n'])
     tags_data = []
-    for line in output['stdout'].splitlines():
+    with iter_git_records(repo_path, ['tag', '-l', '-n']) as records:
+        lines = list(records)
+    for line in lines:
         if line.strip():
             parts = line.split(None, 1)
             tag_name = parts[0] if parts else line
@@ -897,7 +2341,11 @@ def delete_tag(repo_name):
         flash('未指定标签', 'error')
         return redirect(url_for('view_tags', repo_name=clean_name))
         
-    res = run_git_command(repo_path, ['tag', '-d', tag_name])
+    with repo_write_lock(clean_name) as repo_path:
+        if not repo_path: abort(404)
+        res = run_git_command(repo_path, ['tag', '-d', tag_name])
+        if res['success']:
+            update_server_info(repo_path)
     
     if res['success']:
         flash(f'标签 {tag_name} 已删除', 'success')
@@ -914,17 +2362,16 @@ def view_branches(repo_name):
     if not repo_path: abort(404)
     
 
-    output = run_git_command(repo_path, ['branch', '-v', '--format=%(refname:short)|%(committerdate:relative)|%(subject)'])
     branches_data = []
     
 
     current_output = run_git_command(repo_path, ['branch', '--show-current'])
     current_branch = current_output['stdout'].strip()
     
-    if output['success']:
-        for line in output['stdout'].splitlines():
+    with iter_git_records(repo_path, ['branch', '--format=%(refname:short)%00%(committerdate:relative)%00%(subject)']) as records:
+        for line in records:
             if line.strip():
-                parts = line.split('|', 2)
+                parts = line.split('\0', 2)
                 if len(parts) >= 3:
                     branch_name = parts[0].strip()
 
@@ -951,7 +2398,11 @@ def set_default_branch(repo_name):
         return redirect(url_for('view_branches', repo_name=clean_name))
     
 
-    res = run_git_command(repo_path, ['symbolic-ref', 'HEAD', f'refs/heads/{branch}'])
+    with repo_write_lock(clean_name) as repo_path:
+        if not repo_path: abort(404)
+        res = run_git_command(repo_path, ['symbolic-ref', 'HEAD', f'refs/heads/{branch}'])
+        if res['success']:
+            update_server_info(repo_path)
     
     if res['success']:
         flash(f'默认分支已设置为 {branch}', 'success')
@@ -978,7 +2429,11 @@ def create_branch(repo_name):
          flash('分支名称包含非法字符', 'error')
          return redirect(url_for('view_branches', repo_name=clean_name))
 
-    res = run_git_command(repo_path, ['branch', new_branch, 'HEAD'])
+    with repo_write_lock(clean_name) as repo_path:
+        if not repo_path: abort(404)
+        res = run_git_command(repo_path, ['branch', new_branch, 'HEAD'])
+        if res['success']:
+            update_server_info(repo_path)
     
     if res['success']:
         flash(f'分支 {new_branch} 创建成功', 'success')
@@ -1001,13 +2456,16 @@ def delete_branch(repo_name):
         return redirect(url_for('view_branches', repo_name=clean_name))
     
 
-    current = run_git_command(repo_path, ['symbolic-ref', '--short', 'HEAD'])
-    if current['success'] and current['stdout'].strip() == branch:
-        flash('无法删除当前默认分支，请先切换默认分支。', 'error')
-        return redirect(url_for('view_branches', repo_name=clean_name))
-
+    with repo_write_lock(clean_name) as repo_path:
+        if not repo_path: abort(404)
+        current = run_git_command(repo_path, ['symbolic-ref', '--short', 'HEAD'])
+        if current['success'] and current['stdout'].strip() == branch:
+            flash('无法删除当前默认分支，请先切换默认分支。', 'error')
+            return redirect(url_for('view_branches', repo_name=clean_name))
 
-    res = run_git_command(repo_path, ['branch', '-D', branch])
+        res = run_git_command(repo_path, ['branch', '-D', branch])
+        if res['success']:
+            update_server_info(repo_path)
     
     if res['success']:
         flash(f'分支 {branch} 已删除', 'success')
@@ -1033,7 +2491,7 @@ def compare_nodes(repo_name):
         return redirect(url_for('compare_nodes', repo_name=clean_name, base=base, head=head))
     
     if base and head:
-        res = run_git_command(repo_path, ['diff', f'{base}...{head}'])
+        res = run_git_command(repo_path, ['diff', f'{base}...{head}'], op='log')
         diff_output = res['stdout']
         
     return render_template('compare.html', repo_name=clean_name, base=base, head=head, diff=diff_output)
@@ -1047,6 +2505,26 @@ def view_settings(repo_name):
 
     if request.method == 'POST':
         action = request.form.get('action')
+        if action == 'clone_settings':
+            with repo_write_lock(clean_name) as repo_path:
+                if not repo_path: abort(404)
+                for key, label, _ in CLONE_CONFIG_OPTIONS:
+                    value = request.form.get(key, 'inherit')
+                    if value in ('true', 'false'):
+                        run_git_command(repo_path, ['config', key, value])
+                    else:
+                        run_git_command(repo_path, ['config', '--unset-all', key])
+            flash('克隆设置已更新', 'success')
+            return redirect(url_for('view_settings', repo_name=clean_name))
+
+        if action == 'optimize_repo':
+            res = optimize_repo(repo_path)
+            if res['success']:
+                flash('仓库已优化，部分克隆与浅克隆将使用位图索引和提交图加速。', 'success')
+            else:
+                flash(f'优化失败: {res.get("stderr") or res.get("error")}', 'error')
+            return redirect(url_for('view_settings', repo_name=clean_name))
+
         if action == 'delete_repo':
             confirm_name = request.form.get('verify_name')
             if confirm_name != clean_name:
@@ -1054,18 +2532,173 @@ def view_settings(repo_name):
                 return redirect(url_for('view_settings', repo_name=clean_name))
             
             try:
-                shutil.rmtree(repo_path)
-                flash(f'仓库 {clean_name} 已成功删除。', 'success')
-                return redirect(url_for('index'))
+                trash_path = move_repo_to_trash(clean_name, repo_path)
             except Exception as e:
                 flash(f'删除失败: {e}', 'error')
                 return redirect(url_for('view_settings', repo_name=clean_name))
+            job_id = job_queue.submit('purge_repo', clean_name, {'path': trash_path,
+                                                                 'lfs_objects': db.remove_lfs_objects(clean_name)})
+            flash(f'仓库 {clean_name} 已删除，文件正在后台清理（任务 #{job_id}）。', 'success')
+            return redirect(url_for('index'))
 
-    return render_template('settings.html', repo_name=clean_name)
+    local_config = {}
+    with iter_git_records(repo_path, ['config', '--local', '--get-regexp', r'^uploadpack\.']) as records:
+        for line in records:
+            parts = line.split(None, 1)
+            if len(parts) == 2:
+                local_config[parts[0].lower()] = parts[1]
+
+    clone_options = [{
+        'key': key,
+        'label': label,
+        'description': description,
+        'value': local_config.get(key.lower(), 'inherit')
+    } for key, label, description in CLONE_CONFIG_OPTIONS]
+
+    return render_template('settings.html',
+                           repo_name=clean_name,
+                           clone_options=clone_options,
+                           partial_clone_default=PARTIAL_CLONE_ENABLED)
+
+@app.route('/<repo_name>/settings/webhooks', methods=['GET', 'POST'])
+@require_auth
+def webhook_settings(repo_name):
+    """Webhook 配置与投递记录。"""
+    clean_name = repo_name[:-4] if repo_name.endswith('.git') else repo_name
+    repo_path = get_repo_path(clean_name)
+    if not repo_path: abort(404)
+
+    hooks = {hook['id']: hook for hook in db.get_webhooks(clean_name)}
+    if request.method == 'POST':
+        action = request.form.get('action')
+        hook = hooks.get(request.form.get('webhook_id', type=int))
+        if action == 'add_webhook':
+            url = request.form.get('url', '').strip()
+            if not url.startswith(('http://', 'https://')):
+                flash('Webhook 地址必须以 http:// 或 https:// 开头', 'error')
+            else:
+                hook_id = db.add_webhook(clean_name, url, request.form.get('secret', '').strip())
+                flash('Webhook 已添加', 'success')
+                return redirect(url_for('webhook_settings', repo_name=clean_name, webhook=hook_id))
+        elif hook is None:
+            flash('Webhook 不存在', 'error')
+        elif action == 'toggle_webhook':
+            db.set_webhook_active(hook['id'], not hook['active'])
+            flash('Webhook 已停用' if hook['active'] else 'Webhook 已启用', 'success')
+        elif action == 'delete_webhook':
+            db.delete_webhook(hook['id'])
+            flash('Webhook 已删除', 'success')
+            return redirect(url_for('webhook_settings', repo_name=clean_name))
+        elif action == 'ping_webhook':
+            webhook_dispatcher.ping(hook)
+            flash('已发送 ping 事件，稍后刷新查看投递结果', 'success')
+        elif action == 'redeliver':
+            if db.redeliver_webhook(hook['id'], request.form.get('delivery_id', type=int)):
+                flash('已重新排入投递队列', 'success')
+        return redirect(url_for('webhook_settings', repo_name=clean_name, webhook=hook['id'] if hook else None))
+
+    selected = hooks.get(request.args.get('webhook', type=int))
+    deliveries = db.get_webhook_deliveries(selected['id']) if selected else []
+    for delivery in deliveries:
+        if delivery['status'] == 'pending' and delivery['next_attempt_at']:
+            delivery['next_attempt'] = datetime.datetime.fromtimestamp(delivery['next_attempt_at']).strftime('%Y-%m-%d %H:%M:%S')
+
+    return render_template('webhooks.html',
+                           repo_name=clean_name,
+                           webhooks=list(hooks.values()),
+                           selected=selected,
+                           deliveries=deliveries)
+
+def optimize_repo(repo_path):
+    """重新打包并写入位图索引和提交图，加速过滤克隆与浅克隆的对象枚举。
+
+    fork 与上游共享对象库：fork 只打包自己的对象（-l），位图索引要求包含全部
+    可达对象，因此 fork 不写位图；被 fork 的仓库保留不可达对象（--keep-unreachable），
+    以免删掉 fork 仍在引用的对象。
+    """
+    env = git_service_env()
+    repack = ['repack', '-a', '-d']
+    if os.path.exists(get_alternates_file(repo_path)):
+        repack.append('-l')
+    else:
+        repack.append('--write-bitmap-index')
+    if find_dependent_repos(repo_path):
+        repack.append('--keep-unreachable')
+    for args in (repack, ['commit-graph', 'write', '--reachable']):
+        result = run_git_command(repo_path, args, op='maintenance', env=env)
+        if not result['success']:
+            return result
+    return {'success': True}
+
+def apply_web_commit(repo_name, repo_path, data):
+    """按 JSON 请求提交文件改动，不检出工作区；返回 (响应数据, 状态码)。
+
+    data 包含 message、changes（[{"path", "content", "encoding": "utf-8"|"base64"}]，
+    删除文件时为 {"path", "delete": true}），可选 branch（默认为 HEAD 指向的分支）、
+    parent（编辑时看到的分支提交，分支已被更新时返回 409；新建分支时传 40 个 0）
+    与 author（{"name", "email"}）。分支不存在且未声明新建时返回 404。
+    """
+    message = (data.get('message') or '').strip()
+    if not message:
+        return {'error': '请填写提交信息'}, 400
+    branch = data.get('branch')
+    if not branch:
+        head = run_git_command(repo_path, ['symbolic-ref', '--short', 'HEAD'])
+        branch = head['stdout'].strip() if head['success'] else 'master'
+
+    changes = {}
+    try:
+        for change in data.get('changes') or []:
+            path = change['path']
+            if change.get('delete'):
+                changes[path] = None
+            elif change.get('encoding') == 'base64':
+                changes[path] = base64.b64decode(change['content'], validate=True)
+            else:
+                changes[path] = change['content'].encode('utf-8')
+    except (KeyError, TypeError, AttributeError, ValueError):
+        return {'error': '改动格式错误'}, 400
+
+    author = None
+    if isinstance(data.get('author'), dict) and data['author'].get('name') and data['author'].get('email'):
+        author = (data['author']['name'], data['author']['email'])
+
+    lock = lock_repo_for_push(repo_name)
+    try:
+        # 等锁期间仓库可能已被迁移到其他卷，以取得锁之后的位置为准
+        repo_path = get_repo_path(repo_name)
+        if not repo_path:
+            return {'error': '未找到仓库'}, 404
+        result = webcommit.commit_changes(repo_path, branch, changes, message, author=author,
+                                          expected=data.get('parent'))
+    except webcommit.BranchNotFound as e:
+        return {'error': str(e)}, 404
+    except webcommit.RefConflict as e:
+        return {'error': str(e), 'current': e.actual}, 409
+    except (ValueError, RuntimeError) as e:
+        return {'error': str(e)}, 400
+    finally:
+        storage_pool.unlock(lock)
+
+    update_server_info(repo_path)
+    event_bus.publish(events.PushEvent(
+        repo_name, [events.RefUpdate(result['ref'], result['parent'] or webcommit.ZERO_ID, result['commit'])],
+        remote_addr=request.remote_addr or ''))
+    return {'success': True, 'branch': branch, 'commit': result['commit'], 'parent': result['parent']}, 201
+
+@app.route('/<repo_name>/commit', methods=['POST'])
+@require_auth
+def web_commit(repo_name):
+    """通过 Web 提交文件改动（JSON），详见 apply_web_commit。"""
+    clean_name = repo_name[:-4] if repo_name.endswith('.git') else repo_name
+    repo_path = get_repo_path(clean_name)
+    if not repo_path: return jsonify({ 'error': '未找到仓库' }), 404
+    body, status = apply_web_commit(clean_name, repo_path, request.get_json(silent=True) or {})
+    return jsonify(body), status
 
 @app.route('/<repo_name>/action', methods=['POST'])
 def git_action(repo_name):
-    """处理 推送/拉取/提交 (push/pull/commit)。"""
+    """处理 推送/拉取/提交 (push/pull/commit)。提交由 apply_web_commit 直接写入裸仓库。"""
     clean_name = repo_name[:-4] if repo_name.endswith('.git') else repo_name
     repo_path = get_repo_path(clean_name)
     if not repo_path: return jsonify({ 'error': '未找到仓库' }), 404
@@ -1078,9 +2711,10 @@ def git_action(repo_name):
     elif action == 'push':
         res = run_git_command(repo_path, ['push'])
     elif action == 'commit':
-        msg = data.get('message', '通过 Web 更新')
-        run_git_command(repo_path, ['add', '.'])
-        res = run_git_command(repo_path, ['commit', '-m', msg])
+        if get_password_hash() and not session.get('authenticated'):
+            return jsonify({ 'error': '需要登录' }), 401
+        body, status = apply_web_commit(clean_name, repo_path, data)
+        return jsonify(body), status
     else:
         return jsonify({ 'error': '位置操作' }), 400
         
@@ -1089,47 +2723,228 @@ def git_action(repo_name):
 @app.route('/<repo_name>/download/<ref>')
 @require_auth
 def download_zip(repo_name, ref):
-    """下载仓库的 ZIP 压缩包"""
+    """下载仓库的 ZIP 压缩包。
+
+    同一提交的压缩包生成后会缓存一段时间。浏览器请求未缓存的压缩包时，在后台任务中生成
+    并跳转到进度页面，完成后自动开始下载；其他客户端（curl、wget 等）直接流式接收。
+    """
     clean_name = repo_name[:-4] if repo_name.endswith('.git') else repo_name
     repo_path = get_repo_path(clean_name)
     if not repo_path: 
         abort(404)
     
-    import tempfile
-    import zipfile
-    from io import BytesIO
-    
-    try:
+    filename = f"{clean_name}-{ref}.zip"
+    commit = resolve_commit(repo_path, ref)
+    if commit is None:
+        flash(f'无法创建压缩包: 找不到引用 {ref}', 'error')
+        return redirect(url_for('view_repo', repo_name=clean_name))
 
-        result = subprocess.run(
-            ['git', 'archive', '--format=zip', ref],
-            cwd=repo_path,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            check=False
-        )
-        
-        if result.returncode != 0:
-            flash(f'无法创建压缩包: {result.stderr.decode("utf-8", errors="replace")}', 'error')
-            return redirect(url_for('view_repo', repo_name=clean_name))
-        
+    archive_path = get_archive_path(clean_name, commit)
+    if os.path.isfile(archive_path):
+        return send_file(archive_path, mimetype='application/zip', as_attachment=True,
+                         download_name=filename, conditional=True)
 
-        zip_data = BytesIO(result.stdout)
-        
+    if 'text/html' in request.headers.get('Accept', ''):
+        job_id = job_queue.submit('archive', clean_name, {'ref': ref, 'commit': commit},
+                                  dedupe_key=f'archive:{clean_name}:{commit}')
+        return redirect(url_for('view_job', job_id=job_id))
 
-        filename = f"{clean_name}-{ref}.zip"
-        
-        return send_file(
-            zip_data,
-            mimetype='application/zip',
-            as_attachment=True,
-            download_name=filename
+    slot = admission_control.acquire('archive', repo_path)
+    try:
+        stream, error = start_streaming_git(
+            ['git', 'archive', '--format=zip', commit],
+            cwd=repo_path,
+            op='archive',
+            release=lambda: admission_control.release(slot)
         )
-        
     except Exception as e:
+        admission_control.release(slot)
         flash(f'下载失败: {str(e)}', 'error')
         return redirect(url_for('view_repo', repo_name=clean_name))
 
+    if error is not None:
+        flash(f'无法创建压缩包: {error.decode("utf-8", errors="replace")}', 'error')
+        return redirect(url_for('view_repo', repo_name=clean_name))
+
+    response = Response(
+        stream,
+        mimetype='application/zip',
+        headers={'Content-Disposition': f"attachment; filename*=UTF-8''{quote(filename)}"},
+        direct_passthrough=True
+    )
+    response.call_on_close(stream.close)
+    return response
+
+def get_archive_path(repo_name, commit):
+    return os.path.join(ARCHIVE_DIR, repo_name, f'{commit}.zip')
+
+def run_archive_job(ctx):
+    """后台任务：把指定提交打包为 ZIP 写入缓存目录，进度按已写入字节与文件总大小估算。"""
+    repo_path = get_repo_path(ctx.repo_name)
+    if not repo_path:
+        raise RuntimeError('未找到仓库')
+    commit = ctx.params['commit']
+    archive_path = get_archive_path(ctx.repo_name, commit)
+    if os.path.isfile(archive_path):
+        return {'size': os.path.getsize(archive_path)}
+
+    total = 0
+    with iter_git_records(repo_path, ['ls-tree', '-r', '-l', '-z', commit], sep='\0') as records:
+        for record in records:
+            size = record.split(None, 4)[3:4]
+            if size and size[0].isdigit():
+                total += int(size[0])
+
+    archive_dir = os.path.dirname(archive_path)
+    os.makedirs(archive_dir, exist_ok=True)
+    tmp_path = f'{archive_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    written = 0
+    try:
+        with admission_control.admit('archive', repo_path, timeout=job_queue.lease_seconds):
+            with open(tmp_path, 'wb') as f, gitexec.GitProcess(['git', 'archive', '--format=zip', commit],
+                                                             cwd=repo_path, op='archive') as proc:
+                for chunk in proc.iter_chunks():
+                    f.write(chunk)
+                    written += len(chunk)
+                    ctx.progress(min(written / total, 0.99) if total else 0.5,
+                                 f'已写入 {written // 1024} KB')
+                if proc.wait() != 0:
+                    raise RuntimeError(proc.stderr.decode('utf-8', errors='replace') or 'git archive 失败')
+        os.replace(tmp_path, archive_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    cutoff = time.time() - ARCHIVE_CACHE_SECONDS
+    for entry in os.scandir(archive_dir):
+        if entry.name.endswith('.zip') and entry.stat().st_mtime < cutoff:
+            os.remove(entry.path)
+    return {'size': written}
+
+def run_import_job(ctx):
+    """后台任务：批量导入服务器上已有的裸仓库或 bundle 文件。"""
+    def progress(done, total, name):
+        ctx.progress(done / total, f'{done}/{total} {name}', force=True)
+
+    ctx.progress(0, '扫描导入来源', force=True)
+    return importer.import_repos(ctx.params['paths'], storage_pool, ctx.params.get('jobs') or IMPORT_JOBS, progress)
+
+def run_backup_job(ctx):
+    """后台任务：增量备份所有仓库、元数据库与 LFS 对象。
+
+    每个进程都会按计划提交备份任务，已有晚于计划时间的备份时直接跳过。
+    """
+    scheduled_at = ctx.params.get('scheduled_at')
+    latest = backup.latest_manifest(BACKUP_DIR)
+    if scheduled_at and latest and latest['started_at'] >= scheduled_at:
+        return {'skipped': latest['name']}
+    manifest = backup.run_backup(BACKUP_DIR, storage_pool, db.DB_FILE, LFS_DIR, BACKUP_JOBS,
+                                 int(BACKUP_RATE * 1024 * 1024), BACKUP_MAX_CHAIN, progress=ctx.progress)
+    if manifest['failed'] and not manifest['repos']:
+        raise RuntimeError(f'所有仓库备份失败: {manifest["failed"][0]["error"]}')
+    return manifest
+
+def run_backup_scheduler():
+    """每天在 BACKUP_TIME（本地时间 HH:MM）提交一次备份任务。"""
+    hour, minute = (int(part) for part in BACKUP_TIME.split(':'))
+    while True:
+        now = datetime.datetime.now()
+        target = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if target <= now:
+            target += datetime.timedelta(days=1)
+        time.sleep((target - now).total_seconds())
+        try:
+            job_queue.submit('backup', params={'scheduled_at': target.timestamp()}, dedupe_key='backup')
+        except Exception as e:
+            print(f"提交备份任务失败: {e}")
+
+JOB_TITLES = {
+    'create_repo': '创建仓库',
+    'purge_repo': '删除仓库',
+    'archive': '生成压缩包',
+    'import': '导入仓库',
+    'backup': '备份',
+}
+JOB_STATUS_LABELS = {
+    'queued': '排队中',
+    'running': '进行中',
+    'done': '已完成',
+    'failed': '失败',
+}
+
+def job_status(job):
+    """任务的对外表示；成功结束的任务附带下一步跳转的地址。"""
+    data = {key: job[key] for key in ('id', 'kind', 'repo_name', 'status', 'progress', 'message', 'error',
+                                      'created_at', 'started_at', 'finished_at')}
+    data['next_url'] = None
+    if job['status'] == 'done':
+        if job['kind'] == 'create_repo':
+            data['next_url'] = url_for('view_repo', repo_name=job['repo_name'])
+        elif job['kind'] == 'archive':
+            data['next_url'] = url_for('download_zip', repo_name=job['repo_name'],
+                                       ref=json.loads(job['params'])['ref'])
+        elif job['kind'] == 'purge_repo':
+            data['next_url'] = url_for('index')
+        elif job['kind'] == 'backup':
+            result = json.loads(job['result'])
+            if 'skipped' in result:
+                data['message'] = f"已有更新的备份 {result['skipped']}，跳过"
+            else:
+                data['message'] = (f"备份 {len(result['repos'])} 个仓库（{result['changed']} 个有变化），"
+                                   f"失败 {len(result['failed'])} 个")
+        elif job['kind'] == 'import':
+            data['result'] = json.loads(job['result'])
+            data['message'] = (f"导入 {len(data['result']['imported'])} 个，跳过 {len(data['result']['skipped'])} 个，"
+                               f"失败 {len(data['result']['failed'])} 个")
+            data['next_url'] = url_for('index')
+    return data
+
+@app.route('/jobs/<int:job_id>')
+@require_auth
+def view_job(job_id):
+    """任务进度页面；?format=json 返回 JSON，供轮询使用。"""
+    job = db.get_job(job_id)
+    if not job: abort(404)
+    data = job_status(job)
+    if request.args.get('format') == 'json':
+        return jsonify(data)
+    return render_template('job.html',
+                           job=data,
+                           title=JOB_TITLES.get(job['kind'], job['kind']),
+                           status_labels=JOB_STATUS_LABELS)
+
+@app.route('/jobs/<int:job_id>/events')
+@require_auth
+def job_events(job_id):
+    """以 Server-Sent Events 推送任务进度，任务结束或连接超过 JOB_EVENTS_TIMEOUT 后关闭连接。"""
+    if not db.get_job(job_id): abort(404)
+
+    def generate():
+        yield 'retry: 1000\n\n'
+        last = None
+        deadline = time.monotonic() + JOB_EVENTS_TIMEOUT
+        while time.monotonic() < deadline:
+            data = job_status(db.get_job(job_id))
+            payload = json.dumps(data, ensure_ascii=False)
+            if payload != last:
+                yield f'data: {payload}\n\n'
+                last = payload
+            if data['status'] in ('done', 'failed'):
+                return
+            time.sleep(0.5)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+job_queue.register('create_repo', run_create_repo_job)
+job_queue.register('purge_repo', run_purge_repo_job)
+job_queue.register('archive', run_archive_job)
+job_queue.register('import', run_import_job)
+job_queue.register('backup', run_backup_job)
+job_queue.start()
+if BACKUP_DIR:
+    threading.Thread(target=run_backup_scheduler, name='backup-scheduler', daemon=True).start()
+
 @app.route('/upload_temp_asset', methods=['POST'])
 @require_auth
 def upload_temp_asset():
@@ -1178,8 +2993,8 @@ def new_release(repo_name):
     if not repo_path: abort(404)
     
 
-    tags_res = run_git_command(repo_path, ['tag', '-l'])
-    tags = tags_res['stdout'].splitlines() if tags_res['success'] else []
+    with iter_git_records(repo_path, ['tag', '-l']) as records:
+        tags = [t for t in records if t]
     
     if request.method == 'POST':
         tag_name = request.form.get('tag_name')
@@ -1194,9 +3009,11 @@ def new_release(repo_name):
             
 
         if tag_name not in tags:
-
-
-            res = run_git_command(repo_path, ['tag', tag_name, target_commitish])
+            with repo_write_lock(clean_name) as repo_path:
+                if not repo_path: abort(404)
+                res = run_git_command(repo_path, ['tag', tag_name, target_commitish])
+                if res['success']:
+                    update_server_info(repo_path)
             if not res['success']:
                 flash(f'创建标签失败: {res["stderr"]}', 'error')
                 return redirect(url_for('new_release', repo_name=clean_name))
@@ -1205,7 +3022,7 @@ def new_release(repo_name):
         release_id = db.create_release(clean_name, tag_name, target_commitish, name, body, is_prerelease=is_prerelease)
         
 
-        upload_dir = os.path.join(DATA_DIR, clean_name, 'releases', str(release_id))
+        upload_dir = os.path.join(repo_path, 'releases', str(release_id))
         
 
         temp_keys = request.form.getlist('uploaded_file_keys')
@@ -1280,8 +3097,9 @@ def delete_release_route(repo_name, release_id):
                 pass
     
 
-    release_dir = os.path.join(DATA_DIR, clean_name, 'releases', str(release_id))
-    if os.path.exists(release_dir):
+    repo_path = get_repo_path(clean_name)
+    release_dir = os.path.join(repo_path, 'releases', str(release_id)) if repo_path else None
+    if release_dir and os.path.exists(release_dir):
         try:
             shutil.rmtree(release_dir)
         except:
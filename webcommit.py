@@ -0,0 +1,175 @@
+"""不经过工作区的 Web 提交。
+
+在分支现有的树上只重写改动路径所在的目录：hash-object 写入新的文件内容，
+自底向上用 ls-tree + mktree 重建受影响的目录树，commit-tree 生成提交，
+最后以比较并交换的方式 update-ref 前移分支。分支在此期间被推送改变时
+更新失败并抛出 RefConflict，不会覆盖别人的提交。
+
+开销只与改动的路径数及其所在目录的大小有关，与仓库的文件总数无关。
+"""
+import os
+
+import gitexec
+from importer import COMMITTER, check
+
+
+ZERO_ID = '0' * 40
+
+
+class BranchNotFound(Exception):
+    """分支不存在，且调用方没有声明要创建它。"""
+
+
+class RefConflict(Exception):
+    """分支已不在调用方预期的提交上。"""
+
+    def __init__(self, ref, expected, actual):
+        super().__init__(f'{ref} 已被更新为 {actual[:7] if actual else "（不存在）"}，请基于最新提交重试')
+        self.ref = ref
+        self.expected = expected
+        self.actual = actual
+
+
+def normalize_path(path):
+    """规范化仓库内的路径并拒绝不安全的写法，返回路径分段列表。"""
+    parts = [p for p in path.replace('\\', '/').split('/') if p]
+    if not parts:
+        raise ValueError('文件路径不能为空')
+    for part in parts:
+        if part in ('.', '..') or part.lower() == '.git' or '\0' in part:
+            raise ValueError(f'非法的文件路径: {path}')
+    return parts
+
+
+def read_branch(repo_path, ref, op='default'):
+    """返回 (提交, 树)；分支不存在时返回 (None, None)。"""
+    res = gitexec.run(['git', 'log', '-1', '--format=%H %T', ref, '--'], cwd=repo_path, op=op)
+    if res['returncode'] != 0 or not res['stdout'].strip():
+        return None, None
+    commit, tree = res['stdout'].decode('ascii').split()
+    return commit, tree
+
+
+def read_tree(repo_path, tree, op='default'):
+    """读取一层目录树：{名称: (模式, 类型, SHA)}。"""
+    res = check(gitexec.run(['git', 'ls-tree', '-z', tree], cwd=repo_path, op=op), 'git ls-tree')
+    entries = {}
+    for record in res['stdout'].split(b'\0'):
+        if not record:
+            continue
+        info, _, name = record.partition(b'\t')
+        mode, kind, sha = info.decode('ascii').split()
+        entries[name.decode('utf-8', errors='surrogateescape')] = (mode, kind, sha)
+    return entries
+
+
+def write_tree(repo_path, entries, op='default'):
+    stream = b''.join(f'{mode} {kind} {sha}\t'.encode('ascii') + name.encode('utf-8', errors='surrogateescape') + b'\0'
+                      for name, (mode, kind, sha) in sorted(entries.items()))
+    res = check(gitexec.run(['git', 'mktree', '-z'], cwd=repo_path, op=op, input=stream), 'git mktree')
+    return res['stdout'].decode('ascii').strip()
+
+
+def write_blob(repo_path, content, op='default'):
+    res = check(gitexec.run(['git', 'hash-object', '-w', '--no-filters', '--stdin'], cwd=repo_path, op=op,
+                            input=content), 'git hash-object')
+    return res['stdout'].decode('ascii').strip()
+
+
+def build_tree(repo_path, tree, changes, prefix='', op='default'):
+    """在 tree 上应用 changes，返回新树的 SHA；目录变为空时返回 None。
+
+    changes 为 {名称: 子目录的 changes | 新文件的 blob SHA | None（删除）}。
+    只读取和重写 changes 涉及的目录，其余子树原样引用。
+    """
+    entries = read_tree(repo_path, tree, op) if tree else {}
+    for name, change in changes.items():
+        current = entries.get(name)
+        path = prefix + name
+        if isinstance(change, dict):
+            if current and current[1] != 'tree':
+                raise ValueError(f'{path} 是文件，不能作为目录写入')
+            subtree = current[2] if current else None
+            new_tree = build_tree(repo_path, subtree, change, path + '/', op)
+            if new_tree is None:
+                entries.pop(name, None)
+            else:
+                entries[name] = ('040000', 'tree', new_tree)
+        elif change is None:
+            if current is None or current[1] == 'tree':
+                raise ValueError(f'要删除的文件不存在: {path}')
+            del entries[name]
+        else:
+            if current and current[1] != 'blob':
+                raise ValueError(f'{path} 是目录或子模块，不能作为文件写入')
+            # 保留可执行位与符号链接（内容即链接目标），其余按普通文件写入
+            mode = current[0] if current and current[0] in ('100755', '120000') else '100644'
+            entries[name] = (mode, 'blob', change)
+    if not entries:
+        return None
+    return write_tree(repo_path, entries, op)
+
+
+def commit_changes(repo_path, branch, changes, message, author=None, expected=None, op='default'):
+    """把 changes（{路径: bytes 或 None（删除）}）提交到分支 branch。
+
+    expected 为调用方看到的分支提交，为 None 时基于当前提交；分支与之不符或在提交过程中
+    被推送改变时抛出 RefConflict。只有 expected 为 ZERO_ID 时才会新建分支，否则分支不存在
+    时抛出 BranchNotFound。author 为 (名称, 邮箱)，默认与提交者相同。
+    返回 {'ref', 'commit', 'parent', 'tree'}。
+    """
+    ref = f'refs/heads/{branch}'
+    check(gitexec.run(['git', 'check-ref-format', ref], cwd=repo_path, op=op), f'分支名称 {branch}')
+    if not changes:
+        raise ValueError('没有要提交的更改')
+
+    parent, base_tree = read_branch(repo_path, ref, op)
+    if parent is None and expected is None:
+        raise BranchNotFound(f'分支 {branch} 不存在')
+    if expected is not None and (expected or ZERO_ID) != (parent or ZERO_ID):
+        raise RefConflict(ref, expected, parent)
+
+    tree_changes = {}
+    blobs = {}
+    for path, content in changes.items():
+        parts = normalize_path(path)
+        node = tree_changes
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+            if not isinstance(node, dict):
+                raise ValueError(f'路径冲突: {path}')
+        if isinstance(node.get(parts[-1]), dict):
+            raise ValueError(f'路径冲突: {path}')
+        if content is None:
+            node[parts[-1]] = None
+        else:
+            if content not in blobs:
+                blobs[content] = write_blob(repo_path, content, op)
+            node[parts[-1]] = blobs[content]
+
+    tree = build_tree(repo_path, base_tree, tree_changes, op=op)
+    if tree is None:
+        raise ValueError('提交后仓库将不包含任何文件')
+    if tree == base_tree:
+        raise ValueError('内容没有变化')
+
+    author = author or COMMITTER
+    env = os.environ.copy()
+    env.update({
+        'GIT_AUTHOR_NAME': author[0], 'GIT_AUTHOR_EMAIL': author[1],
+        'GIT_COMMITTER_NAME': COMMITTER[0], 'GIT_COMMITTER_EMAIL': COMMITTER[1],
+    })
+    args = ['git', 'commit-tree', tree] + (['-p', parent] if parent else []) + ['-F', '-']
+    res = check(gitexec.run(args, cwd=repo_path, op=op, env=env, input=message.encode('utf-8')),
+                'git commit-tree')
+    commit = res['stdout'].decode('ascii').strip()
+
+    summary = message.splitlines()[0] if message.strip() else ''
+    res = gitexec.run(['git', 'update-ref', '-m', f'web commit: {summary}', ref, commit, parent or ZERO_ID],
+                      cwd=repo_path, op=op)
+    if res['returncode'] != 0:
+        actual, _ = read_branch(repo_path, ref, op)
+        if actual != parent:
+            raise RefConflict(ref, parent, actual)
+        check(res, 'git update-ref')
+    return {'ref': ref, 'commit': commit, 'parent': parent, 'tree': tree}
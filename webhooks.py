@@ -0,0 +1,176 @@
+"""Webhook 投递：推送事件进入持久化投递队列，由后台线程池发送。
+
+推送请求只负责把事件写入事件总线；本模块作为总线的订阅者，为仓库的每个启用的
+Webhook 排入一条投递记录。同一 Webhook 在合并窗口内的多次推送合并为一次投递
+（同一引用取最早的旧值和最新的新值）。发送失败按指数退避重试，每次尝试都记录在
+webhook_attempts 中。投递记录通过加锁字段认领，多个进程可以同时运行工作线程。
+"""
+import hashlib
+import hmac
+import json
+import os
+import random
+import threading
+import time
+import traceback
+import urllib.error
+import urllib.request
+
+import db
+import events
+import metrics
+
+
+RESPONSE_LIMIT = 4096
+
+
+def push_payload(event):
+    """把 PushEvent 转换为投递负载。"""
+    return {
+        'event': 'push',
+        'repository': {'name': event.repo},
+        'event_ids': [event.id],
+        'pushed_at': event.pushed_at,
+        'updates': [{'ref': u.ref, 'before': u.old, 'after': u.new, 'kind': u.kind} for u in event.updates],
+    }
+
+
+def merge_push_payloads(old_json, new_json):
+    """合并两次推送的负载：同一引用保留最早的 before 与最新的 after，前后相同的引用被省略。
+
+    所有引用都回到了合并前的状态（例如创建后又删除）时返回 None，不再投递。
+    """
+    old = json.loads(old_json)
+    new = json.loads(new_json)
+    refs = {}
+    for update in old['updates'] + new['updates']:
+        if update['ref'] in refs:
+            refs[update['ref']]['after'] = update['after']
+        else:
+            refs[update['ref']] = dict(update)
+    updates = []
+    for update in refs.values():
+        if update['before'] == update['after']:
+            continue
+        update['kind'] = events.RefUpdate(update['ref'], update['before'], update['after']).kind
+        updates.append(update)
+    if not updates:
+        return None
+    old.update(event_ids=old['event_ids'] + new['event_ids'], pushed_at=new['pushed_at'], updates=updates)
+    return json.dumps(old, ensure_ascii=False)
+
+
+def sign(secret, body):
+    """与 GitHub 相同的 HMAC-SHA256 签名（X-Hub-Signature-256）。"""
+    return 'sha256=' + hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+
+
+class WebhookDispatcher:
+    """Webhook 投递线程池。
+
+    handle_push 注册为事件总线的订阅者；start() 启动 workers 个投递线程。
+    第 n 次失败后等待 backoff_base * 2**(n-1) 秒（不超过 backoff_max，带 ±20% 抖动）再重试，
+    共尝试 max_attempts 次。
+    """
+
+    LEASE_SECONDS = 300
+    PRUNE_INTERVAL = 3600
+
+    def __init__(self, workers=4, coalesce_seconds=2.0, max_attempts=8, timeout=10.0,
+                 backoff_base=10.0, backoff_max=3600.0, poll_interval=1.0, keep_days=30):
+        self.workers = workers
+        self.coalesce_seconds = coalesce_seconds
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.poll_interval = poll_interval
+        self.keep_days = keep_days
+        self.owner = f'{os.getpid()}:{id(self)}'
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._last_prune = 0.0
+        self._lock = threading.Lock()
+
+    def handle_push(self, event):
+        """事件总线回调：为仓库的每个启用的 Webhook 排入（或合并）一次投递。"""
+        payload = json.dumps(push_payload(event), ensure_ascii=False)
+        not_before = time.time() + self.coalesce_seconds
+        for hook in db.get_webhooks(event.repo, active_only=True):
+            db.enqueue_webhook_delivery(hook['id'], 'push', payload, merge_push_payloads, not_before)
+        self._wakeup.set()
+
+    def ping(self, webhook):
+        """立即投递一次 ping 事件，用于测试 Webhook 配置。"""
+        payload = json.dumps({'event': 'ping', 'repository': {'name': webhook['repo_name']}, 'hook_id': webhook['id']})
+        delivery_id = db.enqueue_webhook_delivery(webhook['id'], 'ping', payload, lambda old, new: new, time.time())
+        self._wakeup.set()
+        return delivery_id
+
+    def start(self):
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            for i in range(len(self._threads), self.workers):
+                thread = threading.Thread(target=self._run, name=f'webhook-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            try:
+                delivery = db.claim_webhook_delivery(self.owner, self.LEASE_SECONDS)
+                if delivery is None:
+                    self._maybe_prune()
+                    self._wakeup.wait(self.poll_interval)
+                    self._wakeup.clear()
+                    continue
+                self.deliver(delivery)
+            except Exception:
+                traceback.print_exc()
+                time.sleep(self.poll_interval)
+
+    def _maybe_prune(self):
+        with self._lock:
+            if time.monotonic() - self._last_prune < self.PRUNE_INTERVAL:
+                return
+            self._last_prune = time.monotonic()
+        db.prune_webhook_deliveries(self.keep_days)
+        db.prune_push_events()
+
+    def deliver(self, delivery):
+        """发送一条已认领的投递并记录结果，返回投递状态。"""
+        body = delivery['payload'].encode('utf-8')
+        headers = {
+            'Content-Type': 'application/json',
+            'User-Agent': 'Olsc-GitWeb-Hookshot',
+            'X-Olsc-Event': delivery['event'],
+            'X-Olsc-Delivery': str(delivery['id']),
+        }
+        if delivery['secret']:
+            headers['X-Hub-Signature-256'] = sign(delivery['secret'], body)
+
+        status_code = None
+        response = ''
+        error = None
+        started = time.monotonic()
+        try:
+            req = urllib.request.Request(delivery['url'], data=body, headers=headers, method='POST')
+            with urllib.request.urlopen(req, timeout=self.timeout) as res:
+                status_code = res.status
+                response = res.read(RESPONSE_LIMIT).decode('utf-8', errors='replace')
+        except urllib.error.HTTPError as e:
+            status_code = e.code
+            response = e.read(RESPONSE_LIMIT).decode('utf-8', errors='replace')
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+        duration_ms = int((time.monotonic() - started) * 1000)
+
+        next_attempt_at = None
+        attempt = delivery['attempts'] + 1
+        if not (status_code is not None and 200 <= status_code < 300) and attempt < self.max_attempts:
+            delay = min(self.backoff_base * 2 ** (attempt - 1), self.backoff_max)
+            next_attempt_at = time.time() + delay * random.uniform(0.8, 1.2)
+        status = db.finish_webhook_attempt(delivery['id'], self.owner, status_code, response, error,
+                                           duration_ms, next_attempt_at)
+        metrics.WEBHOOK_ATTEMPTS.inc(status='retry' if status == 'pending' else status)
+        return status